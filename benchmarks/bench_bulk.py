@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the bulk archive pipeline.
+
+Drives `generate_bulk_zip`, `schema_to_csv`, `org_with_extras_to_csv` and
+`build_manifest` over synthetic packages and resources. CKAN and
+ckanext-scheming are replaced by local stand-ins (toolkit actions, config,
+`h.url_for`, `scheming_get_dataset_schema`), so only Flask, Jinja2 and
+bitmath need to be installed.
+
+Each case runs in a forked child process, and reports wall time, peak RSS
+(and growth over the synthetic input) and, for whole archives, the archive
+size and the per-stage timings.
+
+    python benchmarks/bench_bulk.py --scale 100 10000 1000000
+    python benchmarks/bench_bulk.py --json results.json
+    python benchmarks/bench_bulk.py --compare results.json --tolerance 0.2
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATASET_FIELDS = 40
+RESOURCE_FIELDS = 20
+PACKAGE_TYPES = ["amplicon", "metagenomics", "genomics"]
+RESOURCE_TYPES = ["amplicon", "metagenomics", "genomics"]
+
+
+def dataset_schema(typ):
+    return {
+        "dataset_type": typ,
+        "dataset_fields": [
+            {"field_name": "name", "label": "Name"},
+            {"field_name": "title", "label": "Title"},
+        ]
+        + [
+            {"field_name": "field_%d" % i, "label": "Field %d" % i}
+            for i in range(DATASET_FIELDS - 2)
+        ],
+        "resource_fields": [
+            {"field_name": "name", "label": "Name"},
+            {"field_name": "url", "label": "URL"},
+            {"field_name": "size", "label": "Size"},
+            {"field_name": "md5", "label": "MD5"},
+        ]
+        + [
+            {"field_name": "rfield_%d" % i, "label": "Resource Field %d" % i}
+            for i in range(RESOURCE_FIELDS - 4)
+        ],
+    }
+
+
+def install_stand_ins():
+    """
+    register stand-in CKAN and ckanext-scheming modules, so that
+    ckanext.bulk can be imported without a CKAN instance
+    """
+
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    class Abort(Exception):
+        pass
+
+    def abort(status_code, detail=None, headers=None, comment=None):
+        raise Abort(status_code, detail)
+
+    actions = {
+        "get_available_organizations": lambda context, data_dict: [
+            {"name": "org-0"}
+        ],
+    }
+    config = {
+        "ckan.site_url": "https://data.example.org",
+        "ckan.site_description": "Example Data Portal",
+        "error_email_from": "help@example.org",
+        # an empty member cache, so that each case builds its archive members
+        "ckanext.bulk.cache_dir": tempfile.mkdtemp(prefix="bench_bulk_"),
+    }
+
+    def url_for(endpoint, **kwargs):
+        return "/%s/%s" % (endpoint.replace(".", "/"), kwargs.get("id", ""))
+
+    def asbool(v):
+        return str(v).strip().lower() in ("yes", "true", "t", "y", "1", "on")
+
+    toolkit = module(
+        "ckan.plugins.toolkit",
+        config=config,
+        get_action=lambda name: actions[name],
+        asbool=asbool,
+        asint=int,
+        _=lambda s: s,
+        abort=abort,
+    )
+    plugins = module("ckan.plugins", toolkit=toolkit)
+    helpers = module(
+        "ckan.lib.helpers",
+        url_for=url_for,
+        get_display_timezone=lambda: datetime.timezone.utc,
+    )
+    module("ckan.lib", helpers=helpers)
+    module("ckan.lib.base", abort=abort)
+    module(
+        "ckan.logic",
+        get_action=toolkit.get_action,
+        check_access=lambda name, context, data_dict=None: True,
+        NotFound=LookupError,
+        NotAuthorized=PermissionError,
+    )
+    module("ckan.common", request=None, c=types.SimpleNamespace(user="", userobj=None))
+    model = module("ckan.model")
+    module("ckan", plugins=plugins, lib=sys.modules["ckan.lib"], model=model)
+    scheming_helpers = module(
+        "ckanext.scheming.helpers", scheming_get_dataset_schema=dataset_schema
+    )
+    module("ckanext.scheming", helpers=scheming_helpers)
+
+
+def synthetic_data(resource_count, resources_per_package):
+    package_count = max(1, resource_count // resources_per_package)
+    organizations = [
+        {
+            "name": "org-%d" % i,
+            "display_name": "Organization %d" % i,
+            "extras": [
+                {"key": "extra_%d" % j, "value": "value %d" % j, "state": "active"}
+                for j in range(20)
+            ],
+        }
+        for i in range(10)
+    ]
+    packages = []
+    resources = []
+    for i in range(package_count):
+        typ = PACKAGE_TYPES[i % len(PACKAGE_TYPES)]
+        package = {
+            "id": "package-%d" % i,
+            "name": "package-%d" % i,
+            "title": "Package %d" % i,
+            "type": typ,
+            "metadata_modified": "2024-01-01T00:00:00.000000",
+            "organization": organizations[i % len(organizations)],
+            "resources": [],
+        }
+        for j in range(DATASET_FIELDS - 2):
+            package["field_%d" % j] = "value %d %d" % (i, j)
+        for j in range(resources_per_package):
+            n = i * resources_per_package + j
+            res = {
+                "id": "resource-%d" % n,
+                "package_id": package["id"],
+                "name": "file_%d.fastq.gz" % n,
+                "url": "https://data.example.org/dataset/%s/resource/resource-%d/download/file_%d.fastq.gz"
+                % (package["id"], n, n),
+                "size": 1024 * (n + 1),
+                "md5": hashlib.md5(str(n).encode("utf-8")).hexdigest(),
+                "resource_type": RESOURCE_TYPES[n % len(RESOURCE_TYPES)],
+                "optional_file": n % 10 == 0,
+            }
+            for k in range(RESOURCE_FIELDS - 4):
+                res["rfield_%d" % k] = "resource value %d %d" % (n, k)
+            package["resources"].append(res)
+            resources.append(res)
+        packages.append(package)
+    return organizations, packages, resources
+
+
+def rss_bytes():
+    # current resident set size, where /proc is available
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on MacOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def paged_packages(packages, page_size=1000):
+    # stands in for `iter_packages`: the packages are decoded from JSON a
+    # page at a time, as they are read from the search index, so that the
+    # package dicts loaded are only held as long as the pipeline keeps them
+    for i in range(0, len(packages), page_size):
+        yield from json.loads(json.dumps(packages[i : i + page_size]))
+
+
+def case_manifest(zipoutput, data):
+    organizations, packages, resources = data
+    zipoutput.build_manifest(resources)
+    return {}
+
+
+def by_type(objects, attr):
+    grouped = {}
+    for obj in objects:
+        grouped.setdefault(obj.get(attr, "unknown"), []).append(obj)
+    return grouped
+
+
+def case_schema_to_csv(zipoutput, data):
+    organizations, packages, resources = data
+    size = 0
+    digest = hashlib.sha1()
+    for typ, typ_packages in by_type(packages, "type").items():
+        output = zipoutput.schema_to_csv(typ, "dataset_fields", typ_packages)
+        size += len(output)
+        digest.update(output)
+    for typ, typ_resources in by_type(resources, "resource_type").items():
+        output = zipoutput.schema_to_csv(typ, "resource_fields", typ_resources)
+        size += len(output)
+        digest.update(output)
+    # the same for the same input, whichever path wrote the rows
+    return {"output_bytes": size, "output_sha1": digest.hexdigest()}
+
+
+def case_csv_spool(zipoutput, data):
+    # the CSVs as the archive pipeline writes them, spooled a row at a time
+    # to temporary files; the digest should match `schema_to_csv`
+    organizations, packages, resources = data
+    size = 0
+    digest = hashlib.sha1()
+    for attr, schema_key, objects in [
+        ("type", "dataset_fields", packages),
+        ("resource_type", "resource_fields", resources),
+    ]:
+        spools = {}
+        for obj in objects:
+            typ = obj.get(attr, "unknown")
+            if typ not in spools:
+                spools[typ] = zipoutput.CsvSpool(typ, schema_key)
+            spools[typ].add(obj)
+        for typ_spool in spools.values():
+            output = typ_spool.csv().read()
+            typ_spool.close()
+            size += len(output)
+            digest.update(output)
+    return {"output_bytes": size, "output_sha1": digest.hexdigest()}
+
+
+def case_schema_to_csv_cells(zipoutput, data):
+    # the per-cell path which `csv_rows` replaced, for comparison; each
+    # case runs in its own process, so the module is patched for this one
+    def cell_rows(objects, columns):
+        field_names = [column.source for column in columns]
+        return [column.header for column in columns], [
+            [zipoutput.encode_field(obj.get(field_name, "")) for field_name in field_names]
+            for obj in objects
+        ]
+
+    zipoutput.csv_rows = cell_rows
+    return case_schema_to_csv(zipoutput, data)
+
+
+def case_org_with_extras_to_csv(zipoutput, data):
+    organizations, packages, resources = data
+    size = 0
+    for org in organizations:
+        size += len(zipoutput.org_with_extras_to_csv(org))
+    return {"output_bytes": size}
+
+
+def case_generate_bulk_zip(zipoutput, data):
+    from flask import Flask, g
+    from ckanext.bulk.timing import StageTimer
+
+    organizations, packages, resources = data
+    user = types.SimpleNamespace(name="benchmark", sysadmin=False)
+    fingerprint = sorted((t["id"], t["metadata_modified"]) for t in packages)
+    app = Flask(__name__)
+    with app.test_request_context("/bulk/dataset/file_list"):
+        g.bulk_timer = timer = StageTimer()
+        # as the views do, the packages are read once, as the members are built
+        shared = zipoutput.shared_members(fingerprint, paged_packages(packages))
+        response = zipoutput.generate_bulk_zip(
+            "bpa_benchmark",
+            "Benchmark",
+            user,
+            [{"name": "org-0"}],
+            organizations[:2],
+            organizations,
+            shared,
+            "*:*",
+            "https://data.example.org/dataset",
+            "https://data.example.org/bulk/dataset/file_list",
+        )
+        return {
+            "archive_bytes": len(response.get_data()),
+            "stages_ms": timer.as_dict(),
+        }
+
+
+CASES = {
+    "manifest": case_manifest,
+    "schema_to_csv": case_schema_to_csv,
+    "schema_to_csv_cells": case_schema_to_csv_cells,
+    "csv_spool": case_csv_spool,
+    "org_with_extras_to_csv": case_org_with_extras_to_csv,
+    "generate_bulk_zip": case_generate_bulk_zip,
+}
+
+
+def run_case(name, scale, resources_per_package, queue):
+    sys.path.insert(0, REPO)
+    install_stand_ins()
+    from ckanext.bulk import zipoutput
+
+    data = synthetic_data(scale, resources_per_package)
+    baseline = rss_bytes()
+    start = time.perf_counter()
+    result = CASES[name](zipoutput, data)
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_bytes()
+    result.update(
+        {
+            "case": name,
+            "scale": scale,
+            "seconds": elapsed,
+            "peak_rss_bytes": peak,
+            "rss_growth_bytes": max(0, peak - baseline)
+            if baseline is not None
+            else None,
+        }
+    )
+    queue.put(result)
+
+
+def run(name, scale, resources_per_package):
+    # fork a fresh process per case so that peak RSS is not cumulative
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_case, args=(name, scale, resources_per_package, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def mib(n):
+    return "-" if n is None else "%.1f MiB" % (n / 1048576.0,)
+
+
+def report(result):
+    line = "%-24s %9d  %9.3fs  peak %11s  growth %11s" % (
+        result["case"],
+        result["scale"],
+        result["seconds"],
+        mib(result["peak_rss_bytes"]),
+        mib(result["rss_growth_bytes"]),
+    )
+    if "archive_bytes" in result:
+        line += "  archive %s" % (mib(result["archive_bytes"]),)
+    if "output_sha1" in result:
+        line += "  output %s" % (result["output_sha1"][:12],)
+    print(line)
+    if "stages_ms" in result:
+        print(
+            "    "
+            + ", ".join("%s=%.0fms" % (k, v) for k, v in result["stages_ms"].items())
+        )
+    sys.stdout.flush()
+
+
+def compare(results, previous, tolerance):
+    # returns the cases which are slower than the previous run by more
+    # than the tolerance
+    before = {(r["case"], r["scale"]): r for r in previous}
+    regressions = []
+    for result in results:
+        old = before.get((result["case"], result["scale"]))
+        if old is None:
+            continue
+        if result["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scale",
+        type=int,
+        nargs="+",
+        default=[100, 10000, 1000000],
+        help="number of resources (default: 100 10000 1000000)",
+    )
+    parser.add_argument(
+        "--resources-per-package",
+        type=int,
+        default=10,
+        help="resources in each synthetic package (default: 10)",
+    )
+    parser.add_argument(
+        "--case",
+        choices=sorted(CASES),
+        nargs="+",
+        default=list(CASES),
+        help="cases to run (default: all)",
+    )
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="compare against results from --json")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fractional slowdown reported as a regression (default: 0.2)",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scale:
+        for name in args.case:
+            result = run(name, scale, args.resources_per_package)
+            report(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump(results, fd, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance)
+        for result, old in regressions:
+            print(
+                "REGRESSION %s at %d: %.3fs (was %.3fs)"
+                % (result["case"], result["scale"], result["seconds"], old["seconds"])
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the download engines of the generated download.py.
+
+Serves synthetic files from a local stand-in HTTP server (HTTP/1.1, with
+keep-alive and an optional per-request latency, to stand in for the round
+trip to the portal), renders download.py from `PY_TEMPLATE`, and runs it
+against the server with each engine and concurrency given. Needs Jinja2 and
+requests, and aiohttp for the async engine.
+
+Each run reports wall time, files and bytes per second, and the CPU time
+and peak RSS of the download.py process, and checks that every file was
+downloaded and verified.
+
+    python benchmarks/bench_download.py --files 5000 --size 4096
+    python benchmarks/bench_download.py --engine threads:4 async:200 --latency 0.05
+    python benchmarks/bench_download.py --files 4 --size 268435456 --chunk-size 8K 4M
+    python benchmarks/bench_download.py --json results.json
+"""
+
+import argparse
+import hashlib
+import http.server
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREFIX = "bpa_bench"
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # many connections are opened at once by the async engine
+    request_queue_size = 1024
+
+    def __init__(self, files, latency):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.files = files
+        self.latency = latency
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.files.get(self.path.rsplit("/", 1)[-1])
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+def synthetic_files(count, size):
+    # distinct, deterministic contents
+    return {
+        "file_%06d.bin" % i: hashlib.sha256(b"%d" % i).digest() * (size // 32) + b"x" * (size % 32)
+        for i in range(count)
+    }
+
+
+def render_download_py(site_url):
+    import jinja2
+
+    spec = importlib.util.spec_from_file_location(
+        "python_template", os.path.join(REPO, "ckanext", "bulk", "python.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return jinja2.Environment().from_string(module.PY_TEMPLATE).render(
+        user_page=None, prefix=PREFIX, username="bench", site_url=site_url
+    )
+
+
+def run(script, files, site_url, engine, jobs, chunk_size):
+    # a fresh directory per run, so that nothing is already downloaded
+    directory = tempfile.mkdtemp(prefix="bench_download_")
+    try:
+        os.makedirs(os.path.join(directory, "tmp"))
+        with open(os.path.join(directory, "download.py"), "w") as fd:
+            fd.write(script)
+        with open(os.path.join(directory, "tmp", PREFIX + "_urls.txt"), "w") as fd:
+            for name in files:
+                fd.write("%s/dataset/bench/resource/%s/download/%s\n" % (site_url, name, name))
+        with open(os.path.join(directory, "tmp", PREFIX + "_md5sum.txt"), "w") as fd:
+            for name, data in files.items():
+                fd.write("%s  %s\n" % (hashlib.md5(data).hexdigest(), name))
+
+        log = os.path.join(directory, "events.ndjson")
+        command = [
+            sys.executable,
+            os.path.join(directory, "download.py"),
+            "--engine", engine,
+            "--jobs", str(jobs),
+            "--chunk-size", chunk_size,
+            "--json-log", log,
+        ]
+        env = dict(os.environ, CKAN_API_TOKEN="bench")
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        # the rusage of this child alone
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = status
+
+        summary, engine_used = {}, None
+        with open(log) as fd:
+            for line in fd:
+                record = json.loads(line)
+                if record["event"] == "session":
+                    engine_used = record.get("engine")
+                elif record["event"] == "summary":
+                    summary = record["counts"]
+    finally:
+        shutil.rmtree(directory)
+
+    total_bytes = sum(len(data) for data in files.values())
+    return {
+        "engine": engine_used or engine,
+        "jobs": jobs,
+        "chunk_size": chunk_size,
+        "files": len(files),
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "files_per_second": len(files) / elapsed,
+        "bytes_per_second": total_bytes / elapsed,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+        # kilobytes on Linux
+        "peak_rss_bytes": rusage.ru_maxrss * 1024,
+        "valid": summary.get("valid", 0),
+    }
+
+
+def report(result):
+    print(
+        "%-8s %5d %5s  %9.3fs  %8.0f files/s  %8.1f MiB/s  cpu %7.3fs  peak %7.1f MiB  %s"
+        % (
+            result["engine"],
+            result["jobs"],
+            result["chunk_size"],
+            result["seconds"],
+            result["files_per_second"],
+            result["bytes_per_second"] / 1048576.0,
+            result["cpu_seconds"],
+            result["peak_rss_bytes"] / 1048576.0,
+            "ok" if result["valid"] == result["files"] else "%d/%d valid" % (result["valid"], result["files"]),
+        )
+    )
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--files", type=int, default=2000, help="number of files (default: 2000)"
+    )
+    parser.add_argument(
+        "--size", type=int, default=16384, help="bytes in each file (default: 16384)"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds the server waits before each response (default: 0.02)",
+    )
+    parser.add_argument(
+        "--engine",
+        nargs="+",
+        default=["threads:4", "threads:32", "async:100", "async:400"],
+        metavar="ENGINE:JOBS",
+        help="engines and concurrency to run (default: threads:4 threads:32 async:100 async:400)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        nargs="+",
+        default=["4M"],
+        help="download.py chunk sizes to run (default: 4M)",
+    )
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    files = synthetic_files(args.files, args.size)
+    server = StandInServer(files, args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    site_url = "http://127.0.0.1:%d" % (server.server_address[1],)
+    script = render_download_py(site_url)
+
+    results = []
+    try:
+        for spec in args.engine:
+            engine, _, jobs = spec.partition(":")
+            for chunk_size in args.chunk_size:
+                result = run(script, files, site_url, engine, int(jobs or 4), chunk_size)
+                report(result)
+                results.append(result)
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump(results, fd, indent=2)
+
+    if any(result["valid"] != result["files"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
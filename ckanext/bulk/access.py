@@ -0,0 +1,52 @@
+import logging
+import ckan.plugins as p
+from ckan.lib.base import abort
+from ckan.logic import get_action
+from .timing import stage
+
+_ = p.toolkit._
+
+
+log = logging.getLogger(__name__)
+
+
+@stage("access")
+def required_organizations(userobj, packages):
+    """
+    the organization the user must be a member of to access each of the
+    packages they may not, by package id and name. This is implemented by an API
+    call to ckanext-initiatives. We only need to check the first resource
+    for any package as our access restriction (presently) is only
+    implemented at package level.
+    """
+    if userobj is None:
+        abort(404, _("Unable to check initiative access without a logged in user"))
+
+    context = {"user": userobj.name}
+
+    required = {}
+    for package in packages:
+        if not package["resources"]:
+            continue
+
+        data_dict = {
+            "package_id": package["id"],
+            "resource_id": package["resources"][0]["id"],
+        }
+
+        log.warn(context)
+        log.warn(data_dict)
+
+        try:
+            access_check = get_action("initiatives_check_access")(context, data_dict)
+        except:
+            abort(404, _("Unable to check initiative access"))
+
+        required_org = access_check.get("result", None)
+
+        if required_org:
+            required[package["id"]] = required_org
+            if package.get("name"):
+                required[package["name"]] = required_org
+
+    return required
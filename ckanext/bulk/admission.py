@@ -0,0 +1,266 @@
+import errno
+import fcntl
+import functools
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, make_response
+import ckan.plugins.toolkit as tk
+from ckan.common import request, c
+from ckan.plugins.toolkit import config
+from .storage import private_directory, user_temp_directory
+from . import metrics
+
+_ = tk._
+
+
+def lock_directory():
+    # the locks are per host; a directory others could create or write to
+    # would let them hold the slots, so it must be private
+    return private_directory(
+        config.get("ckanext.bulk.lock_dir") or user_temp_directory()
+    )
+
+
+def acquire_slot(name, slots):
+    """
+    take one of `slots` file locks called `name`, returning its file
+    descriptor, or None if they are all held. The locks are shared by
+    all worker processes on the host, and released if a worker dies.
+    """
+    directory = lock_directory()
+    for i in range(slots):
+        fd = os.open(
+            os.path.join(directory, "%s-%d.lock" % (name, i)), os.O_CREAT | os.O_RDWR, 0o600
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except (IOError, OSError) as exception:
+            os.close(fd)
+            if exception.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+    return None
+
+
+def release_slot(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+# keys share a fixed number of build locks, so that lock files do not
+# accumulate; a collision only delays an unrelated build
+BUILD_LOCKS = 256
+
+
+@contextmanager
+def build_lock(key, wait):
+    """
+    hold the host-wide lock for building `key` (a hex digest), waiting up
+    to `wait` seconds for another worker process to release it. Yields
+    whether another process held it; if it is still held after `wait`,
+    the caller proceeds without it.
+    """
+    name = "build-%d.lock" % (int(key[:8], 16) % BUILD_LOCKS,)
+    fd = os.open(os.path.join(lock_directory(), name), os.O_CREAT | os.O_RDWR, 0o600)
+    deadline = time.monotonic() + wait
+    waited = False
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as exception:
+                if exception.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            waited = True
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        yield waited
+    finally:
+        # closing the file releases the lock, if it was taken
+        os.close(fd)
+
+
+def requester():
+    if c.userobj is not None:
+        return c.userobj.name
+    return request.remote_addr or ""
+
+
+def too_many_requests(scope):
+    metrics.admission_rejected_total.inc(scope=scope)
+    retry_after = tk.asint(config.get("ckanext.bulk.retry_after", 30))
+    return make_response(
+        (
+            _("Too many bulk downloads are being generated, please retry shortly"),
+            429,
+            {"Retry-After": str(retry_after), "Content-Type": "text/plain"},
+        )
+    )
+
+
+def admit_slots(kind, per_user, total):
+    user_hash = hashlib.sha1(requester().encode("utf-8")).hexdigest()[:16]
+    user_fd = acquire_slot("%suser-%s" % (kind, user_hash), per_user)
+    if user_fd is None:
+        return too_many_requests(kind + "user")
+    g.bulk_slots.append(user_fd)
+
+    global_fd = acquire_slot(kind + "global", total)
+    if global_fd is None:
+        return too_many_requests(kind + "global")
+    g.bulk_slots.append(global_fd)
+    return None
+
+
+def admit():
+    """
+    admit the current request to archive generation, limiting concurrent
+    builds per user and across the host. Returns a 429 response if the
+    request can not be admitted, otherwise None; slots are released when
+    the view returns (see `controlled`).
+    """
+    per_user = tk.asint(config.get("ckanext.bulk.max_concurrent_per_user", 2))
+    total = tk.asint(config.get("ckanext.bulk.max_concurrent", 4))
+    return admit_slots("", per_user, total)
+
+
+def admit_stream():
+    """
+    admit the current request to stream resource contents, limiting
+    concurrent streams per user and across the host separately from
+    archive builds, as streams last as long as the transfer. Slots are
+    held until the response has been sent (see `streamed`).
+    """
+    per_user = tk.asint(config.get("ckanext.bulk.max_streams_per_user", 1))
+    total = tk.asint(config.get("ckanext.bulk.max_streams", 4))
+    return admit_slots("stream-", per_user, total)
+
+
+class SingleFlight(object):
+    """
+    runs a function once for concurrent callers with the same key in this
+    process, all of whom receive the result (or exception) of that one
+    call. Callers in other worker processes are not coalesced (see
+    `build_lock`).
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        """
+        returns the result of `fn`, and whether it was shared with an
+        earlier caller
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as exception:
+            call.error = exception
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+inflight = SingleFlight()
+
+
+def request_key():
+    # identical requests produce identical responses
+    return (
+        requester(),
+        request.path,
+        tuple(sorted(request.params.items())),
+        request.headers.get("If-None-Match", ""),
+    )
+
+
+def copy_response(response):
+    return make_response(
+        (response.get_data(), response.status_code, list(response.headers.items()))
+    )
+
+
+def controlled(view):
+    """
+    decorate a bulk view so that identical in-flight requests (e.g.
+    duplicate clicks) handled by the same worker process share one build,
+    and admission slots taken by the view are released when it returns
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        def run():
+            g.bulk_slots = []
+            try:
+                return view(*args, **kwargs)
+            finally:
+                for fd in g.bulk_slots:
+                    release_slot(fd)
+                g.bulk_slots = []
+
+        response, shared = inflight.do(request_key(), run)
+        metrics.cache_result("inflight", shared)
+        if shared:
+            return copy_response(response)
+        return response
+
+    return wrapper
+
+
+def streamed(view):
+    """
+    decorate a bulk view which streams its response, so that admission
+    slots taken by the view are held until the response has been sent
+    (see `release_on_close`), and otherwise released when it returns
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.bulk_slots = []
+        try:
+            return view(*args, **kwargs)
+        finally:
+            for fd in g.bulk_slots:
+                release_slot(fd)
+            g.bulk_slots = []
+
+    return wrapper
+
+
+def release_on_close(response):
+    # hand the slots taken by the current request over to the response
+    slots, g.bulk_slots = g.bulk_slots, []
+
+    def release():
+        for fd in slots:
+            release_slot(fd)
+
+    response.call_on_close(release)
+    return response
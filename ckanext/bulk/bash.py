@@ -11,12 +11,26 @@ SH_TEMPLATE = """\
 BPA_AGENT="data.bioplatforms.com download.sh/1.3 {{ username }} (Contact help@bioplatforms.com)"
 
 OPTIONAL_DOWNLOAD=false
-OPTSTRING=":ho"
+VERIFY_ONLY=false
+FAST_VERIFY=false
+OPTSTRING=":hoVF"
+
+# long options, as short ones for getopts
+for ARG in "$@"; do
+  shift
+  case "$ARG" in
+    --help) set -- "$@" -h ;;
+    --optional) set -- "$@" -o ;;
+    --verify-only) set -- "$@" -V ;;
+    --fast-verify) set -- "$@" -F ;;
+    *) set -- "$@" "$ARG" ;;
+  esac
+done
 
 while getopts ${OPTSTRING} opt; do
   case ${opt} in
     h)
-      echo "usage: download.sh [-h] [-o]"
+      echo "usage: download.sh [-h] [-o] [-V] [-F]"
       echo
       echo $BPA_AGENT
       echo
@@ -25,6 +39,13 @@ while getopts ${OPTSTRING} opt; do
       echo " optional arguments:"
       echo " -h, --help      show this help message and exit"
       echo " -o, --optional  Download optional files"
+      echo " -V, --verify-only"
+      echo "                 Check the files already downloaded against their"
+      echo "                 checksums, without downloading"
+      echo " -F, --fast-verify"
+      echo "                 As --verify-only, but only hash files whose size and"
+      echo "                 modification time have changed since they were last"
+      echo "                 verified"
       echo
       exit 1
       ;;
@@ -32,6 +53,13 @@ while getopts ${OPTSTRING} opt; do
       echo "Will download optional files"
       OPTIONAL_DOWNLOAD=true
       ;;
+    V)
+      VERIFY_ONLY=true
+      ;;
+    F)
+      VERIFY_ONLY=true
+      FAST_VERIFY=true
+      ;;
     ?)
       echo "Invalid option: -${OPTARG}."
       exit 1
@@ -39,9 +67,9 @@ while getopts ${OPTSTRING} opt; do
   esac
 done
 
-# Check for API tokens or keys
+# Check for API tokens or keys, which verification does not need
 
-if [ x"$CKAN_API_TOKEN" = "x" ]; then
+if [ "$VERIFY_ONLY" = false ] && [ x"$CKAN_API_TOKEN" = "x" ]; then
   if [ x"$CKAN_API_KEY" = "x" ]; then
     echo "Please set the CKAN_API_TOKEN environment variable."
     echo
@@ -103,23 +131,152 @@ fi
 
 # Check for required programs
 
-if ! which curl >/dev/null 2>&1; then
-  echo "`curl` is not installed. Please install it."
+if ! which md5sum >/dev/null 2>&1; then
+  echo "`md5sum` is not installed. Please install it."
   echo
   echo "On MacOS, it can be installed via HomeBrew (https://brew.sh/)"
-  echo "using the command `brew install curl`"
+  echo "using the command `brew install md5sha1sum`"
   exit 1
 fi
 
-if ! which md5sum >/dev/null 2>&1; then
-  echo "`md5sum` is not installed. Please install it."
+function select_checksums()
+{
+  # sets SUMS and SUMTOOL to a checksum list and the tool to check it:
+  # those of the fastest tool installed which has a checksum of every
+  # file in the CHECKSUMS list, otherwise MD5 and md5sum
+  MD5=$1
+  CHECKSUMS=$2
+
+  SUMS=$MD5
+  SUMTOOL=md5sum
+  if [ ! -f "$CHECKSUMS" ]; then
+    return 0
+  fi
+  local CANDIDATE
+  for CANDIDATE in "blake3 b3sum" "xxh128 xxh128sum"; do
+    set -- $CANDIDATE
+    if ! which $2 >/dev/null 2>&1; then
+      continue
+    fi
+    awk -v algorithm=$1 '$1 == algorithm { print substr($0, index($0, " ") + 1) }' "$CHECKSUMS" > tmp/$1sums.txt
+    if [ $(wc -l < tmp/$1sums.txt) -ge $(wc -l < $MD5) ]; then
+      echo "Using $1 checksums ($2)"
+      SUMS=tmp/$1sums.txt
+      SUMTOOL=$2
+      return 0
+    fi
+  done
+}
+
+# Verify files already downloaded, without the network
+
+# files hashed at once
+JOBS=$( (nproc || sysctl -n hw.ncpu) 2>/dev/null || echo 4)
+
+function file_stats()
+{
+  # "size mtime name" of each existing file named (NUL separated) on stdin
+  if stat -c %s . >/dev/null 2>&1; then
+    xargs -0 stat -c '%s %Y %n' 2>/dev/null
+  else
+    xargs -0 stat -f '%z %m %N' 2>/dev/null
+  fi
+}
+
+function verify_data()
+{
+  MD5=$1
+  CHECKSUMS=$2
+  SIZES=$3
+  VERIFIED=$4
+  ANNOTATION=$5
+
+  echo "Verifying files ($ANNOTATION)"
+  if [ ! -f $MD5 ]; then
+    echo "$MD5 not found"
+    return 1
+  fi
+  select_checksums $MD5 $CHECKSUMS
+  [ -f "$SIZES" ] || SIZES=/dev/null
+  [ -f "$VERIFIED" ] || touch "$VERIFIED"
+  rm -f tmp/verify.*
+
+  awk '{ print substr($0, index($0, "  ") + 2) }' $SUMS | tr '\\n' '\\0' | file_stats > tmp/verify.stats
+
+  # files which are missing, or (with --fast-verify) the wrong size or
+  # unchanged since last verified, are not hashed; the rest are shared
+  # out between the jobs
+  awk -v fast="$FAST_VERIFY" -v jobs="$JOBS" '
+    function rest(line, n,  i) {
+      for (i = 0; i < n; i++) line = substr(line, index(line, " ") + 1)
+      return line
+    }
+    FILENAME == ARGV[1] { size[rest($0, 2)] = $1; mtime[rest($0, 2)] = $2; next }
+    FILENAME == ARGV[2] { listed[substr($0, index($0, "  ") + 2)] = $1; next }
+    FILENAME == ARGV[3] { verified[substr($0, index($0, "  ") + 2)] = $1 " " $2 " " $3; next }
+    {
+      name = substr($0, index($0, "  ") + 2)
+      if (!(name in size)) {
+        print name ": FAILED open or read" > "tmp/verify.result"
+        next
+      }
+      record = size[name] " " mtime[name] " " $1
+      if (fast == "true" && (name in listed) && listed[name] != size[name]) {
+        print name ": FAILED size" > "tmp/verify.result"
+        next
+      }
+      print record "  " name > "tmp/verify.records"
+      if (fast == "true" && verified[name] == record) {
+        print name ": OK" > "tmp/verify.result"
+        next
+      }
+      print $0 > ("tmp/verify.job." (n++ % jobs))
+    }' tmp/verify.stats $SIZES "$VERIFIED" $SUMS
+
+  for JOB in tmp/verify.job.*; do
+    if [ -f "$JOB" ]; then
+      $SUMTOOL -c "$JOB" > "$JOB.out" 2>/dev/null &
+    fi
+  done
+  wait
+  cat tmp/verify.result tmp/verify.job.*.out 2>/dev/null | tee -a tmp/md5sum.log > tmp/verify.out
+  cat tmp/verify.out
+
+  # record the files which are valid, as they are now
+  awk '
+    FILENAME == ARGV[1] { if ($0 ~ /: OK$/) ok[substr($0, 1, length($0) - 4)] = 1; next }
+    { if (substr($0, index($0, "  ") + 2) in ok) print }
+  ' tmp/verify.out tmp/verify.records > "$VERIFIED" 2>/dev/null
+
+  FAILURES=$(grep -c ': FAILED' tmp/verify.out)
+  rm -f tmp/verify.*
+  if [ "$FAILURES" -gt 0 ]; then
+    echo "$FAILURES files missing or corrupted, run without --verify-only or --fast-verify to download them"
+    return 1
+  fi
+  echo "All files verified ($ANNOTATION)"
+  return 0
+}
+
+if [ "$VERIFY_ONLY" = true ]; then
+  # Remove old MD5 log file
+  rm -f tmp/md5sum.log
+  STATUS=0
+  verify_data {{ md5sum_fname }} {{ checksums_fname }} {{ sizes_fname }} {{ verified_fname }} main || STATUS=1
+  if [ "$OPTIONAL_DOWNLOAD" = true ] && [ -f {{ md5sum_optional_fname }} ]; then
+    verify_data {{ md5sum_optional_fname }} {{ checksums_optional_fname }} {{ sizes_optional_fname }} {{ verified_optional_fname }} optional || STATUS=1
+  fi
+  exit $STATUS
+fi
+
+if ! which curl >/dev/null 2>&1; then
+  echo "`curl` is not installed. Please install it."
   echo
   echo "On MacOS, it can be installed via HomeBrew (https://brew.sh/)"
-  echo "using the command `brew install md5sha1sum`"
+  echo "using the command `brew install curl`"
   exit 1
 fi
 
-
 CURL=`which curl`
 
 # if on MacOS, favour homebrew curl over system curl
@@ -225,8 +382,10 @@ function file_checks()
 function download_data()
 {
   URLS=$1
-  MD5=$2
-  ANNOTATION=$3
+  PATHS=$2
+  MD5=$3
+  CHECKSUMS=$4
+  ANNOTATION=$5
 
   echo "Checking URLs and MD5s ($ANNOTATION)"
   if ! file_checks $URLS $MD5 ; then
@@ -235,26 +394,39 @@ function download_data()
     exit 99
   fi
 
+  # the path of each file, in the order of the URLs; without a list of
+  # paths, files are named from their URLs
+  [ -f "$PATHS" ] || PATHS=/dev/null
+
   echo "Downloading data ($ANNOTATION)"
 while read URL; do
+  read FILENAME <&3 || FILENAME=""
   echo "Downloading: $URL"
-  if [ x"$CKAN_API_TOKEN" != "x" ]; then
-      $CURL -O -L -C - -A "$BPA_AGENT" -H "Authorization: $CKAN_API_TOKEN" "$URL"
+  if [ x"$FILENAME" = "x" ]; then
+    # the file name, without any query string (e.g. of a signed URL)
+    FILENAME=$(basename "${URL%%\\?*}")
+  fi
+  if [[ "$URL" != "{{ site_url }}/"* ]]; then
+      # not the portal, e.g. a signed object storage URL: send no credentials
+      $CURL -o "$FILENAME" --create-dirs -L -C - -A "$BPA_AGENT" "$URL"
+  elif [ x"$CKAN_API_TOKEN" != "x" ]; then
+      $CURL -o "$FILENAME" --create-dirs -L -C - -A "$BPA_AGENT" -H "Authorization: $CKAN_API_TOKEN" "$URL"
   elif [ x"$CKAN_API_KEY" != "x" ]; then
-      $CURL -O -L -C - -A "$BPA_AGENT" -H "Authorization: $CKAN_API_KEY" "$URL"
+      $CURL -o "$FILENAME" --create-dirs -L -C - -A "$BPA_AGENT" -H "Authorization: $CKAN_API_KEY" "$URL"
   fi  
   if [ $? -ne 0 ] ; then
      echo "Error downloading: $URL"
   fi
-  done < $URLS
+  done < $URLS 3< $PATHS
 
 echo "Data download complete. Verifying checksums:"
-  md5sum -c $MD5 2>&1 | tee -a tmp/md5sum.log
+  select_checksums $MD5 $CHECKSUMS
+  $SUMTOOL -c $SUMS 2>&1 | tee -a tmp/md5sum.log
 }
 
 
-download_data {{ urls_fname }} {{ md5sum_fname }} main
+download_data {{ urls_fname }} {{ paths_fname }} {{ md5sum_fname }} {{ checksums_fname }} main
 if [ "$OPTIONAL_DOWNLOAD" = true ] ; then
-  download_data {{ urls_optional_fname }} {{ md5sum_optional_fname }} optional
+  download_data {{ urls_optional_fname }} {{ paths_optional_fname }} {{ md5sum_optional_fname }} {{ checksums_optional_fname }} optional
 fi
 """
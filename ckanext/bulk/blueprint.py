@@ -1,19 +1,47 @@
 import logging
 import ckan.plugins as p
 import ckan.lib.helpers as h
-import datetime
 import string
 import hashlib
+import json
+import bitmath
 import ckan.plugins.toolkit as tk
-from flask import Blueprint
+from flask import Blueprint, make_response
 from ckan.common import request, c
 from ckan.plugins.toolkit import config
 from ckan import model
 from ckan.lib.base import abort
 from ckan.logic import NotFound, NotAuthorized, get_action, check_access
-from ckan.views.group import _db_to_form_schema, _action, _read, _guess_group_type
-from collections import OrderedDict
-from .zipoutput import generate_bulk_zip
+from ckan.views.group import _db_to_form_schema, _action, _guess_group_type
+from .search import (
+    search_data_dict,
+    ids_filter,
+    index_fingerprint,
+    ids_data_dicts,
+    ids_fingerprint,
+    index_packages,
+    index_packages_by_id,
+    iter_packages,
+    iter_packages_by_id,
+    index_estimate,
+    ids_estimate,
+    parse_since,
+    changed_since,
+    utc_now,
+)
+from .timing import timed, stage, current_timer
+from .admission import admit, admit_stream, controlled, streamed
+from .signing import url_signer, signing_window
+from .access import required_organizations
+from . import metrics
+from .zipoutput import (
+    generate_bulk_zip,
+    shared_members,
+    refresh_members,
+    default_layout,
+    LAYOUTS,
+)
+from .tarstream import generate_bulk_tar, tar_enabled
 
 _ = p.toolkit._
 
@@ -23,8 +51,10 @@ log = logging.getLogger(__name__)
 bulk = Blueprint("bulk", __name__)
 
 
-def timestamp():
-    return datetime.datetime.now().strftime("%Y%m%dT%H%M")
+def timestamp(at):
+    # the UTC time the packages were searched for, to the minute (rounded
+    # down), so that the prefix can be the `since` of the next download
+    return at.strftime("%Y%m%dT%H%MZ")
 
 
 def make_safe(s):
@@ -33,20 +63,20 @@ def make_safe(s):
     )
 
 
-def prefix_from_components(components):
+def prefix_from_components(components, at):
     # note: a hash is generated of the components to avoid long paths
     components = [make_safe(c) for c in components]
     component_hash = hashlib.sha1(("_".join(components)).encode("utf-8")).hexdigest()[
         -8:
     ]
-    return "bpa_{}_{}".format(component_hash, timestamp())
+    return "bpa_{}_{}".format(component_hash, timestamp(at))
 
 
-def dataset_to_zip_prefix(_id):
-    return prefix_from_components([_id])
+def dataset_to_zip_prefix(_id, at):
+    return prefix_from_components([_id], at)
 
 
-def query_to_zip_prefix(request, name=None):
+def query_to_zip_prefix(request, at, name=None):
     def add_param(c, p):
         v = request.params.get(p, "").strip()
         if v:
@@ -58,55 +88,21 @@ def query_to_zip_prefix(request, name=None):
     add_param(components, "q")
     add_param(components, "res-format")
     add_param(components, "tags")
-    return prefix_from_components(components)
+    return prefix_from_components(components, at)
 
 
-def access_required(userobj, packages):
-    # This is implemented by an API call to ckanext-initiatives
-    # We only need to check the first resource for any package
-    # as our access restriction (presently) is only implemented
-    # at package level
-    if userobj is None:
-        abort(404, _("Unable to check initiative access without a logged in user"))
-
+@stage("access")
+def access_required(userobj, required):
+    # the organizations the user must join to access the packages, from
+    # `required_organizations`
     context = {"user": userobj.name}
 
-
     orgs = {}
     orgs_with_extras = []
 
-    def _resources(pkg):
-        for resource in pkg["resources"]:
-            yield resource
-
     # get unique orgs by name
-    for package in packages:
-        check_resource = None
-        access_check = None
-        resources = list(_resources(package))
-
-        if len(resources):
-            check_resource = resources[0]
-        else:
-            continue
-
-        data_dict = {
-            "package_id": package["id"],
-            "resource_id": check_resource["id"],
-        }
-
-        log.warn(context)
-        log.warn(data_dict)
-
-        try:
-            access_check = get_action("initiatives_check_access")(context, data_dict)
-        except:
-            abort(404, _("Unable to check initiative access"))
-
-        required_org = access_check.get("result", None)
-
-        if required_org:
-            orgs[required_org] = required_org
+    for required_org in required.values():
+        orgs[required_org] = required_org
 
     for org in list(orgs.items()):
         name = org[0]
@@ -128,6 +124,7 @@ def access_required(userobj, packages):
     return orgs_with_extras
 
 
+@stage("membership_lookup")
 def memberships(userobj):
     if userobj is not None:
         context = {"user": userobj.name}
@@ -137,9 +134,77 @@ def memberships(userobj):
     return None
 
 
+def bulk_etag(userobj, memberships, fingerprint):
+    # the archive depends upon the query, the packages matched (and their
+    # modification times), the user the scripts are generated for, and when
+    # it holds signed URLs, when they expire
+    components = {
+        "path": request.path,
+        "params": sorted(request.params.items()),
+        "user": userobj.name if userobj is not None else None,
+        "sysadmin": bool(userobj is not None and userobj.sysadmin),
+        "memberships": sorted(org["name"] for org in memberships or []),
+        "packages": fingerprint,
+        "signing_window": signing_window(),
+    }
+    return hashlib.sha1(
+        json.dumps(components, sort_keys=True).encode("utf-8")
+    ).hexdigest()
 
-def organization_file_list(id):
-    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def not_modified(etag):
+    # answer a conditional GET before any archive generation is done
+    hit = request.if_none_match.contains(etag)
+    metrics.cache_result("etag", hit)
+    if hit:
+        return with_etag(make_response(("", 304)), etag)
+    return None
+
+
+def since_param():
+    # the cut-off for a delta download, if one was requested
+    value = request.params.get("since", "").strip()
+    if not value:
+        return None
+    try:
+        return parse_since(value)
+    except ValueError:
+        abort(
+            400,
+            _(
+                "Invalid since: expected a timestamp, or the prefix of an earlier download"
+            ),
+        )
+
+
+def layout_param():
+    # the directory layout of the downloaded files
+    layout = request.params.get("layout", "").strip() or default_layout()
+    if layout not in LAYOUTS:
+        abort(400, _("Invalid layout: expected one of %s") % (", ".join(LAYOUTS),))
+    return layout
+
+
+def page_param():
+    # the page of search results being viewed, as on an organization's page
+    try:
+        page = int(request.params.get("page", 1))
+    except ValueError:
+        page = 0
+    if page < 1:
+        abort(400, _('"page" parameter must be a positive integer'))
+    return page
+
+
+def organization_search(id, limit):
+    # the organization, and the search for its datasets: the page of them
+    # being viewed, in the order viewed, as CKAN's organization page
     group_type = _guess_group_type()
 
     context = {
@@ -165,16 +230,62 @@ def organization_file_list(id):
     except (NotFound, NotAuthorized):
         abort(404, _("Group not found"))
 
-    _read(id, limit, group_type)
+    search_context = {"model": model, "user": c.user, "auth_user_obj": c.userobj}
+    search_dict = search_data_dict(
+        request.params,
+        limit,
+        fq='+owner_org:"%s"' % (c.group_dict["id"],),
+        since=since_param(),
+        sort=request.params.get("sort") or None,
+        start=(page_param() - 1) * limit,
+    )
+    return search_context, search_dict
+
+
+def prebuild_organization(id):
+    """
+    build the user-independent members of the download of an organization
+    (without a query) for the current user, unless they are unchanged
+    since last built. Returns True if they were built.
+    """
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    layout = layout_param()
+    search_context, search_dict = organization_search(id, limit)
+    fingerprint = index_fingerprint(search_context, search_dict)
+    if refresh_members(fingerprint, None, layout):
+        return False
+    shared_members(fingerprint, iter_packages(search_context, search_dict), None, layout)
+    return True
+
+
+@timed("organization")
+@controlled
+def organization_file_list(id):
+    # the cut-off for the next delta download: anything modified after
+    # the search is run will be in that download
+    next_since = utc_now()
+    since = since_param()
+    layout = layout_param()
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    search_context, search_dict = organization_search(id, limit)
+
+    user_memberships = memberships(c.userobj)
+    fingerprint = index_fingerprint(search_context, search_dict)
+    etag = bulk_etag(c.userobj, user_memberships, fingerprint)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    response = admit()
+    if response is not None:
+        return response
 
-    def _resources():
-        for package in c.page.items:
-            for resource in package["resources"]:
-                yield resource
+    # when the organization's packages are unchanged since their members
+    # were last built (e.g. by `ckan bulk prebuild`) no packages are loaded
+    packages = changed_since(iter_packages(search_context, search_dict), since)
+    shared = shared_members(fingerprint, packages, since, layout)
 
     name = c.group_dict["name"]
-    packages = [t for t in c.page.items]
-    resources = list(_resources())
 
     site_url = config.get("ckan.site_url").rstrip("/")
     query = request.params.get("q", "")
@@ -191,55 +302,33 @@ def organization_file_list(id):
         ),
     )
 
-    return generate_bulk_zip(
-        query_to_zip_prefix(request, name),
+    required = required_organizations(c.userobj, shared["access_packages"])
+    response = generate_bulk_zip(
+        query_to_zip_prefix(request, next_since, name),
         "Search of organization: {}".format(name),
         c.userobj,
-        memberships(c.userobj),
-        access_required(c.userobj, packages),
+        user_memberships,
+        access_required(c.userobj, required),
         [c.group_dict],
-        packages,
-        resources,
+        shared,
         query,
         query_url,
         download_url,
+        since,
+        next_since,
+        sign=url_signer(required),
     )
+    return with_etag(response, etag)
 
 
-def package_search_list():
-    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+def site_search(limit):
+    # the search of all datasets
     try:
         context = {"model": model, "user": c.user, "auth_user_obj": c.userobj}
         check_access("site_read", context)
     except NotAuthorized:
         abort(403, _("Not authorized to see this page"))
 
-    # unicode format (decoded from utf8)
-    q = request.params.get("q", "")
-    c.query_error = False
-
-    c.fields = []
-    # c.fields_grouped will contain a dict of params containing
-    # a list of values eg {'tags':['tag1', 'tag2']}
-    c.fields_grouped = {}
-    search_extras = {}
-    fq = ""
-    for (param, value) in list(request.params.items()):
-        if (
-            param not in ["q", "page", "sort"]
-            and len(value)
-            and not param.startswith("_")
-        ):
-            if not param.startswith("ext_"):
-                c.fields.append((param, value))
-                fq += ' %s:"%s"' % (param, value)
-                if param not in c.fields_grouped:
-                    c.fields_grouped[param] = [value]
-                else:
-                    c.fields_grouped[param].append(value)
-            else:
-                search_extras[param] = value
-
     context = {
         "model": model,
         "session": model.Session,
@@ -249,41 +338,41 @@ def package_search_list():
         "extras_as_string": True,
     }
 
-    facets = OrderedDict()
+    return context, search_data_dict(request.params, limit, since=since_param())
 
-    data_dict = {
-        "q": q,
-        "fq": fq.strip(),
-        "facet.field": list(facets.keys()),
-        "rows": limit,
-        "extras": search_extras,
-        "include_private": p.toolkit.asbool(
-            config.get("ckan.search.default_include_private", True)
-        ),
-    }
 
-    query = get_action("package_search")(context, data_dict)
-    results = query["results"]
+@timed("search")
+@controlled
+def package_search_list():
+    next_since = utc_now()
+    since = since_param()
+    layout = layout_param()
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    context, data_dict = site_search(limit)
+    q = request.params.get("q", "")
+
+    user_memberships = memberships(c.userobj)
+    fingerprint = index_fingerprint(context, data_dict)
+    etag = bulk_etag(c.userobj, user_memberships, fingerprint)
+    response = not_modified(etag)
+    if response is not None:
+        return response
 
-    def _resources():
-        for package in results:
-            for resource in package["resources"]:
-                yield resource
+    response = admit()
+    if response is not None:
+        return response
 
-    packages = [t for t in results]
-    resources = list(_resources())
+    # the packages are loaded a page at a time as the members are built
+    packages = changed_since(iter_packages(context, data_dict), since)
+    shared = shared_members(fingerprint, packages, since, layout)
 
+    @stage("organizations")
     def _organizations():
-        orgs = {}
         orgs_with_extras = []
 
-        # get unique orgs by name
-        for package in results:
-            orgs[package["organization"]["name"]] = package["organization"]["id"]
-
-        for org in list(orgs.items()):
-            name = org[0]
-            org_dict = {"id": org[1]}
+        # the unique orgs of the packages
+        for org_id in shared["organization_ids"]:
+            org_dict = {"id": org_id}
 
             try:
                 # Do not query for the group datasets when dictizing, as they will
@@ -312,24 +401,27 @@ def package_search_list():
         ),
     )
 
-    return generate_bulk_zip(
-        query_to_zip_prefix(request),
+    required = required_organizations(c.userobj, shared["access_packages"])
+    response = generate_bulk_zip(
+        query_to_zip_prefix(request, next_since),
         "Search of all datasets",
         c.userobj,
-        memberships(c.userobj),
-        access_required(c.userobj, packages),
+        user_memberships,
+        access_required(c.userobj, required),
         organizations,
-        packages,
-        resources,
+        shared,
         q,
         query_url,
         download_url,
+        since,
+        next_since,
+        sign=url_signer(required),
     )
+    return with_etag(response, etag)
 
 
-def package_file_list(id):
-    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
-
+def dataset_search(id):
+    # the search for a single dataset, by id or name
     context = {
         "model": model,
         "session": model.Session,
@@ -337,15 +429,40 @@ def package_file_list(id):
         "for_view": True,
         "auth_user_obj": c.userobj,
     }
-    data_dict = {"id": id, "include_tracking": True}
+    return context, search_data_dict(
+        {}, 1, fq=ids_filter([id]), since=since_param()
+    )
+
+
+@timed("dataset")
+@controlled
+def package_file_list(id):
+    next_since = utc_now()
+    since = since_param()
+    layout = layout_param()
+    context, data_dict = dataset_search(id)
+
+    user_memberships = memberships(c.userobj)
+    fingerprint = index_fingerprint(context, data_dict)
+    etag = bulk_etag(c.userobj, user_memberships, fingerprint)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    response = admit()
+    if response is not None:
+        return response
 
     # check if package exists
     try:
-        pkg_dict = get_action("package_show")(context, data_dict)
+        pkg_dict = index_packages_by_id(context, [id])[0]
     except (NotFound, NotAuthorized):
         abort(404, _("Dataset not found"))
 
     name = pkg_dict["name"]
+    shared = shared_members(
+        fingerprint, changed_since([pkg_dict], since), since, layout
+    )
 
     site_url = config.get("ckan.site_url").rstrip("/")
     query = "id:%s" % (name,)
@@ -357,27 +474,34 @@ def package_file_list(id):
         # Do not query for the group datasets when dictizing, as they will
         # be ignored and get requested on the controller anyway
         org_dict["include_datasets"] = False
-        found_org_dict = get_action("organization_show")(context, org_dict)
+        with current_timer().stage("organizations"):
+            found_org_dict = get_action("organization_show")(context, org_dict)
     except (NotFound, NotAuthorized):
         abort(404, _("Organization not found"))
 
-    return generate_bulk_zip(
-        dataset_to_zip_prefix(id),
+    required = required_organizations(c.userobj, shared["access_packages"])
+    response = generate_bulk_zip(
+        dataset_to_zip_prefix(id, next_since),
         "Dataset: %s" % (name,),
         c.userobj,
-        memberships(c.userobj),
-        access_required(c.userobj, [pkg_dict]),
+        user_memberships,
+        access_required(c.userobj, required),
         [found_org_dict],
-        [pkg_dict],
-        pkg_dict["resources"],
+        shared,
         query,
         query_url,
         download_url,
+        since,
+        next_since,
+        sign=url_signer(required),
     )
+    return with_etag(response, etag)
 
 
-def cart_file_list(target_user):
-    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+def cart_search(target_user):
+    # the user whose cart is being downloaded, the packages in the cart,
+    # a context to look them up with, and data dicts to search for them
+    # with, a batch at a time
     site_user = tk.get_action("get_site_user")({"ignore_auth": True}, {})["name"]
     admin_ctx = {"ignore_auth": True, "user": site_user}
     # Only allow impersonation if an admin
@@ -415,34 +539,48 @@ def cart_file_list(target_user):
         "for_view": True,
         "auth_user_obj": site_user,
     }
-    package_q = {"id": "", "include_tracking": True}
-    packages = []
+    data_dicts = ids_data_dicts(list(cart), since=since_param())
+    return username, cart, context, data_dicts
+
+
+@timed("cart")
+@controlled
+def cart_file_list(target_user):
+    next_since = utc_now()
+    since = since_param()
+    layout = layout_param()
+    username, cart, context, data_dicts = cart_search(target_user)
+
+    user_memberships = memberships(c.userobj)
+    fingerprint = ids_fingerprint(context, data_dicts)
+    etag = bulk_etag(c.userobj, user_memberships, fingerprint)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    response = admit()
+    if response is not None:
+        return response
+
+    # check the packages exist, loading them a page at a time as the
+    # members are built
+    try:
+        packages = changed_since(
+            iter_packages_by_id(context, list(cart), since), since
+        )
+        shared = shared_members(fingerprint, packages, since, layout)
+    except (NotFound, NotAuthorized):
+        abort(404, _("Dataset not found"))
+
     orgs = []
-    resources = []
-    org_dict = {}
-    for package_id, package_details in cart.items():
-        # note the package details are sometimes missing, so we use the org from the package.
-        # check if package exists and retrieve the resources
-        package_q["id"] = package_id
+    # note the package details are sometimes missing, so we use the org from the package.
+    for org_id in shared["organization_ids"]:
+        org_q = {"id": org_id, "include_datasets": False}
         try:
-            pkg_dict = get_action("package_show")(context, package_q)
+            with current_timer().stage("organizations"):
+                orgs.append(get_action("organization_show")(context, org_q))
         except (NotFound, NotAuthorized):
-            abort(404, _("Dataset not found"))
-        package_resources = pkg_dict["resources"]
-        # check if the org is already added
-        pkg_org = pkg_dict["organization"]
-        org_id = pkg_org["id"]
-        if org_id not in org_dict:
-            org_q = {"id": org_id, "include_datasets": False}
-            try:
-                org_new = get_action("organization_show")(context, org_q)
-                org_dict[org_id] = org_new
-                orgs.append(org_new)
-            except (NotFound, NotAuthorized):
-                abort(404, _("Organization not found"))
-
-        packages.append(pkg_dict)
-        resources = resources + package_resources
+            abort(404, _("Organization not found"))
 
     site_url = config.get("ckan.site_url").rstrip("/")
     query = None
@@ -450,18 +588,160 @@ def cart_file_list(target_user):
     query_url = f"{site_url}/cart/{username}"
     download_url = request.url
 
-    return generate_bulk_zip(
-        prefix_from_components([username]),
+    required = required_organizations(c.userobj, shared["access_packages"])
+    response = generate_bulk_zip(
+        prefix_from_components([username], next_since),
         "Cart: %s" % (username,),
         c.userobj,
-        memberships(c.userobj),
-        access_required(c.userobj, packages),
+        user_memberships,
+        access_required(c.userobj, required),
         orgs,
-        packages,
-        resources,
+        shared,
         query,
         query_url,
         download_url,
+        since,
+        next_since,
+        sign=url_signer(required),
+    )
+    return with_etag(response, etag)
+
+
+def check_tar_enabled():
+    # streaming resource contents is opt-in
+    if not tar_enabled():
+        abort(404, _("Tar downloads are not enabled"))
+
+
+def tar_response(prefix, packages, layout):
+    response = admit_stream()
+    if response is not None:
+        return response
+    optional = tk.asbool(request.params.get("optional", False))
+    return generate_bulk_tar(prefix, packages, layout, optional)
+
+
+@timed("organization_tar")
+@streamed
+def organization_tar(id):
+    check_tar_enabled()
+    searched_at = utc_now()
+    since = since_param()
+    layout = layout_param()
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    search_context, search_dict = organization_search(id, limit)
+    packages = changed_since(index_packages(search_context, search_dict), since)
+    return tar_response(
+        query_to_zip_prefix(request, searched_at, c.group_dict["name"]),
+        packages,
+        layout,
+    )
+
+
+@timed("search_tar")
+@streamed
+def package_search_tar():
+    check_tar_enabled()
+    searched_at = utc_now()
+    since = since_param()
+    layout = layout_param()
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    context, data_dict = site_search(limit)
+    packages = changed_since(index_packages(context, data_dict), since)
+    return tar_response(query_to_zip_prefix(request, searched_at), packages, layout)
+
+
+@timed("dataset_tar")
+@streamed
+def package_tar(id):
+    check_tar_enabled()
+    searched_at = utc_now()
+    since = since_param()
+    layout = layout_param()
+    context = dataset_search(id)[0]
+    try:
+        pkg_dict = index_packages_by_id(context, [id])[0]
+    except (NotFound, NotAuthorized):
+        abort(404, _("Dataset not found"))
+    packages = changed_since([pkg_dict], since)
+    return tar_response(dataset_to_zip_prefix(id, searched_at), packages, layout)
+
+
+@timed("cart_tar")
+@streamed
+def cart_tar(target_user):
+    check_tar_enabled()
+    searched_at = utc_now()
+    since = since_param()
+    layout = layout_param()
+    username, cart, context, data_dicts = cart_search(target_user)
+    try:
+        packages = changed_since(
+            index_packages_by_id(context, list(cart), since), since
+        )
+    except (NotFound, NotAuthorized):
+        abort(404, _("Dataset not found"))
+    # the cart is looked up as the site user: access is checked per resource
+    # as the requesting user
+    return tar_response(
+        prefix_from_components([username], searched_at), packages, layout
+    )
+
+
+def estimate_response(estimate):
+    # a cheap pre-flight estimate of the size of an archive's downloads,
+    # used by the download popover to warn before large requests
+    warn_resources = p.toolkit.asint(config.get("ckanext.bulk.warn_resources", 10000))
+    warn_bytes = p.toolkit.asint(
+        config.get("ckanext.bulk.warn_bytes", 1024 * 1024 * 1024 * 1024)
+    )
+    estimate["size_human"] = (
+        bitmath.Byte(bytes=estimate["size"]).best_prefix().format("{value:.2f} {unit}")
+    )
+    estimate["truncated"] = estimate["count"] > estimate["packages"]
+    estimate["warn"] = (
+        estimate["resources"] > warn_resources or estimate["size"] > warn_bytes
+    )
+    return make_response(
+        (json.dumps(estimate), 200, {"Content-Type": "application/json"})
+    )
+
+
+@timed("organization_estimate")
+def organization_estimate(id):
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    return estimate_response(index_estimate(*organization_search(id, limit)))
+
+
+@timed("search_estimate")
+def package_search_estimate():
+    limit = p.toolkit.asint(config.get("ckanext.bulk.limit", 100))
+    return estimate_response(index_estimate(*site_search(limit)))
+
+
+@timed("dataset_estimate")
+def package_estimate(id):
+    return estimate_response(index_estimate(*dataset_search(id)))
+
+
+@timed("cart_estimate")
+def cart_estimate(target_user):
+    username, cart, context, data_dicts = cart_search(target_user)
+    return estimate_response(ids_estimate(context, data_dicts))
+
+
+def metrics_exposition():
+    # metrics are restricted to sysadmins (e.g. a scraper using an API
+    # token) unless configured to be public
+    if not p.toolkit.asbool(config.get("ckanext.bulk.metrics_public", False)):
+        if c.userobj is None or c.userobj.sysadmin is not True:
+            abort(403, _("Not authorized to see this page"))
+    return make_response(
+        (
+            metrics.render(),
+            200,
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
     )
 
 
@@ -484,3 +764,25 @@ bulk.add_url_rule(
     view_func=cart_file_list,
     methods=["GET", "POST"],
 )
+
+bulk.add_url_rule(
+    "/bulk/organization/<id>/tar", view_func=organization_tar, methods=["GET"]
+)
+bulk.add_url_rule("/bulk/dataset/<id>/tar", view_func=package_tar, methods=["GET"])
+bulk.add_url_rule("/bulk/dataset/tar", view_func=package_search_tar, methods=["GET"])
+bulk.add_url_rule("/bulk/cart/<target_user>/tar", view_func=cart_tar, methods=["GET"])
+
+bulk.add_url_rule("/bulk/metrics", view_func=metrics_exposition, methods=["GET"])
+
+bulk.add_url_rule(
+    "/bulk/organization/<id>/estimate", view_func=organization_estimate, methods=["GET"]
+)
+bulk.add_url_rule(
+    "/bulk/dataset/<id>/estimate", view_func=package_estimate, methods=["GET"]
+)
+bulk.add_url_rule(
+    "/bulk/dataset/estimate", view_func=package_search_estimate, methods=["GET"]
+)
+bulk.add_url_rule(
+    "/bulk/cart/<target_user>/estimate", view_func=cart_estimate, methods=["GET"]
+)
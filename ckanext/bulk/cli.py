@@ -0,0 +1,64 @@
+import click
+from flask import g
+from werkzeug.exceptions import HTTPException
+from ckan import model
+from ckan.logic import get_action
+from ckanext.bulk.blueprint import prebuild_organization
+
+
+def get_commands():
+    return [bulk]
+
+
+@click.group()
+def bulk():
+    """Bulk download commands."""
+    pass
+
+
+@bulk.command()
+@click.argument("organizations", nargs=-1)
+@click.option(
+    "--user",
+    default="",
+    help=(
+        "build the downloads as seen by this user (default: anonymous); "
+        "required for organizations with private datasets"
+    ),
+)
+@click.pass_context
+def prebuild(ctx, organizations, user):
+    """
+    Prebuild the user-independent parts of organization downloads (all
+    organizations, unless some are named). Organizations whose datasets are
+    unchanged since their last build are only refreshed, so this can be run
+    regularly, e.g. from cron.
+
+    The members built are those of the datasets the user sees, and only serve
+    users whose downloads match the same datasets. Anonymously, that is the
+    public datasets, so for an organization with private datasets give
+    --user, a member of the organization (whose downloads, like those of its
+    other members and sysadmins, include them).
+    """
+    flask_app = ctx.meta["flask_app"]
+    userobj = model.User.get(user) if user else None
+    if user and userobj is None:
+        raise click.BadParameter("no such user: %s" % (user,), param_hint="--user")
+
+    if not organizations:
+        organizations = get_action("organization_list")(
+            {"user": user}, {"all_fields": False}
+        )
+
+    for name in organizations:
+        # the organization download view is emulated, so that the members
+        # built are exactly those the view will look for
+        with flask_app.test_request_context("/bulk/organization/%s/file_list" % (name,)):
+            g.user = user
+            g.userobj = userobj
+            try:
+                built = prebuild_organization(name)
+            except HTTPException as exception:
+                click.secho("%s: %s" % (name, exception), fg="red")
+                continue
+        click.echo("%s: %s" % (name, "built" if built else "unchanged"))
@@ -0,0 +1,220 @@
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+from collections import namedtuple
+from zipfile import ZipInfo, ZIP_DEFLATED, ZIP64_LIMIT
+import ckan.plugins.toolkit as tk
+from ckan.plugins.toolkit import config
+from .storage import private_directory, storage_directory
+
+
+log = logging.getLogger(__name__)
+
+# an archive member, already deflated, which can be written into a zip
+# file without recompression
+CompressedMember = namedtuple(
+    "CompressedMember", ["name", "crc", "file_size", "compress_size", "data"]
+)
+
+
+# bytes of a file member compressed at a time
+CHUNK_SIZE = 1024 * 1024
+
+# the ZipFile internals which write_compressed relies upon, which are
+# those of CPython 3.6 to 3.13
+ZIPFILE_INTERNALS = (
+    "_lock",
+    "_seekable",
+    "_writecheck",
+    "_didModify",
+    "fp",
+    "start_dir",
+    "filelist",
+    "NameToInfo",
+)
+SPLICE_VERSIONS = ((3, 6), (3, 13))
+
+
+def compress_member(name, data):
+    """
+    compress a member's data: a string, bytes, or a binary file (e.g. a
+    spooled CSV), which is read a chunk at a time
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if isinstance(data, bytes):
+        chunks = [data]
+    else:
+        chunks = iter(functools.partial(data.read, CHUNK_SIZE), b"")
+    # raw deflate stream, as stored in zip files
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    compressed = []
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        compressed.append(compressor.compress(chunk))
+    compressed.append(compressor.flush())
+    compressed = b"".join(compressed)
+    return CompressedMember(name, crc & 0xFFFFFFFF, size, len(compressed), compressed)
+
+
+def decompress_member(member):
+    return zlib.decompress(member.data, -15)
+
+
+def can_splice(zf):
+    # whether this Python's ZipFile is one write_compressed knows
+    return (
+        SPLICE_VERSIONS[0] <= sys.version_info[:2] <= SPLICE_VERSIONS[1]
+        and hasattr(ZipInfo, "FileHeader")
+        and all(hasattr(zf, attr) for attr in ZIPFILE_INTERNALS)
+        and not getattr(zf, "_writing", False)
+    )
+
+
+def write_compressed(zf, arcname, member):
+    """
+    splice a precompressed member into a zip file opened for writing.
+    Other versions of Python, whose ZipFile may differ, recompress it.
+    """
+    zinfo = ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    if not can_splice(zf):
+        zf.writestr(zinfo, decompress_member(member))
+        return
+    zinfo.file_size = member.file_size
+    zinfo.compress_size = member.compress_size
+    zinfo.CRC = member.crc
+    zip64 = member.file_size > ZIP64_LIMIT or member.compress_size > ZIP64_LIMIT
+
+    # this mirrors ZipFile.writestr, minus the compression
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zip64))
+        zf.fp.write(member.data)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+
+
+def cache_directory():
+    """
+    the directory the cache is stored in, `ckanext.bulk.cache_dir` or
+    under `ckan.storage_path`, or None if neither is configured, in which
+    case nothing is cached. Raises OSError if it is not private.
+    """
+    directory = config.get("ckanext.bulk.cache_dir") or storage_directory("members")
+    if not directory:
+        return None
+    return private_directory(directory)
+
+
+def cache_enabled():
+    try:
+        return cache_directory() is not None
+    except OSError:
+        return False
+
+
+def cache_ttl():
+    return tk.asint(config.get("ckanext.bulk.cache_ttl", 7 * 24 * 60 * 60))
+
+
+def cache_path(key):
+    directory = cache_directory()
+    if directory is None:
+        return None
+    return os.path.join(directory, "%s.members" % (key,))
+
+
+def write_entry(fd, value):
+    """
+    write cached members: a line of JSON, with the compressed members'
+    names and sizes in place of the members, then their data
+    """
+    index = dict(value, members=[list(member[:4]) for member in value["members"]])
+    fd.write(json.dumps(index).encode("utf-8") + b"\n")
+    for member in value["members"]:
+        fd.write(member.data)
+
+
+def read_entry(fd):
+    value = json.loads(fd.readline().decode("utf-8"))
+    members = []
+    for name, crc, file_size, compress_size in value["members"]:
+        data = fd.read(compress_size)
+        if len(data) != compress_size:
+            raise ValueError("truncated cache entry")
+        members.append(CompressedMember(name, crc, file_size, compress_size, data))
+    value["members"] = members
+    return value
+
+
+def cache_get(key):
+    """
+    the cached value for `key`, or None if it is missing or expired
+    """
+    try:
+        path = cache_path(key)
+        if path is None:
+            return None
+        if time.time() - os.stat(path).st_mtime > cache_ttl():
+            return None
+        with open(path, "rb") as fd:
+            return read_entry(fd)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def cache_touch(key):
+    """
+    reset the age of a cached value, returning False if it is missing
+    """
+    try:
+        path = cache_path(key)
+        if path is None:
+            return False
+        os.utime(path, None)
+        return True
+    except OSError:
+        return False
+
+
+def cache_put(key, value):
+    # a failure to cache is logged, but does not fail the download
+    try:
+        path = cache_path(key)
+        if path is None:
+            return
+        # write then rename, so readers in other workers never see a partial file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as fd:
+            write_entry(fd, value)
+        os.replace(tmp, path)
+        prune()
+    except (IOError, OSError) as exception:
+        log.warning("Unable to cache bulk archive members: %s", exception)
+
+
+def prune():
+    # remove expired entries
+    directory = cache_directory()
+    expired = time.time() - cache_ttl()
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            if os.stat(path).st_mtime < expired:
+                os.remove(path)
+        except OSError:
+            pass
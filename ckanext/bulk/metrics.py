@@ -0,0 +1,162 @@
+import threading
+from collections import OrderedDict
+
+# metrics are held in memory, and so are per web worker process
+
+DURATION_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+BYTES_BUCKETS = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9]
+COUNT_BUCKETS = [1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+def format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return "%d" % (v,)
+    return repr(float(v))
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (
+            k,
+            str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for k, v in pairs
+    )
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[k] for k in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            for key, value in self.values.items():
+                yield self.name, format_labels(self.labelnames, key), value
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = list(buckets) + [float("inf")]
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[k] for k in self.labelnames)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    yield (
+                        self.name + "_bucket",
+                        format_labels(
+                            self.labelnames, key, [("le", format_value(bound))]
+                        ),
+                        count,
+                    )
+                yield self.name + "_sum", format_labels(self.labelnames, key), total
+                yield self.name + "_count", format_labels(
+                    self.labelnames, key
+                ), counts[-1]
+
+
+requests_total = Counter(
+    "bulk_requests_total", "Bulk download requests.", ["route", "status"]
+)
+request_duration = Histogram(
+    "bulk_request_duration_seconds", "Bulk download request latency.", ["route"]
+)
+stage_duration = Histogram(
+    "bulk_stage_duration_seconds",
+    "Time spent in each stage of bulk archive generation.",
+    ["stage"],
+)
+archive_bytes = Histogram(
+    "bulk_archive_bytes", "Size of generated bulk archives.", ["route"], BYTES_BUCKETS
+)
+archive_packages = Histogram(
+    "bulk_archive_packages",
+    "Number of packages in generated bulk archives.",
+    ["route"],
+    COUNT_BUCKETS,
+)
+archive_resources = Histogram(
+    "bulk_archive_resources",
+    "Number of resources in generated bulk archives.",
+    ["route"],
+    COUNT_BUCKETS,
+)
+cache_requests_total = Counter(
+    "bulk_cache_requests_total", "Bulk cache lookups.", ["cache", "result"]
+)
+admission_rejected_total = Counter(
+    "bulk_admission_rejected_total",
+    "Bulk requests rejected as too many builds were in progress.",
+    ["scope"],
+)
+stream_bytes_total = Counter(
+    "bulk_stream_bytes_total", "Resource bytes streamed in bulk tar archives."
+)
+stream_files_total = Counter(
+    "bulk_stream_files_total",
+    "Resources in bulk tar archives, streamed or skipped.",
+    ["result"],
+)
+
+REGISTRY = [
+    requests_total,
+    request_duration,
+    stage_duration,
+    archive_bytes,
+    archive_packages,
+    archive_resources,
+    cache_requests_total,
+    admission_rejected_total,
+    stream_bytes_total,
+    stream_files_total,
+]
+
+
+def cache_result(cache, hit):
+    cache_requests_total.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def render():
+    """
+    all metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append("%s%s %s" % (name, labels, format_value(value)))
+    return "\n".join(lines) + "\n"
@@ -1,15 +1,37 @@
+import json
 import logging
-from ckan.plugins import toolkit, IConfigurer, IBlueprint, SingletonPlugin, implements
+from ckan.plugins import (
+    toolkit,
+    IConfigurer,
+    IBlueprint,
+    IClick,
+    IPackageController,
+    SingletonPlugin,
+    implements,
+)
 
-from ckanext.bulk import blueprint
+from ckanext.bulk import blueprint, cli
+from ckanext.bulk.search import SIZE_FIELD
 
 
 log = logging.getLogger(__name__)
 
 
+def resources_size(resources):
+    total = 0
+    for resource in resources:
+        try:
+            total += int(resource.get("size") or 0)
+        except (TypeError, ValueError):
+            pass
+    return total
+
+
 class BulkPlugin(SingletonPlugin):
     implements(IConfigurer)
     implements(IBlueprint)
+    implements(IClick)
+    implements(IPackageController, inherit=True)
 
     # IConfigurer
     def update_config(self, config):
@@ -19,3 +41,19 @@ class BulkPlugin(SingletonPlugin):
     # IBlueprint
     def get_blueprint(self):
         return blueprint.bulk
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
+
+    # IPackageController
+    def before_dataset_index(self, pkg_dict):
+        # index the total size of each package's resources, so that the
+        # size of a bulk download can be estimated from the search index
+        data_dict = json.loads(pkg_dict.get("validated_data_dict") or "{}")
+        pkg_dict[SIZE_FIELD] = resources_size(data_dict.get("resources", []))
+        return pkg_dict
+
+    # CKAN < 2.10
+    def before_index(self, pkg_dict):
+        return self.before_dataset_index(pkg_dict)
@@ -1,13 +1,21 @@
 POWERSHELL_TEMPLATE = """\
 #!/usr/bin/env pwsh
 
-{% if user_page %}
 param(
     [Parameter(HelpMessage="Download optional files")]
     [Alias("o")]
-    [switch]$Optional = $False
+    [switch]$Optional = $False,
+
+    [Parameter(HelpMessage="Check the files already downloaded against their checksums, without downloading")]
+    [switch]$VerifyOnly = $False,
+
+    [Parameter(HelpMessage="As -VerifyOnly, but only hash files whose size and modification time have changed since they were last verified")]
+    [switch]$FastVerify = $False
 )
 
+$verify = $VerifyOnly -or $FastVerify
+
+{% if user_page %}
 $user_agent = "data.bioplatforms.com download.ps1/0.5 {{ username }} (Contact help@bioplatforms.com)"
 
 $apikey = $Env:CKAN_API_KEY
@@ -23,7 +31,8 @@ if ($apikey -and !$apitoken) {
   ''
 }
 
-if (!$apitoken) {
+# verification does not need a token
+if (!$apitoken -and !$verify) {
   'Please set the CKAN_API_TOKEN environment variable.'
   ''
   'You can create your API Token by browsing to:'
@@ -45,9 +54,13 @@ $apitoken = $null;
 # This PowerShell script was automatically generated.
 #
 
-function DownloadURL($url)
+function DownloadURL($url, $filename_only)
 {
-    $filename_only = $url.Substring($url.lastIndexOf('/') + 1)
+    if (!$filename_only) {
+        # the file name, without any query string (e.g. of a signed URL)
+        $path = ([System.Uri]$url).AbsolutePath
+        $filename_only = $path.Substring($path.lastIndexOf('/') + 1)
+    }
     $filename = ($PSScriptRoot + '/' + $filename_only)
 
     if (Test-Path $filename) {
@@ -56,7 +69,9 @@ function DownloadURL($url)
     }
     $client = new-object System.Net.WebClient
     $client.Headers.add("user-agent", $user_agent)
-    if ($apitoken) {
+    if (!$url.StartsWith("{{ site_url }}/")) {
+        # not the portal, e.g. a signed object storage URL: send no credentials
+    } elseif ($apitoken) {
         $client.Headers.Add('Authorization: ' + $apitoken)
     } else {
         if ($apikey) {
@@ -65,16 +80,90 @@ function DownloadURL($url)
     }   
     
     "Downloading: " + $filename_only
+    [void](New-Item -ItemType Directory -Force -Path (Split-Path -Parent $filename))
     $client.DownloadFile($url, $filename)
 }
 
-function VerifyMD5([String]$filename, [String]$expected_md5)
+# checksum algorithms supported here; of those listed for every file, the
+# fastest (as measured) is used
+$hash_algorithms = @('md5', 'sha1', 'sha256', 'sha512')
+
+function NewHash([String]$algorithm)
+{
+    switch ($algorithm) {
+        'sha1' { return [System.Security.Cryptography.SHA1]::Create() }
+        'sha256' { return [System.Security.Cryptography.SHA256]::Create() }
+        'sha512' { return [System.Security.Cryptography.SHA512]::Create() }
+        default { return [System.Security.Cryptography.MD5]::Create() }
+    }
+}
+
+function ReadChecksums([String]$md5file, [String]$checksumsfile)
 {
-    $md5hash = new-object -TypeName System.Security.Cryptography.MD5CryptoServiceProvider
+    # the Name and Checksum of each file in the manifest, using the fastest
+    # algorithm here with a checksum of every file in the checksums list
+    # ("algorithm checksum  filename" lines), or MD5
+    $files = New-Object System.Collections.Generic.List[object]
+    ForEach ($line in Get-Content ($PSScriptRoot + '/' + $md5file)) {
+        $i = $line.IndexOf('  ')
+        if ($i -gt 0) {
+            $files.Add([PSCustomObject]@{ Name = $line.Substring($i + 2); Checksum = $line.Substring(0, $i) })
+        }
+    }
+
+    $by_algorithm = @{}
+    if (Test-Path ($PSScriptRoot + '/' + $checksumsfile)) {
+        ForEach ($line in Get-Content ($PSScriptRoot + '/' + $checksumsfile)) {
+            $i = $line.IndexOf('  ')
+            $j = $line.IndexOf(' ')
+            if ($j -le 0 -or $i -le $j) {
+                continue
+            }
+            $algorithm = $line.Substring(0, $j)
+            if (!$by_algorithm.ContainsKey($algorithm)) {
+                $by_algorithm[$algorithm] = @{}
+            }
+            $by_algorithm[$algorithm][$line.Substring($i + 2)] = $line.Substring($j + 1, $i - $j - 1)
+        }
+    }
+
+    $script:algorithm = 'md5'
+    $fastest = [double]::MaxValue
+    $data = New-Object byte[] (8MB)
+    ForEach ($algorithm in $hash_algorithms) {
+        if ($algorithm -ne 'md5') {
+            if (!$by_algorithm.ContainsKey($algorithm)) {
+                continue
+            }
+            $missing = @($files | Where-Object { !$by_algorithm[$algorithm].ContainsKey($_.Name) })
+            if ($missing.Count -gt 0) {
+                continue
+            }
+        }
+        $hash = NewHash $algorithm
+        $watch = [System.Diagnostics.Stopwatch]::StartNew()
+        [void]$hash.ComputeHash($data)
+        if ($watch.Elapsed.TotalSeconds -lt $fastest) {
+            $fastest = $watch.Elapsed.TotalSeconds
+            $script:algorithm = $algorithm
+        }
+    }
+    if ($script:algorithm -ne 'md5') {
+        Write-Host ('Using ' + $script:algorithm + ' checksums')
+        ForEach ($file in $files) {
+            $file.Checksum = $by_algorithm[$script:algorithm][$file.Name]
+        }
+    }
+    return $files
+}
+
+function VerifyChecksum([String]$filename, [String]$expected)
+{
+    $hash = NewHash $script:algorithm
     try {
         $file = [System.IO.File]::Open($filename,[System.IO.Filemode]::Open, [System.IO.FileAccess]::Read)
         try {
-            $actual_md5 = [System.BitConverter]::ToString($md5hash.ComputeHash($file)).Replace('-', '').toLower()
+            $actual = [System.BitConverter]::ToString($hash.ComputeHash($file)).Replace('-', '').toLower()
         } finally {
             $file.Dispose()
         }
@@ -82,13 +171,143 @@ function VerifyMD5([String]$filename, [String]$expected_md5)
         $filename + ": FAILED open or read"
         return
     }
-    if ($actual_md5 -eq $expected_md5) {
+    if ($actual -eq $expected) {
         $filename + ": OK"
     } else {
         $filename + ": FAILED"
     }
 }
 
+function HashFiles($files)
+{
+    # the MD5 of each file, as its Actual property, hashing as many files
+    # at once as there are processors in a pool of runspaces. At most twice
+    # that many are queued at a time (WaitAny takes at most 64 handles), the
+    # next started as each completes, so that memory does not grow with the
+    # number of files
+    $hashScript = {
+        param($path, $algorithm)
+        switch ($algorithm) {
+            'sha1' { $hash = [System.Security.Cryptography.SHA1]::Create() }
+            'sha256' { $hash = [System.Security.Cryptography.SHA256]::Create() }
+            'sha512' { $hash = [System.Security.Cryptography.SHA512]::Create() }
+            default { $hash = [System.Security.Cryptography.MD5]::Create() }
+        }
+        $stream = New-Object System.IO.FileStream($path, [System.IO.FileMode]::Open, [System.IO.FileAccess]::Read, [System.IO.FileShare]::Read, 4MB)
+        try {
+            [System.BitConverter]::ToString($hash.ComputeHash($stream)).Replace('-', '').toLower()
+        } finally {
+            $stream.Dispose()
+        }
+    }
+    $limit = [Math]::Min([Environment]::ProcessorCount * 2, 64)
+    $pool = [RunspaceFactory]::CreateRunspacePool(1, [Environment]::ProcessorCount)
+    $pool.Open()
+    $running = New-Object System.Collections.Generic.List[object]
+    $next = 0
+    try {
+        while ($next -lt $files.Count -or $running.Count -gt 0) {
+            while ($next -lt $files.Count -and $running.Count -lt $limit) {
+                $file = $files[$next]
+                $next++
+                $ps = [PowerShell]::Create()
+                $ps.RunspacePool = $pool
+                [void]$ps.AddScript($hashScript).AddArgument($file.Path).AddArgument($script:algorithm)
+                $running.Add(@($file, $ps, $ps.BeginInvoke()))
+            }
+            $handles = [System.Threading.WaitHandle[]]@($running | ForEach-Object { $_[2].AsyncWaitHandle })
+            $i = [System.Threading.WaitHandle]::WaitAny($handles)
+            $file, $ps, $handle = $running[$i]
+            $running.RemoveAt($i)
+            try {
+                $file.Actual = [String]($ps.EndInvoke($handle) | Select-Object -First 1)
+            } catch {
+                $file.Actual = $null
+            } finally {
+                $ps.Dispose()
+            }
+        }
+    } finally {
+        ForEach ($job in $running) {
+            $job[1].Dispose()
+        }
+        $pool.Close()
+    }
+}
+
+function VerifyData([String]$md5file, [String]$checksumsfile, [String]$sizesfile, [String]$verifiedfile, [String]$annotation, [bool]$fast) {
+    # Checks downloaded files against their checksums, without the network.
+    # With -FastVerify, a file is failed without hashing if its size differs
+    # from the manifest, and passed without hashing if its size and
+    # modification time are unchanged since it was last verified
+    # ("size mtime md5  filename" lines, shared with download.py and
+    # download.sh)
+    ''
+    '------------------------------------------------------------------------'
+    'Verifying files (' + $annotation + ') : '
+    '------------------------------------------------------------------------'
+    ''
+
+    $sizes = @{}
+    if ($fast -and (Test-Path ($PSScriptRoot + '/' + $sizesfile))) {
+        ForEach ($line in Get-Content ($PSScriptRoot + '/' + $sizesfile)) {
+            $i = $line.IndexOf('  ')
+            if ($i -gt 0) {
+                $sizes[$line.Substring($i + 2)] = $line.Substring(0, $i)
+            }
+        }
+    }
+    $verified = @{}
+    if (Test-Path ($PSScriptRoot + '/' + $verifiedfile)) {
+        ForEach ($line in Get-Content ($PSScriptRoot + '/' + $verifiedfile)) {
+            $i = $line.IndexOf('  ')
+            if ($i -gt 0) {
+                $verified[$line.Substring($i + 2)] = $line.Substring(0, $i)
+            }
+        }
+    }
+
+    $records = New-Object System.Collections.Generic.List[String]
+    $tohash = New-Object System.Collections.Generic.List[object]
+    $failures = 0
+    ForEach ($entry in ReadChecksums $md5file $checksumsfile) {
+        $md5 = $entry.Checksum
+        $filename = $entry.Name
+        $path = $PSScriptRoot + '/' + $filename
+        if (!(Test-Path -LiteralPath $path -PathType Leaf)) {
+            $filename + ": FAILED open or read"
+            $failures++
+            continue
+        }
+        $item = Get-Item -LiteralPath $path
+        $mtime = [DateTimeOffset]::new($item.LastWriteTimeUtc).ToUnixTimeSeconds()
+        $record = [String]$item.Length + ' ' + $mtime + ' ' + $md5
+        if ($fast -and $sizes.ContainsKey($filename) -and $sizes[$filename] -ne [String]$item.Length) {
+            $filename + ": FAILED size"
+            $failures++
+        } elseif ($fast -and $verified[$filename] -eq $record) {
+            $filename + ": OK"
+            $records.Add($record + '  ' + $filename)
+        } else {
+            $tohash.Add([PSCustomObject]@{ Name = $filename; Path = $path; Md5 = $md5; Record = $record; Actual = $null })
+        }
+    }
+
+    HashFiles $tohash
+    ForEach ($file in $tohash) {
+        if ($file.Actual -eq $file.Md5) {
+            $file.Name + ": OK"
+            $records.Add($file.Record + '  ' + $file.Name)
+        } else {
+            $file.Name + ": FAILED"
+            $failures++
+        }
+    }
+
+    [System.IO.File]::WriteAllLines($PSScriptRoot + '/' + $verifiedfile, $records)
+    $script:verify_failures += $failures
+}
+
 # Output information files
 
 function DisplayFile([String]$filename, [String]$description) {
@@ -98,36 +317,40 @@ function DisplayFile([String]$filename, [String]$description) {
     Get-Content $filename |ForEach-Object {"    $_"}
 }
 
-DisplayFile .\README.txt 'README.txt'
-DisplayFile .\MEMBERSHIPS.txt 'MEMBERSHIPS.txt'
-if([System.IO.File]::Exists('.\OPTIONAL.txt')){
-    DisplayFile .\OPTIONAL.txt 'OPTIONAL.txt'
+DisplayFile .\\README.txt 'README.txt'
+DisplayFile .\\MEMBERSHIPS.txt 'MEMBERSHIPS.txt'
+if([System.IO.File]::Exists('.\\OPTIONAL.txt')){
+    DisplayFile .\\OPTIONAL.txt 'OPTIONAL.txt'
 }
 
 
 # Force downloads to location where script is
 Set-Location -Path $PSScriptRoot
 
-function DownloadData([String]$urlfile, [String]$md5file, [String]$annotation) {
+function DownloadData([String]$urlfile, [String]$pathsfile, [String]$md5file, [String]$checksumsfile, [String]$annotation) {
     ''
     '------------------------------------------------------------------------'
     'Commencing bulk download of data from CKAN (' + $annotation + ') : '
     '------------------------------------------------------------------------'
     ''
 
-    $urls = Get-Content  ($PSScriptRoot + '/' + $urlfile)
-    ForEach ($line in $urls) {
-        DownloadURL $line
+    $urls = @(Get-Content  ($PSScriptRoot + '/' + $urlfile))
+    # the path of each file, in the order of the URLs; without a list of
+    # paths, files are named from their URLs
+    $paths = @()
+    if (Test-Path ($PSScriptRoot + '/' + $pathsfile)) {
+        $paths = @(Get-Content ($PSScriptRoot + '/' + $pathsfile))
+    }
+    For ($i = 0; $i -lt $urls.Count; $i++) {
+        DownloadURL $urls[$i] $(if ($i -lt $paths.Count) { $paths[$i] } else { $null })
     }
 
     'File downloads complete.'
     ''
     'Verifying file checksums:'
     ''
-    $md5s = Get-Content ($PSScriptRoot + '/' + $md5file)
-    ForEach ($line in $md5s) {
-        $md5, $filename = $line.Split(" ",[StringSplitOptions]'RemoveEmptyEntries')
-        VerifyMD5 $filename $md5
+    ForEach ($entry in ReadChecksums $md5file $checksumsfile) {
+        VerifyChecksum $entry.Name $entry.Checksum
     }
 }
 
@@ -157,9 +380,24 @@ function CheckFileStatus {
     return $True
 }
 
-DownloadData '{{ urls_fname }}' '{{ md5sum_fname }}' 'main'
+if ($verify) {
+    $script:verify_failures = 0
+    VerifyData '{{ md5sum_fname }}' '{{ checksums_fname }}' '{{ sizes_fname }}' '{{ verified_fname }}' 'main' $FastVerify
+    if ($Optional -and (CheckFileStatus '{{ md5sum_optional_fname }}')) {
+        VerifyData '{{ md5sum_optional_fname }}' '{{ checksums_optional_fname }}' '{{ sizes_optional_fname }}' '{{ verified_optional_fname }}' 'optional' $FastVerify
+    }
+    ''
+    if ($script:verify_failures -gt 0) {
+        [String]$script:verify_failures + ' files missing or corrupted, run without -VerifyOnly or -FastVerify to download them'
+        exit 1
+    }
+    'All files verified.'
+    exit 0
+}
+
+DownloadData '{{ urls_fname }}' '{{ paths_fname }}' '{{ md5sum_fname }}' '{{ checksums_fname }}' 'main'
 
 if($Optional -and (CheckFileStatus '{{ urls_optional_fname }}' '{{ md5sum_optional_fname }}')) {
-    DownloadData '{{ urls_optional_fname }}' '{{ md5sum_optional_fname }}' 'optional'
+    DownloadData '{{ urls_optional_fname }}' '{{ paths_optional_fname }}' '{{ md5sum_optional_fname }}' '{{ checksums_optional_fname }}' 'optional'
 }
 """
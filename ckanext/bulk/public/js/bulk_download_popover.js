@@ -14,7 +14,7 @@ ckan.module('bulk_download_popover', function ($) {
       var bulk_wording = this.options.wording;
       var bulk_url = this.options.url;
 
-      var bulk_content = 'WORDS  <a class="btn btn-primary popover-btn fa fa-download pull-right" href="URL"> Download Zip</a>'
+      var bulk_content = 'WORDS <p class="bulk-estimate"></p> <a class="btn btn-primary popover-btn fa fa-download pull-right" href="URL"> Download Zip</a>'
         .replace('WORDS', bulk_wording)
         .replace('URL', bulk_url)
 
@@ -26,6 +26,57 @@ ckan.module('bulk_download_popover', function ($) {
                        placement: 'top',
                        trigger: 'focus'});
 
+      // Fetch a size estimate for the download when the popover is first
+      // shown, so users are warned before triggering very large archives.
+      this.estimate = null;
+      if (this.options.estimate_url) {
+        this.el.on('shown.bs.popover', this._onShown);
+      }
+    },
+
+    _onShown: function () {
+      var module = this;
+      if (this.estimate !== null) {
+        this._onEstimate(this.estimate);
+        return;
+      }
+      this._popover().find('.bulk-estimate').text('Calculating download size...');
+      $.getJSON(this.options.estimate_url)
+        .done(this._onEstimate)
+        .fail(function () {
+          module._popover().find('.bulk-estimate').text('');
+        });
+    },
+
+    _onEstimate: function (estimate) {
+      this.estimate = estimate;
+      var popover = this._popover();
+      var text = 'Datasets: ' + estimate.packages +
+        ', files: ' + estimate.resources +
+        ', total size: ' + estimate.size_human + '.';
+      if (estimate.truncated) {
+        text += ' Only the first ' + estimate.packages + ' of ' +
+          estimate.count + ' matching datasets will be included.';
+      }
+      var element = popover.find('.bulk-estimate').text(text);
+      if (estimate.warn) {
+        element.addClass('bulk-estimate-warning')
+          .append(' This is a very large download; consider narrowing your search.');
+        popover.find('.popover-btn')
+          .removeClass('btn-primary')
+          .addClass('btn-warning')
+          .off('click.bulk')
+          .on('click.bulk', function (event) {
+            if (!window.confirm('This is a very large download (' + estimate.size_human + '). Continue?')) {
+              event.preventDefault();
+            }
+          });
+      }
+    },
+
+    _popover: function () {
+      // Bootstrap links the trigger element to its popover
+      return $('#' + this.el.attr('aria-describedby'));
     },
   };
-});
\ No newline at end of file
+});
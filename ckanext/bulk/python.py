@@ -16,6 +16,7 @@ PY_TEMPLATE = '''\
 # Automatically generated variables
 bpa_dltool_slug = "{{ prefix }}"
 bpa_username = "{{ username }}"
+portal_url = "{{ site_url }}"
 
 # Static constants
 user_agent = "data.bioplatforms.com download.py/0.9 {{ username }} (Contact help@bioplatforms.com)"
@@ -27,6 +28,17 @@ import os
 import hashlib
 import logging
 import argparse
+import asyncio
+import ctypes
+import json
+import datetime
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 
 if __name__ == "__main__":
@@ -52,6 +64,13 @@ if __name__ == "__main__":
 else:
     import requests
 
+# Optional: with aiohttp, many more downloads can be in flight at once,
+# without a thread each (--engine async)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 
 def make_logger(name, level=logging.INFO):
     logger = logging.getLogger(name)
@@ -64,38 +83,683 @@ def make_logger(name, level=logging.INFO):
     return logger
 
 
-def check_md5sum(fullpath, checksum):
-    # Returns true if file matches checksum
-    filename = fullpath.split(os.path.sep)[-1]
+class Buffers:
+    # A reusable buffer per thread, which files are read into and hashed
+    # from, rather than allocating a new byte string for each chunk; its
+    # size is also the chunk size of downloads
+    def __init__(self, size=4 * 1024 * 1024):
+        self.size = size
+        self.local = threading.local()
+
+    def get(self):
+        view = getattr(self.local, "view", None)
+        if view is None or len(view) != self.size:
+            view = self.local.view = memoryview(bytearray(self.size))
+        return view
+
+
+buffers = Buffers()
+
+
+def advise_sequential(f):
+    # Hints that the file will be accessed sequentially, so that the
+    # kernel reads ahead further (Linux and some other Unixes)
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+# fallocate(2) mode: allocate blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def load_fallocate():
+    # fallocate(2) from the C library on Linux, or None
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+fallocate = load_fallocate()
+
+
+@contextmanager
+def open_target(target, append=False, length=None):
+    # Opens target for writing, at its end if appending, preallocating
+    # length more bytes where supported so that large files are not
+    # fragmented. The file's size is left unchanged, so that if the
+    # script is killed, the file holds only what was written, and is
+    # resumed from there.
+    f = open(target, "r+b" if append and os.path.isfile(target) else "wb")
+    try:
+        f.seek(0, os.SEEK_END)
+        if length and fallocate is not None:
+            # a failure (e.g. not supported by the filesystem) is harmless
+            fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, f.tell(), length)
+        advise_sequential(f)
+        yield f
+    finally:
+        f.close()
+
+
+def content_length(headers):
+    try:
+        return int(headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
 
-    md5_object = hashlib.md5()
-    block_size = 64 * 1024 * md5_object.block_size
+def hash_file(fullpath, md5_object):
+    # Adds the contents of the file to md5_object
+    view = buffers.get()
 
-    f = open(fullpath, "rb")
-    chunk = f.read(block_size)
-    while chunk:
-        # md5_object.update(bytearray(chunk))
-        md5_object.update(chunk)
-        chunk = f.read(block_size)
+    with open(fullpath, "rb", buffering=0) as f:
+        advise_sequential(f)
+        n = f.readinto(view)
+        while n:
+            md5_object.update(view[:n])
+            n = f.readinto(view)
+    return md5_object
 
-    md5_hash = md5_object.hexdigest()
 
+def hash_constructor(algorithm):
+    # A hashlib style constructor for the algorithm, or None if it is not
+    # available here; BLAKE3 and XXH3 need the blake3 and xxhash modules
+    try:
+        if algorithm == "blake3":
+            import blake3
+            return blake3.blake3
+        if algorithm == "xxh3":
+            import xxhash
+            return xxhash.xxh3_64
+        if algorithm == "xxh128":
+            import xxhash
+            return xxhash.xxh3_128
+    except ImportError:
+        return None
+    if algorithm in hashlib.algorithms_available:
+        return lambda: hashlib.new(algorithm)
+    return None
+
+
+def fastest_algorithm(algorithms):
+    # The fastest of the algorithms on this machine, as measured (the best
+    # of three runs each)
+    data = bytes(8 * 1024 * 1024)
+    timings = []
+    for algorithm in algorithms:
+        for _ in range(3):
+            h = hash_constructor(algorithm)()
+            started = time.perf_counter()
+            h.update(data)
+            timings.append((time.perf_counter() - started, algorithm))
+    return min(timings)[1]
+
+
+class Digest:
+    # The checksum algorithm in use for a manifest: MD5, unless a faster
+    # one is available with a checksum for every file
+    def __init__(self):
+        self.use("md5")
+
+    def use(self, algorithm):
+        self.algorithm = algorithm
+        self.new = hash_constructor(algorithm)
+
+
+digest = Digest()
+
+
+def check_md5sum(fullpath, checksum):
+    # Returns true if file matches checksum (of the algorithm in use)
+    md5_hash = hash_file(fullpath, digest.new()).hexdigest()
+    return report_checksum(fullpath, md5_hash, checksum)
+
+
+def report_checksum(fullpath, md5_hash, checksum):
+    filename = os.path.basename(fullpath)
     if md5_hash == checksum:
         logger.info(f"VALID checksum for {filename} matches {checksum}")
     else:
         logger.warning(f"FAILED checksum for {filename} does not match {checksum}")
+    events.emit("checksum", file=filename, algorithm=digest.algorithm, valid=md5_hash == checksum)
 
     return md5_hash == checksum
 
 
+class EventLog:
+    # Machine readable progress and results, as newline delimited JSON
+    # (NDJSON), one event per line; a no-op unless opened
+    def __init__(self):
+        self.fh = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        self.fh = open(path, "a")
+
+    def emit(self, event, **fields):
+        if self.fh is None:
+            return
+        record = {"time": time.time(), "event": event}
+        record.update(fields)
+        line = json.dumps(record)
+        with self.lock:
+            print(line, file=self.fh, flush=True)
+
+    def transfer(self, target, offset=0):
+        return Transfer(self, os.path.basename(target), offset)
+
+
+class Transfer:
+    # Emits "bytes" events for a transfer in progress, at most once a second
+    def __init__(self, events, filename, offset):
+        self.events = events
+        self.filename = filename
+        self.offset = offset
+        self.received = 0
+        self.started = self.reported = time.monotonic()
+        self.reported_bytes = 0
+
+    def add(self, n):
+        self.received += n
+        now = time.monotonic()
+        if now - self.reported >= 1.0:
+            self.events.emit(
+                "bytes",
+                file=self.filename,
+                bytes=self.offset + self.received,
+                rate=(self.received - self.reported_bytes) / (now - self.reported),
+            )
+            self.reported, self.reported_bytes = now, self.received
+
+
+events = EventLog()
+
+
+def previously_valid(path):
+    # Files recorded as downloaded and verified by the last session to
+    # process them, as {filename: size}
+    valid = {}
+    if not os.path.isfile(path):
+        return valid
+    with open(path, "r") as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("event") != "done":
+                continue
+            if record.get("status") == "valid":
+                valid[record["file"]] = record.get("bytes")
+            else:
+                valid.pop(record["file"], None)
+    return valid
+
+
+class WindowClosed(Exception):
+    pass
+
+
+class Interrupted(Exception):
+    # Raised in download threads once the user has interrupted the script
+    pass
+
+
+# set on Ctrl-C, so that download threads stop at their next chunk
+interrupted = threading.Event()
+
+
+class TokenBucket:
+    # Limits the combined transfer rate of all downloads, in bytes per
+    # second, allowing bursts of up to a second's worth; a no-op unless
+    # a rate is set
+    def __init__(self):
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.tokens = float(rate or 0)
+
+    def reserve(self, n):
+        # Returns the time to wait before n more bytes may be received
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # go into debt, and wait until it would have been repaid
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, n):
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Schedule:
+    # Times of day (local) during which downloads may run, e.g. 19:00-07:00;
+    # always open unless windows are set
+    def __init__(self):
+        self.windows = []
+        self.checked = 0.0
+        self.was_open = True
+
+    def add_window(self, text):
+        start, end = text.split("-")
+        self.windows.append((parse_time_of_day(start), parse_time_of_day(end)))
+
+    def is_open(self):
+        if not self.windows:
+            return True
+        now = datetime.datetime.now().time()
+        for start, end in self.windows:
+            if start <= end and start <= now < end:
+                return True
+            # windows such as 19:00-07:00 span midnight
+            if start > end and (now >= start or now < end):
+                return True
+        return False
+
+    def wait(self):
+        # Blocks until a window is open
+        if self.is_open():
+            return
+        logger.info("Outside of download windows, waiting...")
+        events.emit("paused")
+        while not self.is_open():
+            time.sleep(30)
+        logger.info("Download window open, continuing")
+        events.emit("unpaused")
+
+    async def wait_async(self):
+        # wait(), for coroutines
+        if self.is_open():
+            return
+        logger.info("Outside of download windows, waiting...")
+        events.emit("paused")
+        while not self.is_open():
+            await asyncio.sleep(30)
+        logger.info("Download window open, continuing")
+        events.emit("unpaused")
+
+    def check(self):
+        # Raises WindowClosed if the window has closed, checking at most
+        # once a second
+        now = time.monotonic()
+        if now - self.checked >= 1.0:
+            self.checked = now
+            self.was_open = self.is_open()
+        if not self.was_open:
+            raise WindowClosed()
+
+
+def parse_time_of_day(text):
+    return datetime.datetime.strptime(text.strip(), "%H:%M").time()
+
+
+def parse_rate(text):
+    # bytes per second, with an optional K, M or G (binary) suffix
+    return parse_size(text.strip().upper().replace("/S", ""))
+
+
+def parse_size(text):
+    # bytes, with an optional K, M or G (binary) suffix
+    text = text.strip().upper().rstrip("B")
+    multiplier = 1
+    for suffix, factor in (("K", 1024), ("M", 1024 ** 2), ("G", 1024 ** 3)):
+        if text.endswith(suffix):
+            text, multiplier = text[:-1], factor
+    return int(float(text) * multiplier)
+
+
+bandwidth = TokenBucket()
+schedule = Schedule()
+
+
+def throttle(n):
+    # Called for each chunk received
+    if interrupted.is_set():
+        raise Interrupted()
+    bandwidth.consume(n)
+    schedule.check()
+
+
+async def throttle_async(n):
+    wait = bandwidth.reserve(n)
+    if wait > 0:
+        await asyncio.sleep(wait)
+    schedule.check()
+
+
+def read_md5sums(md5_file):
+    # {filename: checksum} from an md5sum list
+    md5 = {}
+    with open(md5_file, "r") as md5fh:
+        for line in md5fh.readlines():
+            try:
+                (checksum, filename) = line.strip().split("  ", 1)
+                md5[filename] = checksum
+            except ValueError as exception:
+                logger.error("Failed to parse MD5 line")
+                logger.error("Line     : %s" % (line,))
+                logger.error("Exception: %s" % (exception,))
+    return md5
+
+
+def read_checksums(md5_file, checksums_file):
+    # {filename: checksum} in the fastest algorithm available here which
+    # has a checksum for every file in the manifest, from "algorithm
+    # checksum  filename" lines; MD5 otherwise. The algorithm is put in use.
+    md5 = read_md5sums(md5_file)
+    by_algorithm = {}
+    if checksums_file and os.path.isfile(checksums_file):
+        with open(checksums_file, "r") as fh:
+            for line in fh:
+                try:
+                    record, filename = line.rstrip().split("  ", 1)
+                    algorithm, checksum = record.split(" ")
+                except ValueError:
+                    continue
+                by_algorithm.setdefault(algorithm, {})[filename] = checksum
+
+    candidates = [
+        algorithm
+        for algorithm, checksums in by_algorithm.items()
+        if algorithm != "md5"
+        and hash_constructor(algorithm) is not None
+        and all(filename in checksums for filename in md5)
+    ]
+    algorithm = fastest_algorithm(candidates + ["md5"]) if candidates else "md5"
+    digest.use(algorithm)
+    if algorithm == "md5":
+        return md5
+    logger.info("Using %s checksums" % (algorithm,))
+    return {filename: by_algorithm[algorithm][filename] for filename in md5}
+
+
+def read_paths(url_list, paths_file=None):
+    # [(url, path)] of the files to download, with each path relative to
+    # the script directory ("/" separated) from the paths list, which is in
+    # the order of the URLs; without one, files are named from their URLs
+    with open(url_list, "r") as urlfh:
+        urls = [url.strip() for url in urlfh if url.strip()]
+    if paths_file and os.path.isfile(paths_file):
+        with open(paths_file, "r") as pathfh:
+            paths = [path.strip() for path in pathfh if path.strip()]
+        if len(paths) == len(urls):
+            return list(zip(urls, paths))
+        logger.warning("%s does not list a path for each URL, ignoring it" % (paths_file,))
+    # the path excludes any query string, e.g. of a signed URL
+    return [(url, urlparse(url).path.split("/")[-1]) for url in urls]
+
+
+def local_path(target_dir, filename):
+    # the local path of a file listed in the manifest
+    return os.path.join(target_dir, *filename.split("/"))
+
+
+def read_sizes(path):
+    # {filename: size} from a "size  filename" list, if present
+    sizes = {}
+    if not os.path.isfile(path):
+        return sizes
+    with open(path, "r") as fh:
+        for line in fh:
+            try:
+                size, filename = line.strip().split("  ", 1)
+                sizes[filename] = int(size)
+            except ValueError:
+                continue
+    return sizes
+
+
+# HTTP statuses which are retried, after a backoff
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+# HTTP statuses which mean the server is overloaded, so fewer concurrent
+# requests should be made to it
+OVERLOAD_STATUSES = (429, 503)
+# (connect, read) timeouts in seconds, so that stalled transfers are retried
+REQUEST_TIMEOUT = (30, 300)
+
+
+class TransientError(Exception):
+    # A failure which may not recur if the request is retried
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds, or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_status(status, headers, url):
+    # Raises TransientError for responses worth retrying
+    if status in RETRY_STATUSES:
+        raise TransientError(
+            "HTTP %d from %s" % (status, urlparse(url).netloc),
+            status,
+            parse_retry_after(headers.get("Retry-After")),
+        )
+
+
+def check_response(r):
+    # Raises TransientError for responses worth retrying, otherwise
+    # HTTPError for failed requests
+    check_status(r.status_code, r.headers, r.url)
+    r.raise_for_status()
+
+
+class HostLimiter:
+    # Limits concurrent requests to one host, adapting the limit by
+    # additive increase / multiplicative decrease (AIMD): it grows by
+    # one after a limit's worth of successes, and halves (at most once
+    # a second) when the host reports that it is overloaded
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.active = 0
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= max(1, int(self.limit)):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, succeeded=False, overloaded=False):
+        with self.condition:
+            self.active -= 1
+            self.adapt(succeeded, overloaded)
+            self.condition.notify_all()
+
+    def adapt(self, succeeded, overloaded):
+        now = time.monotonic()
+        if overloaded and now - self.decreased > 1.0:
+            self.limit = max(1.0, self.limit / 2)
+            self.decreased = now
+            events.emit("concurrency", limit=int(self.limit))
+            logger.warning("Server overloaded, reducing to %d concurrent downloads" % (int(self.limit),))
+        elif succeeded:
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+
+
+class AsyncHostLimiter(HostLimiter):
+    # HostLimiter, for coroutines; created within the event loop
+    def __init__(self, maximum):
+        super().__init__(maximum)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < max(1, int(self.limit)))
+            self.active += 1
+
+    async def release(self, succeeded=False, overloaded=False):
+        async with self.condition:
+            self.active -= 1
+            self.adapt(succeeded, overloaded)
+            self.condition.notify_all()
+
+
+class FailureBudget:
+    # The number of failed attempts allowed in the whole session, after
+    # which no more are made: better to stop and re-run later than to
+    # keep retrying against a struggling server
+    def __init__(self, failures):
+        self.remaining = failures
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            self.remaining -= 1
+            return self.remaining >= 0
+
+    @property
+    def exhausted(self):
+        return self.remaining < 0
+
+
+class RetryEngine:
+    # Runs requests with retries, jittered exponential backoff, and
+    # adaptive per-host concurrency, within a global failure budget
+    def __init__(self, jobs=4, retries=5, failure_budget=50, backoff=1.0, max_backoff=120.0, asynchronous=False):
+        self.jobs = jobs
+        # downloads are made by an AsyncDownloader, rather than threads
+        self.asynchronous = asynchronous
+        self.retries = retries
+        self.budget = FailureBudget(failure_budget)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(self.jobs)
+            return self.hosts[host]
+
+    def delay(self, attempt, retry_after=None):
+        # "Full jitter" backoff, so that clients do not retry in lockstep,
+        # but never sooner than the server asked
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+    def run(self, url, attempt):
+        # Returns attempt(n) for the first of n = 0, 1, ... which does not
+        # raise a transient error, or None once retries are exhausted
+        limiter = self.limiter(url)
+        error = None
+        n = 0
+        while n <= self.retries:
+            if self.budget.exhausted:
+                raise BudgetExhausted()
+            schedule.wait()
+            retry_after = None
+            limiter.acquire()
+            try:
+                result = attempt(n)
+            except WindowClosed:
+                # not a failure: try again (resuming) when the window opens
+                limiter.release()
+                continue
+            except TransientError as exception:
+                limiter.release(overloaded=exception.status in OVERLOAD_STATUSES)
+                error, retry_after = exception, exception.retry_after
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as exception:
+                limiter.release()
+                error = exception
+            except BaseException:
+                limiter.release()
+                raise
+            else:
+                limiter.release(succeeded=True)
+                return result
+
+            if not self.budget.spend():
+                logger.error("Failure budget exhausted: %s" % (error,))
+                raise BudgetExhausted()
+            if n < self.retries:
+                delay = self.delay(n, retry_after)
+                events.emit("retry", url=url, error=str(error), attempt=n + 1, delay=delay)
+                logger.warning(
+                    "%s, retrying in %.1fs (%d/%d)" % (error, delay, n + 1, self.retries)
+                )
+                if interrupted.wait(delay):
+                    raise Interrupted()
+            n += 1
+        logger.error("Giving up after %d attempts: %s" % (self.retries + 1, error))
+        return None
+
+
+http_local = threading.local()
+
+
+def http():
+    # A session per thread, so that connections are reused
+    if not hasattr(http_local, "session"):
+        http_local.session = requests.Session()
+    return http_local.session
+
+
+def request_headers(api, url):
+    # Credentials are only sent to the portal, and not to other hosts
+    # such as object storage (signed URLs must not carry credentials)
+    headers = requests.utils.default_headers()
+    headers.update({"User-Agent": user_agent})
+    if url.startswith(portal_url + "/"):
+        headers.update({"Authorization": api})
+    return headers
+
+
 def get_remote_file_size(api, url):
     # This method returns None if it is not able to determine
     # the remote file size
-    headers = requests.utils.default_headers()
-    headers.update({"User-Agent": user_agent, "Authorization": api})
+    headers = request_headers(api, url)
 
-    resGet = requests.get(url, stream=True, headers=headers)
-    contentLength = resGet.headers.get("Content-length")
+    with http().get(url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT) as resGet:
+        if resGet.status_code in RETRY_STATUSES:
+            check_response(resGet)
+        contentLength = resGet.headers.get("Content-length")
     if contentLength is None:
         u = urlparse(resGet.url)
         if u.path == "/user/login":
@@ -122,21 +786,24 @@ def resume_download(api, source, target):
     have = os.path.getsize(target)
 
     logger.info("Resuming download at: %d" % have)
+    events.emit("resume", file=os.path.basename(target), offset=have)
 
-    headers = requests.utils.default_headers()
-    headers.update(
-        {"User-Agent": user_agent, "Authorization": api, "Range": "bytes=%d-" % have}
-    )
+    headers = request_headers(api, source)
+    headers.update({"Range": "bytes=%d-" % have})
 
     try:
-        with requests.get(
-            source, stream=True, headers=headers, allow_redirects=True
+        with http().get(
+            source, stream=True, headers=headers, allow_redirects=True, timeout=REQUEST_TIMEOUT
         ) as r:
-            r.raise_for_status()
-            # append
-            with open(target, "ab") as f:
-                for chunk in r.iter_content(chunk_size=8192):
+            check_response(r)
+            # append, unless the server ignored the range and sent it all
+            mode = "ab" if r.status_code == 206 else "wb"
+            progress = events.transfer(target, have if mode == "ab" else 0)
+            with open_target(target, mode == "ab", content_length(r.headers)) as f:
+                for chunk in r.iter_content(chunk_size=buffers.size):
                     f.write(chunk)
+                    progress.add(len(chunk))
+                    throttle(len(chunk))
     except requests.exceptions.HTTPError as exception:
         logger.error("Failed (re)-download")
         logger.error(exception)
@@ -149,39 +816,177 @@ def download(api, source, target, checksum=None):
     # Returns the local filename if succesful, else None
     # If checksum provided, calculate it on the fly
     logger.info("Downloading")
-    headers = requests.utils.default_headers()
-    headers.update({"User-Agent": user_agent, "Authorization": api})
+    headers = request_headers(api, source)
 
-    md5_object = hashlib.md5()
+    md5_object = digest.new()
 
     try:
-        with requests.get(
-            source, stream=True, headers=headers, allow_redirects=True
+        with http().get(
+            source, stream=True, headers=headers, allow_redirects=True, timeout=REQUEST_TIMEOUT
         ) as r:
-            r.raise_for_status()
-            with open(target, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
+            check_response(r)
+            progress = events.transfer(target)
+            with open_target(target, length=content_length(r.headers)) as f:
+                for chunk in r.iter_content(chunk_size=buffers.size):
                     if checksum is not None:
                         md5_object.update(chunk)
                     f.write(chunk)
+                    progress.add(len(chunk))
+                    throttle(len(chunk))
     except requests.exceptions.HTTPError as exception:
         logger.error("Failed download")
         logger.error(exception)
         return None
 
-    if checksum is not None:
-        # Returns true if file matches checksum
-        md5_hash = md5_object.hexdigest()
-
-        if md5_hash == checksum:
-            logger.info(f"VALID checksum for {target} matches {checksum}")
-        else:
-            logger.warning(f"FAILED checksum for {target} does not match {checksum}")
-            return None
+    if checksum is not None and not report_checksum(target, md5_object.hexdigest(), checksum):
+        return None
 
     return target
 
 
+def fetch(engine, api, source, target, checksum):
+    # Downloads the whole file, resuming it after a transient failure (or
+    # the download window closing)
+    # Returns the local filename if succesful, else None
+    def attempt(n):
+        if os.path.isfile(target) and os.path.getsize(target) > 0:
+            if resume_download(api, source, target) is None:
+                return None
+            return target if check_md5sum(target, checksum) else None
+        return download(api, source, target, checksum)
+
+    return engine.run(source, attempt)
+
+
+class AsyncDownloader:
+    # Downloads with asyncio and aiohttp, for manifests of many small files:
+    # hundreds of requests can be in flight over keep-alive connections,
+    # without a thread each. Each file takes a single ranged request, which
+    # resumes a partial file or confirms a complete one, and is hashed as
+    # it streams to disk. Retries, backoff, the failure budget and per-host
+    # concurrency are as for the RetryEngine.
+    def __init__(self, engine, api):
+        self.engine = engine
+        self.api = api
+        self.hosts = {}
+
+    def session(self):
+        connector = aiohttp.TCPConnector(limit=self.engine.jobs, limit_per_host=self.engine.jobs)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1]
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def limiter(self, url):
+        host = urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = AsyncHostLimiter(self.engine.jobs)
+        return self.hosts[host]
+
+    async def run(self, url, attempt):
+        # RetryEngine.run, for coroutines
+        engine = self.engine
+        limiter = self.limiter(url)
+        error = None
+        n = 0
+        while n <= engine.retries:
+            if engine.budget.exhausted:
+                raise BudgetExhausted()
+            await schedule.wait_async()
+            retry_after = None
+            await limiter.acquire()
+            try:
+                result = await attempt()
+            except WindowClosed:
+                await limiter.release()
+                continue
+            except TransientError as exception:
+                await limiter.release(overloaded=exception.status in OVERLOAD_STATUSES)
+                error, retry_after = exception, exception.retry_after
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+                await limiter.release()
+                error = exception
+            except BaseException:
+                await limiter.release()
+                raise
+            else:
+                await limiter.release(succeeded=True)
+                return result
+
+            if not engine.budget.spend():
+                logger.error("Failure budget exhausted: %s" % (error,))
+                raise BudgetExhausted()
+            if n < engine.retries:
+                delay = engine.delay(n, retry_after)
+                events.emit("retry", url=url, error=str(error) or repr(error), attempt=n + 1, delay=delay)
+                logger.warning(
+                    "%s, retrying in %.1fs (%d/%d)" % (str(error) or repr(error), delay, n + 1, engine.retries)
+                )
+                await asyncio.sleep(delay)
+            n += 1
+        logger.error("Giving up after %d attempts: %s" % (engine.retries + 1, error))
+        return None
+
+    async def process_file(self, session, url, filename, dl_path, checksum, count, total):
+        logger.info("File %d/%d: %s" % (count("processed"), total, filename))
+        count("present" if os.path.isfile(dl_path) else "fresh")
+        status = await self.run(
+            url, lambda: self.attempt(session, url, dl_path, checksum, count)
+        )
+        count(status or "failed")
+
+    async def attempt(self, session, url, target, checksum, count):
+        # Returns valid, invalid or failed
+        loop = asyncio.get_event_loop()
+        have = os.path.getsize(target) if os.path.isfile(target) else 0
+        headers = request_headers(self.api, url)
+        if have:
+            headers["Range"] = "bytes=%d-" % have
+
+        md5_object = digest.new()
+        async with session.get(url, headers=headers) as r:
+            if have and r.status == 416:
+                # nothing beyond the local file: it is complete (or larger
+                # than the remote file, and so will fail the checksum)
+                md5_object = None
+            else:
+                check_status(r.status, r.headers, url)
+                if r.status >= 400:
+                    logger.error("Failed download: HTTP %d for %s" % (r.status, url))
+                    return "failed"
+                if r.status == 206:
+                    logger.info("Resuming download at: %d" % have)
+                    events.emit("resume", file=os.path.basename(target), offset=have)
+                    count("resume")
+                    # hash what is already on disk, off the event loop
+                    await loop.run_in_executor(None, hash_file, target, md5_object)
+                else:
+                    have = 0
+                progress = events.transfer(target, have)
+                with open_target(target, bool(have), r.content_length) as f:
+                    # whatever has arrived, rather than waiting to fill a
+                    # large chunk for each of many transfers
+                    async for chunk in r.content.iter_any():
+                        md5_object.update(chunk)
+                        f.write(chunk)
+                        progress.add(len(chunk))
+                        await throttle_async(len(chunk))
+
+        if md5_object is None:
+            valid = await loop.run_in_executor(None, check_md5sum, target, checksum)
+        else:
+            valid = report_checksum(target, md5_object.hexdigest(), checksum)
+        if valid:
+            return "valid"
+        if have:
+            logger.info("File corrupted, attempting to redownload...")
+            count("corrupted")
+            count("redownload")
+            os.remove(target)
+            return await self.attempt(session, url, target, checksum, count)
+        return "invalid"
+
+
 def check_for_api_key():
     # Check for CKAN API Key or token in the users environment
     # Returns the API Token first,or the Key if found, aborts otherwise
@@ -305,13 +1110,108 @@ def main():
     parser.add_argument(
         "-o", "--optional", action="store_true", help="Download optional files"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Files to download at once (default: 4, or 100 with --engine async), reduced automatically if the server is overloaded",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default="threads",
+        help="Download with a thread per file, or with asyncio, which suits many small files and needs aiohttp (default: threads)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Times to retry each request after a transient failure (default: 5)",
+    )
+    parser.add_argument(
+        "--failure-budget",
+        type=int,
+        default=50,
+        help="Failed attempts allowed in total before giving up until a later re-run (default: 50)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        metavar="SIZE",
+        default="4M",
+        help="Bytes read and written at a time, e.g. 1M to 16M for fast links (default: 4M)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        metavar="RATE",
+        help="Limit the combined download rate, in bytes per second, e.g. 500K, 20M or 1G",
+    )
+    parser.add_argument(
+        "--window",
+        action="append",
+        metavar="HH:MM-HH:MM",
+        help="Only download during this time of day (local time), e.g. 19:00-07:00; may be repeated",
+    )
+    parser.add_argument(
+        "--order",
+        choices=["manifest", "largest", "smallest"],
+        default="manifest",
+        help="Download the largest or smallest files first (default: manifest order)",
+    )
+    parser.add_argument(
+        "--verify-only",
+        action="store_true",
+        help="Check the files already downloaded against their checksums, without downloading",
+    )
+    parser.add_argument(
+        "--fast-verify",
+        action="store_true",
+        help="As --verify-only, but only hash files whose size and modification time have changed since they were last verified",
+    )
+    parser.add_argument(
+        "--json-log",
+        nargs="?",
+        const="",
+        metavar="PATH",
+        help="Append progress and results as NDJSON events (default PATH: tmp/<slug>_download.ndjson)",
+    )
+    parser.add_argument(
+        "--only-failed",
+        action="store_true",
+        help="Skip files which the JSON log records as downloaded and verified",
+    )
     parsed = parser.parse_args()
 
     logger.info(user_agent)
     logger.info("Download Tool slug: %s" % bpa_dltool_slug)
     logger.info("BPA Portal Username: %s" % bpa_username)
 
-    api_key = check_for_api_key()
+    try:
+        buffers.size = parse_size(parsed.chunk_size)
+        if buffers.size < 1:
+            raise ValueError("invalid chunk size: %s" % (parsed.chunk_size,))
+        if parsed.max_rate:
+            bandwidth.set_rate(parse_rate(parsed.max_rate))
+        for window in parsed.window or []:
+            schedule.add_window(window)
+    except ValueError as exception:
+        parser.error(str(exception))
+
+    asynchronous = parsed.engine == "async"
+    if asynchronous and (aiohttp is None or sys.version_info < (3, 7)):
+        logger.warning("The async engine needs Python 3.7 or later and aiohttp, using threads")
+        logger.warning("Install aiohttp using: python3 -m pip install aiohttp")
+        asynchronous = False
+    jobs = parsed.jobs or (100 if asynchronous else 4)
+    verify = parsed.verify_only or parsed.fast_verify
+
+    # verification does not use the network
+    api_key = None if verify else check_for_api_key()
+    engine = RetryEngine(
+        jobs=max(1, jobs),
+        retries=max(0, parsed.retries),
+        failure_budget=max(0, parsed.failure_budget),
+        asynchronous=asynchronous,
+    )
 
     # Check for our list of URLs and MD5 values
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -321,10 +1221,34 @@ def main():
         f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_urls_optional.txt"
     )
     md5_optional_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_md5sum_optional.txt"
+    sizes_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_sizes.txt"
+    sizes_optional_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_sizes_optional.txt"
+    checksums_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_checksums.txt"
+    checksums_optional_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_checksums_optional.txt"
+    paths_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_paths.txt"
+    paths_optional_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_paths_optional.txt"
+    verified_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_verified.txt"
+    verified_optional_file = f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_verified_optional.txt"
+    json_log = parsed.json_log or f"{script_dir}{os.path.sep}tmp{os.path.sep}{bpa_dltool_slug}_download.ndjson"
     query_file = f"{script_dir}{os.path.sep}QUERY.txt"
     memberships_file = f"{script_dir}{os.path.sep}MEMBERSHIPS.txt"
     optional_file = f"{script_dir}{os.path.sep}OPTIONAL.txt"
 
+    skip = None
+    if parsed.only_failed:
+        # read before this session appends to the log
+        skip = previously_valid(json_log)
+    if parsed.json_log is not None:
+        events.open(json_log)
+        logger.info("JSON log: %s" % (json_log,))
+    events.emit(
+        "session",
+        slug=bpa_dltool_slug,
+        user=bpa_username,
+        jobs=engine.jobs,
+        engine="async" if engine.asynchronous else "threads",
+    )
+
     # Add QUERY.txt to debug output
     log_file_when_present(query_file, "QUERY.txt")
 
@@ -338,6 +1262,25 @@ def main():
         logger.info("Downloading main files first ...")
         logger.info("-----------")
 
+    if verify:
+        # hashing is bound by the disks and processors, not the server
+        verify_jobs = parsed.jobs or os.cpu_count() or 4
+        file_present(md5_file, "MD5 file")
+        valid = verify_downloads(
+            md5_file, checksums_file, sizes_file, verified_file, script_dir, verify_jobs, parsed.fast_verify
+        )
+        if parsed.optional and check_files(md5_optional_file):
+            valid = verify_downloads(
+                md5_optional_file,
+                checksums_optional_file,
+                sizes_optional_file,
+                verified_optional_file,
+                script_dir,
+                verify_jobs,
+                parsed.fast_verify,
+            ) and valid
+        sys.exit(0 if valid else 1)
+
     # Check we are being run from a suitable location
 
     file_present(url_list, "URL list")
@@ -346,7 +1289,7 @@ def main():
     # TODO: Add argument parsing to enable runtime setting of
     # download location, debug level, API Key
 
-    process_downloads(api_key, url_list, md5_file, script_dir)
+    process_downloads(engine, api_key, url_list, md5_file, script_dir, skip, parsed.order, sizes_file, checksums_file, paths_file)
 
     if parsed.optional and check_files(url_optional_list, md5_optional_file):
         logger.info("-----------")
@@ -356,7 +1299,7 @@ def main():
         file_present(url_optional_list, "URL optional list")
         file_present(md5_optional_file, "MD5 optional file")
 
-        process_downloads(api_key, url_optional_list, md5_optional_file, script_dir)
+        process_downloads(engine, api_key, url_optional_list, md5_optional_file, script_dir, skip, parsed.order, sizes_optional_file, checksums_optional_file, paths_optional_file)
     elif not parsed.optional and check_files(url_optional_list, md5_optional_file):
         logger.info("Skipping downloading OPTIONAL files")
     elif parsed.optional and not check_files(url_optional_list, md5_optional_file):
@@ -364,162 +1307,162 @@ def main():
         logger.warning("There may be file problems - email help@bioplatforms.com")
 
 
-def process_downloads(api_key, url_list, md5_file, target_dir):
+def process_downloads(engine, api_key, url_list, md5_file, target_dir, skip=None, order="manifest", sizes_file=None, checksums_file=None, paths_file=None):
+    # skip: {filename: size} of files known to be valid, which are not
+    # checked again if present with that size
+    # order: manifest, largest (first) or smallest (first), using the
+    # sizes listed in sizes_file
+    # checksums_file: checksums other than MD5, of which the fastest
+    # available is used
+    # paths_file: the path of each file in the directory layout
     # Open MD5 file and populate cache
 
-    md5 = {}
-    counts = {
-        "valid": 0,
-        "invalid": 0,
-        "fresh": 0,
-        "failed": 0,
-        "present": 0,
-        "corrupted": 0,
-        "redownload": 0,
-        "resume": 0,
-        "rerun": 0,
-        "processed": 0,
-        "noremotesize": 0,
-    }
+    md5 = read_checksums(md5_file, checksums_file)
+    counts = Counter(
+        {
+            "valid": 0,
+            "invalid": 0,
+            "fresh": 0,
+            "failed": 0,
+            "present": 0,
+            "corrupted": 0,
+            "redownload": 0,
+            "resume": 0,
+            "rerun": 0,
+            "processed": 0,
+            "noremotesize": 0,
+            "skipped": 0,
+        }
+    )
+    counts_lock = threading.Lock()
 
-    with open(md5_file, "r") as md5fh:
-        for line in md5fh.readlines():
-            try:
-                (checksum, filename) = line.strip().split("  ", 1)
-                md5[filename] = checksum
-            except ValueError as exception:
-                logger.error("Failed to parse MD5 line")
-                logger.error("Line     : %s" % (line,))
-                logger.error("Exception: %s" % (exception,))
+    def count(name):
+        with counts_lock:
+            counts[name] += 1
+            return counts[name]
 
     # Open list of URLs
 
     logger.info("%d files to download" % (len(md5),))
     logger.info("Manifest: %s" % (url_list,))
 
-    # For each URL
-    with open(url_list, "r") as urlfh:
-        for url in urlfh.readlines():
-            url = url.strip()
-            filename = url.strip().split("/")[-1]
-            dl_path = f"{target_dir}{os.path.sep}{filename}"
-
-            # Find MD5 sum for file
-            if not filename in md5:
-                logging.error("No MD5 sum found for %s" % (filename,))
-                sys.exit(2)
-
-            counts["processed"] += 1
-            logger.info("-----------")
-            logger.info("       File: %d/%d" % (counts["processed"], len(md5)))
-            logger.info("Downloading: %s" % (filename,))
-            logger.info("       from: %s" % (url,))
-            logger.info("         to: %s" % (dl_path,))
-
-            valid = False
-
-            if not (os.path.isfile(dl_path) and os.access(dl_path, os.R_OK)):
-                #    If file not present,
-                #        Check file size on mirror, note error, skip
-                #        begin download
-                #        Check MD5 sum
-                #        Log errors
-                logger.info("Checking file size and access...")
-                remote = get_remote_file_size(api_key, url)
-                if remote is None:
-                    logger.warning("Remote file size could not determined, skipping")
-                    counts["noremotesize"] += 1
-                    counts["failed"] += 1
-                    continue
-                logger.info("File %s - not present, downloading..." % (filename,))
-                counts["fresh"] += 1
-                if download(api_key, url, dl_path, md5[filename]):
-                    counts["valid"] += 1
-                else:
-                    # assume transfer failed, keep the file around
-                    counts["failed"] += 1
-            else:
-                #    If file present,
-                #        Check file size on mirror
-                #          If no, file size, check md5 / skip
-                #        If less than file size,
-                #          resume download
-                #        Log errors
-                #          Check MD5 sum
-                #          Log errors
-                #        If equal size,
-                #          Check MD5 Sum
-                #          If valid, move onto next URL, else delete
-                #          Begin download
-                #          Check MD5 sum
-                #        If greater size,
-                #          Delete file
-                #          begin download
-                #          Check MD5 sum
-                #          Log errors
-                counts["present"] += 1
-                logger.info("File %s - present, checking integrity..." % (filename,))
-                local = os.path.getsize(dl_path)
-                remote = get_remote_file_size(api_key, url)
-                if remote is None:
-                    logger.warning("Remote file size could not determined")
-                    logger.info("Checking file integrity anyhow...")
-                    counts["noremotesize"] += 1
-                    valid = check_md5sum(dl_path, md5[filename])
-                    if valid:
-                        counts["valid"] += 1
-                        logger.info("%s valid" % (filename,))
-                    else:
-                        counts["invalid"] += 1
-                    continue
+    downloads = []
+    directories = set()
+    for url, filename in read_paths(url_list, paths_file):
+        dl_path = local_path(target_dir, filename)
+
+        # Find MD5 sum for file
+        if not filename in md5:
+            logging.error("No MD5 sum found for %s" % (filename,))
+            sys.exit(2)
+
+        if skip and filename in skip and os.path.isfile(dl_path) and os.path.getsize(dl_path) == skip[filename]:
+            count("valid")
+            continue
+
+        directory = os.path.dirname(dl_path)
+        if directory not in directories:
+            os.makedirs(directory, exist_ok=True)
+            directories.add(directory)
+        downloads.append((url, filename, dl_path))
+
+    if skip:
+        logger.info("%d files previously downloaded and verified" % (counts["valid"],))
+
+    if order != "manifest" and sizes_file:
+        sizes = read_sizes(sizes_file)
+        # files of unknown size last, in either order
+        sign = -1 if order == "largest" else 1
+        downloads.sort(
+            key=lambda t: (t[1] not in sizes, sign * sizes.get(t[1], 0))
+        )
+        logger.info("Downloading %s files first" % (order,))
+
+    @contextmanager
+    def tracked(url, filename, dl_path):
+        # the last of valid, invalid or failed counted is the outcome
+        outcome = {"status": "skipped"}
+
+        def track(name):
+            if name in ("valid", "invalid", "failed"):
+                outcome["status"] = name
+            return count(name)
+
+        started = time.monotonic()
+        events.emit("start", file=filename, url=url)
+        try:
+            yield track
+        except BudgetExhausted:
+            count("skipped")
+        finally:
+            seconds = time.monotonic() - started
+            size = os.path.getsize(dl_path) if os.path.isfile(dl_path) else 0
+            events.emit(
+                "done",
+                file=filename,
+                status=outcome["status"],
+                bytes=size,
+                seconds=seconds,
+                rate=size / seconds if seconds > 0 else None,
+            )
 
-                # Compare file sizes
-
-                if local < remote:
-                    # assume interrupted as opposed to corrupt
-                    logger.info("Resuming download due to partial file...")
-                    counts["resume"] += 1
-                    if resume_download(api_key, url, dl_path):
-                        valid = check_md5sum(dl_path, md5[filename])
-                    else:
-                        valid = False
-                    if valid:
-                        counts["valid"] += 1
-                    else:
-                        counts["invalid"] += 1
-                        counts["rerun"] += 1
-                if local == remote:
-                    valid = check_md5sum(dl_path, md5[filename])
-                    if valid:
-                        logger.info("File already downloaded")
-                        counts["valid"] += 1
-                        continue
-                    else:
-                        logger.info(
-                            "File corrupted, same size but failed checksum, attempting to redownload..."
-                        )
-                        counts["corrupted"] += 1
-                        os.remove(dl_path)
-                    counts["redownload"] += 1
-                    if download(api_key, url, dl_path, md5[filename]):
-                        counts["valid"] += 1
-                    else:
-                        counts["invalid"] += 1
-                if local > remote:
-                    logger.info(
-                        "File corrupted, larger than remote, attempting to redownload..."
+    def process(url, filename, dl_path):
+        if interrupted.is_set():
+            return
+        with tracked(url, filename, dl_path) as track:
+            if engine.budget.exhausted:
+                raise BudgetExhausted()
+            process_file(engine, api_key, url, filename, dl_path, md5[filename], track, len(md5))
+
+    async def process_async():
+        downloader = AsyncDownloader(engine, api_key)
+        pending = iter(downloads)
+
+        async def worker(session):
+            # each worker takes the next download from those pending
+            for url, filename, dl_path in pending:
+                with tracked(url, filename, dl_path) as track:
+                    if engine.budget.exhausted:
+                        raise BudgetExhausted()
+                    await downloader.process_file(
+                        session, url, filename, dl_path, md5[filename], track, len(md5)
                     )
-                    counts["corrupted"] += 1
-                    os.remove(dl_path)
-                    counts["redownload"] += 1
-                    if download(api_key, url, dl_path, md5[filename]):
-                        counts["valid"] += 1
-                    else:
-                        counts["invalid"] += 1
+
+        async with downloader.session() as session:
+            await asyncio.gather(*[worker(session) for _ in range(engine.jobs)])
+
+    # For each URL, with up to engine.jobs at once
+    if engine.asynchronous:
+        asyncio.run(process_async())
+    else:
+        # only a few downloads are queued beyond those running, so that on
+        # Ctrl-C there are few to cancel, and those running stop at their
+        # next chunk, leaving partial files to be resumed
+        pool = ThreadPoolExecutor(max_workers=engine.jobs)
+        outstanding = set()
+        try:
+            for t in downloads:
+                if len(outstanding) >= 2 * engine.jobs:
+                    done, outstanding = wait(outstanding, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                outstanding.add(pool.submit(process, *t))
+            for future in outstanding:
+                future.result()
+        except KeyboardInterrupt:
+            interrupted.set()
+            for future in outstanding:
+                future.cancel()
+            pool.shutdown(wait=False)
+            logger.warning("Interrupted: re-run to resume the downloads")
+            events.emit("interrupted", manifest=os.path.basename(url_list))
+            sys.exit(130)
+        pool.shutdown()
 
     # Summary after all files/URLs processed
     logger.info("-----------")
-    logger.info("Session summary: %s" % (str(counts),))
+    logger.info("Session summary: %s" % (str(dict(counts)),))
+    events.emit("summary", manifest=os.path.basename(url_list), counts=dict(counts))
 
     if counts["valid"] == len(md5):
         logger.info("All files sucessfully downloaded.")
@@ -540,6 +1483,212 @@ def process_downloads(api_key, url_list, md5_file, target_dir):
                 "%d corrupted files, re-run to attempt to fix" % (counts["invalid"],)
             )
 
+        if counts["skipped"] > 0:
+            logger.warning(
+                "%d files not attempted as the server is failing, re-run later to download them"
+                % (counts["skipped"],)
+            )
+
+
+def process_file(engine, api_key, url, filename, dl_path, checksum, count, total):
+    logger.info("-----------")
+    logger.info("       File: %d/%d" % (count("processed"), total))
+    logger.info("Downloading: %s" % (filename,))
+    logger.info("       from: %s" % (url,))
+    logger.info("         to: %s" % (dl_path,))
+
+    valid = False
+
+    def remote_size():
+        return engine.run(url, lambda n: get_remote_file_size(api_key, url))
+
+    if not (os.path.isfile(dl_path) and os.access(dl_path, os.R_OK)):
+        #    If file not present,
+        #        Check file size on mirror, note error, skip
+        #        begin download
+        #        Check MD5 sum
+        #        Log errors
+        logger.info("Checking file size and access...")
+        remote = remote_size()
+        if remote is None:
+            logger.warning("Remote file size could not determined, skipping")
+            count("noremotesize")
+            count("failed")
+            return
+        logger.info("File %s - not present, downloading..." % (filename,))
+        count("fresh")
+        if fetch(engine, api_key, url, dl_path, checksum):
+            count("valid")
+        else:
+            # assume transfer failed, keep the file around
+            count("failed")
+    else:
+        #    If file present,
+        #        Check file size on mirror
+        #          If no, file size, check md5 / skip
+        #        If less than file size,
+        #          resume download
+        #        Log errors
+        #          Check MD5 sum
+        #          Log errors
+        #        If equal size,
+        #          Check MD5 Sum
+        #          If valid, move onto next URL, else delete
+        #          Begin download
+        #          Check MD5 sum
+        #        If greater size,
+        #          Delete file
+        #          begin download
+        #          Check MD5 sum
+        #          Log errors
+        count("present")
+        logger.info("File %s - present, checking integrity..." % (filename,))
+        local = os.path.getsize(dl_path)
+        remote = remote_size()
+        if remote is None:
+            logger.warning("Remote file size could not determined")
+            logger.info("Checking file integrity anyhow...")
+            count("noremotesize")
+            valid = check_md5sum(dl_path, checksum)
+            if valid:
+                count("valid")
+                logger.info("%s valid" % (filename,))
+            else:
+                count("invalid")
+            return
+
+        # Compare file sizes
+
+        if local < remote:
+            # assume interrupted as opposed to corrupt
+            logger.info("Resuming download due to partial file...")
+            count("resume")
+            if engine.run(url, lambda n: resume_download(api_key, url, dl_path)):
+                valid = check_md5sum(dl_path, checksum)
+            else:
+                valid = False
+            if valid:
+                count("valid")
+            else:
+                count("invalid")
+                count("rerun")
+        if local == remote:
+            valid = check_md5sum(dl_path, checksum)
+            if valid:
+                logger.info("File already downloaded")
+                count("valid")
+                return
+            else:
+                logger.info(
+                    "File corrupted, same size but failed checksum, attempting to redownload..."
+                )
+                count("corrupted")
+                os.remove(dl_path)
+            count("redownload")
+            if fetch(engine, api_key, url, dl_path, checksum):
+                count("valid")
+            else:
+                count("invalid")
+        if local > remote:
+            logger.info(
+                "File corrupted, larger than remote, attempting to redownload..."
+            )
+            count("corrupted")
+            os.remove(dl_path)
+            count("redownload")
+            if fetch(engine, api_key, url, dl_path, checksum):
+                count("valid")
+            else:
+                count("invalid")
+
+
+def read_verified(path):
+    # {filename: (size, mtime, checksum)} of files as they were when last
+    # verified, from "size mtime checksum  filename" lines; shared with
+    # download.sh and download.ps1
+    verified = {}
+    if not os.path.isfile(path):
+        return verified
+    with open(path, "r") as fh:
+        for line in fh:
+            try:
+                record, filename = line.rstrip().split("  ", 1)
+                size, mtime, checksum = record.split(" ")
+                verified[filename] = (int(size), int(mtime), checksum)
+            except ValueError:
+                continue
+    return verified
+
+
+def write_verified(path, verified):
+    with open(path + ".new", "w") as fh:
+        for filename, (size, mtime, checksum) in sorted(verified.items()):
+            print("%d %d %s  %s" % (size, mtime, checksum, filename), file=fh)
+    os.replace(path + ".new", path)
+
+
+def verify_downloads(md5_file, checksums_file, sizes_file, verified_file, target_dir, jobs, fast=False):
+    # Checks downloaded files against the manifest, without the network,
+    # hashing up to jobs files at once. With fast, a file is failed without
+    # hashing if its size differs from the manifest, and passed without
+    # hashing if its size and modification time are unchanged since it was
+    # last verified
+    # Returns True if all files are valid
+    md5 = read_checksums(md5_file, checksums_file)
+    sizes = read_sizes(sizes_file) if fast else {}
+    previous = read_verified(verified_file)
+    verified = {}
+    counts = Counter({"valid": 0, "invalid": 0, "missing": 0, "unchanged": 0, "hashed": 0})
+
+    logger.info("Verifying %d files listed in %s" % (len(md5), md5_file))
+    to_hash = []
+    for filename, checksum in md5.items():
+        dl_path = local_path(target_dir, filename)
+        try:
+            st = os.stat(dl_path)
+        except OSError:
+            logger.warning(f"MISSING {filename}")
+            counts["missing"] += 1
+            events.emit("done", file=filename, status="failed", bytes=0)
+            continue
+        record = (st.st_size, int(st.st_mtime), checksum)
+        if fast and filename in sizes and sizes[filename] != st.st_size:
+            logger.warning(f"FAILED size of {filename} is {st.st_size}, not {sizes[filename]}")
+            counts["invalid"] += 1
+            events.emit("done", file=filename, status="invalid", bytes=st.st_size)
+        elif fast and previous.get(filename) == record:
+            logger.info(f"VALID {filename} is unchanged since verified")
+            counts["valid"] += 1
+            counts["unchanged"] += 1
+            verified[filename] = record
+            events.emit("done", file=filename, status="valid", bytes=st.st_size)
+        else:
+            to_hash.append((filename, dl_path, checksum, record))
+
+    # hashlib releases the GIL while hashing, so threads hash in parallel
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(lambda t: check_md5sum(t[1], t[2]), to_hash)
+        for (filename, dl_path, checksum, record), valid in zip(to_hash, results):
+            counts["hashed"] += 1
+            counts["valid" if valid else "invalid"] += 1
+            if valid:
+                verified[filename] = record
+            events.emit("done", file=filename, status="valid" if valid else "invalid", bytes=record[0])
+
+    write_verified(verified_file, verified)
+
+    logger.info("-----------")
+    logger.info("Verification summary: %s" % (str(dict(counts)),))
+    events.emit("summary", manifest=os.path.basename(md5_file), counts=dict(counts))
+    if counts["valid"] == len(md5):
+        logger.info("All files verified.")
+        return True
+    logger.warning(
+        "%d missing and %d corrupted files, run without --verify-only or --fast-verify to download them"
+        % (counts["missing"], counts["invalid"])
+    )
+    return False
+
 
 logger = make_logger(__name__)
 
@@ -0,0 +1,327 @@
+import datetime
+import json
+import re
+import ckan.plugins as p
+from ckan.plugins.toolkit import config
+from ckan.logic import get_action
+from .timing import stage, current_timer
+
+# request parameters which control the bulk download rather than the search
+RESERVED_PARAMS = [
+    "q",
+    "page",
+    "sort",
+    "profile",
+    "since",
+    "layout",
+    "direct",
+    "optional",
+]
+
+# indexed with each package by the plugin: the total size of its resources
+SIZE_FIELD = "bulk_size"
+
+# ids or names looked up per search: each is two clauses of the query,
+# and Solr refuses queries of more than `maxBooleanClauses` (default 1024)
+ID_BATCH_SIZE = 500
+
+# the prefix of an earlier archive, e.g. bpa_1a2b3c4d_20240101T0930Z, which
+# ends with the UTC time its packages were searched for, to the minute
+PREFIX_RE = re.compile(r"^bpa_[0-9a-f]{8}_(\d{8}T\d{4})Z$")
+
+# as metadata_modified is stored by CKAN: UTC, without a timezone
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def search_filters(params):
+    """
+    split request parameters into a filter query and search extras,
+    in the same manner as the dataset search page
+    """
+    fq = ""
+    search_extras = {}
+    for (param, value) in list(params.items()):
+        if (
+            param not in RESERVED_PARAMS
+            and len(value)
+            and not param.startswith("_")
+        ):
+            if not param.startswith("ext_"):
+                fq += ' %s:"%s"' % (param, value)
+            else:
+                search_extras[param] = value
+    return fq, search_extras
+
+
+def parse_since(value):
+    """
+    the UTC cut-off for a delta download, from either a timestamp (UTC
+    unless it has an offset) or the prefix of an earlier archive (the
+    time its search was made, rounded down to the minute, so that nothing
+    modified while it was being built is missed). Raises ValueError if
+    `value` is neither.
+    """
+    value = value.strip()
+    match = PREFIX_RE.match(value)
+    if match:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%dT%H%M")
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    since = datetime.datetime.fromisoformat(value)
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def utc_now():
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+
+def format_since(since):
+    return since.strftime(TIMESTAMP_FORMAT) + "Z"
+
+
+def since_filter(since):
+    """
+    filter query matching packages modified at or after `since`
+    """
+    return "+metadata_modified:[%s TO *]" % (format_since(since),)
+
+
+def changed_since(packages, since):
+    """
+    the packages modified at or after `since`, with only those of their
+    resources modified (or created) at or after `since`. Packages are
+    filtered as they are read, so `packages` may be a generator.
+    """
+    if since is None:
+        yield from packages
+        return
+    cut_off = since.strftime(TIMESTAMP_FORMAT)
+    for package in packages:
+        if package.get("metadata_modified", cut_off) < cut_off:
+            continue
+        resources = [
+            resource
+            for resource in package["resources"]
+            if (resource.get("metadata_modified") or resource.get("created") or cut_off)
+            >= cut_off
+        ]
+        yield dict(package, resources=resources)
+
+
+def search_data_dict(params, limit, fq="", since=None, sort=None, start=0):
+    """
+    build a `package_search` data dict for `limit` packages matched by the
+    query in `params`, optionally restricted by an additional filter query
+    and to packages modified since a cut-off, in the given sort order and
+    from the given offset
+    """
+    params_fq, search_extras = search_filters(params)
+    if since is not None:
+        fq = "%s %s" % (fq, since_filter(since))
+    data_dict = {
+        "q": params.get("q", ""),
+        "fq": (fq + params_fq).strip(),
+        "facet.field": [],
+        "rows": limit,
+        "start": start,
+        "extras": search_extras,
+        "include_private": p.toolkit.asbool(
+            config.get("ckan.search.default_include_private", True)
+        ),
+    }
+    if sort:
+        data_dict["sort"] = sort
+    return data_dict
+
+
+def ids_filter(ids):
+    """
+    filter query matching packages by id or name
+    """
+    terms = " OR ".join('"%s"' % (t,) for t in ids)
+    return "+(id:(%s) OR name:(%s))" % (terms, terms)
+
+
+def id_batches(ids):
+    # `ids` in batches small enough to be searched for at once
+    ids = list(ids)
+    for i in range(0, len(ids), ID_BATCH_SIZE):
+        yield ids[i : i + ID_BATCH_SIZE]
+
+
+def ids_data_dicts(ids, since=None):
+    """
+    `package_search` data dicts matching packages by id or name, each for a
+    batch of the ids, optionally restricted to packages modified since a
+    cut-off
+    """
+    return [
+        search_data_dict({}, len(batch), fq=ids_filter(batch), since=since)
+        for batch in id_batches(ids)
+    ]
+
+
+def page_size():
+    # rows fetched per search request; CKAN refuses more than
+    # `ckan.search.rows_max` (default 1000)
+    return max(1, p.toolkit.asint(config.get("ckanext.bulk.page_size", 1000)))
+
+
+def search_pages(context, data_dict):
+    """
+    the results of a search a page at a time, up to the search's `rows`
+    from its `start`
+    """
+    start = data_dict.get("start", 0)
+    end = start + data_dict["rows"]
+    while start < end:
+        rows = min(page_size(), end - start)
+        results = get_action("package_search")(
+            dict(context), dict(data_dict, start=start, rows=rows)
+        )["results"]
+        if results:
+            yield results
+        if len(results) < rows:
+            return
+        start += rows
+
+
+@stage("fingerprint")
+def index_fingerprint(context, data_dict):
+    """
+    (id, metadata_modified) pairs for the packages matched by a search,
+    read from the search index only: sorted, unless the search is, as
+    the order of the packages is then that of the archive's members
+    """
+    data_dict = dict(data_dict, fl=["id", "metadata_modified"])
+    pairs = [
+        (result["id"], result.get("metadata_modified", ""))
+        for results in search_pages(context, data_dict)
+        for result in results
+    ]
+    return pairs if data_dict.get("sort") else sorted(pairs)
+
+
+def iter_packages(context, data_dict):
+    """
+    package dicts for a search, loaded from the validated data dict
+    serialized into the search index rather than dictized by plugins;
+    packages without a stored data dict fall back to `package_show`.
+    Pages are fetched as the packages are consumed, so that only one
+    page is held at a time.
+    """
+    pages = search_pages(context, dict(data_dict, fl=["id", "validated_data_dict"]))
+    while True:
+        with current_timer().stage("search"):
+            results = next(pages, None)
+            if results is None:
+                return
+            packages = []
+            for result in results:
+                stored = result.get("validated_data_dict")
+                if stored:
+                    packages.append(json.loads(stored))
+                else:
+                    packages.append(
+                        get_action("package_show")(dict(context), {"id": result["id"]})
+                    )
+        yield from packages
+
+
+def ids_fingerprint(context, data_dicts):
+    # the fingerprint of the packages matched by any of the searches
+    return sorted(
+        set(
+            pair
+            for data_dict in data_dicts
+            for pair in index_fingerprint(context, data_dict)
+        )
+    )
+
+
+def index_packages(context, data_dict):
+    # all of the packages at once, for callers which need them together
+    return list(iter_packages(context, data_dict))
+
+
+def iter_packages_by_id(context, ids, since=None):
+    """
+    package dicts for the given ids or names, in order, loaded from the
+    search index where possible, a batch of ids at a time. Raises NotFound
+    via `package_show` for packages which are not in the index and do not
+    exist. If `since` is given, only packages modified since then are
+    returned, and those not matched by the search are skipped rather than
+    looked up.
+    """
+    for batch in id_batches(ids):
+        found = {}
+        data_dict = search_data_dict({}, len(batch), fq=ids_filter(batch), since=since)
+        for package in iter_packages(context, data_dict):
+            found[package["id"]] = package
+            found[package["name"]] = package
+        for _id in batch:
+            package = found.get(_id)
+            if package is None:
+                if since is not None:
+                    continue
+                package = get_action("package_show")(dict(context), {"id": _id})
+            yield package
+
+
+def index_packages_by_id(context, ids, since=None):
+    return list(iter_packages_by_id(context, ids, since))
+
+
+def facet_total(facet):
+    # sum of value * count over a facet of numeric values
+    total = 0
+    for value, count in facet.items():
+        try:
+            total += float(value) * count
+        except ValueError:
+            pass
+    return total
+
+
+@stage("estimate")
+def index_estimate(context, data_dict):
+    """
+    estimated package, resource and byte counts for a search, computed
+    from facets over the search index without fetching any rows
+    """
+    if data_dict is None:
+        return {"count": 0, "packages": 0, "resources": 0, "size": 0}
+    limit = data_dict["rows"]
+    data_dict = dict(
+        data_dict,
+        rows=0,
+        **{
+            "facet.field": ["num_resources", SIZE_FIELD],
+            "facet.limit": -1,
+            "facet.mincount": 1,
+        }
+    )
+    result = get_action("package_search")(dict(context), data_dict)
+    count = result["count"]
+    packages = max(0, min(count - data_dict.get("start", 0), limit))
+    # only `limit` packages (from `start`) are included in an archive, so
+    # scale the totals when the search matches more than that
+    scale = float(packages) / count if count else 0
+    facets = result.get("facets", {})
+    return {
+        "count": count,
+        "packages": packages,
+        "resources": int(round(facet_total(facets.get("num_resources", {})) * scale)),
+        "size": int(round(facet_total(facets.get(SIZE_FIELD, {})) * scale)),
+    }
+
+
+def ids_estimate(context, data_dicts):
+    # the estimates of each of the searches, summed
+    estimate = index_estimate(context, None)
+    for data_dict in data_dicts:
+        for key, value in index_estimate(context, data_dict).items():
+            estimate[key] += value
+    return estimate
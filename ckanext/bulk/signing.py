@@ -0,0 +1,146 @@
+import importlib
+import logging
+import re
+import time
+from urllib.parse import urlparse
+import ckan.plugins.toolkit as tk
+from ckan import model
+from ckan.common import request, c
+from ckan.plugins.toolkit import config
+from ckan.logic import NotAuthorized, NotFound, check_access
+
+
+log = logging.getLogger(__name__)
+
+# the path of a resource download URL on this portal
+RESOURCE_URL_RE = re.compile(
+    r"/dataset/(?P<package_id>[^/]+)/resource/(?P<id>[^/]+)/download/(?P<filename>[^/]+)$"
+)
+
+
+def signed_url_expiry():
+    # seconds; S3 presigned URLs are valid for at most a week
+    return tk.asint(config.get("ckanext.bulk.signed_url_expiry", 24 * 60 * 60))
+
+
+def load_signer():
+    """
+    the configured URL signer, `ckanext.bulk.url_signer` as `module:callable`.
+    A signer is called with a list of resources (dicts of id, package_id,
+    filename and url) and an expiry in seconds, and returns a dict mapping
+    the URL of each resource it signs to the signed URL.
+    """
+    name = config.get("ckanext.bulk.url_signer")
+    if not name:
+        return None
+    module, _, attr = name.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def s3_client():
+    # boto3 is only required if S3 storage is configured
+    import boto3
+    from botocore.client import Config
+
+    return boto3.client(
+        "s3",
+        endpoint_url=config.get("ckanext.bulk.s3.endpoint_url") or None,
+        region_name=config.get("ckanext.bulk.s3.region_name") or None,
+        # otherwise, from the usual boto3 environment and configuration
+        aws_access_key_id=config.get("ckanext.bulk.s3.access_key_id") or None,
+        aws_secret_access_key=config.get("ckanext.bulk.s3.secret_access_key") or None,
+        config=Config(signature_version="s3v4"),
+    )
+
+
+def s3_key(resource):
+    """
+    the object key of a resource (a dict of id, package_id and filename)
+    """
+    key_template = config.get("ckanext.bulk.s3.key_template", "resources/{id}/{filename}")
+    return key_template.format(**resource)
+
+
+def portal_resource(url):
+    """
+    the id, package_id and filename of a resource download URL on this
+    portal, or None
+    """
+    match = RESOURCE_URL_RE.search(urlparse(url).path)
+    if match is None:
+        return None
+    return match.groupdict()
+
+
+def s3_signer(resources, expires_in):
+    """
+    presign requests for resources held in S3-compatible object storage
+    (e.g. by ckanext-s3filestore, or MinIO) with boto3
+    """
+    client = s3_client()
+    bucket = config.get("ckanext.bulk.s3.bucket")
+
+    signed = {}
+    for resource in resources:
+        signed[resource["url"]] = client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": s3_key(resource)},
+            ExpiresIn=expires_in,
+        )
+    return signed
+
+
+def signing_requested():
+    # direct downloads were requested (`direct=1`), and a signer is configured
+    return (
+        tk.asbool(request.params.get("direct", False)) and load_signer() is not None
+    )
+
+
+def signing_window():
+    """
+    if URLs are being signed, the number of the current period of half
+    their expiry, so that an archive (and its ETag) changes while at least
+    half the life of the signed URLs it holds remains; otherwise None
+    """
+    if not signing_requested():
+        return None
+    return int(time.time() // max(1, signed_url_expiry() // 2))
+
+
+def url_signer(required):
+    """
+    if direct downloads were requested (`direct=1`) and a signer is
+    configured, a function mapping a list of URLs to signed URLs for the
+    portal resources among them which the current user may read. Those of
+    packages which need membership of an organization (`required`, by
+    package id or name) are left unsigned.
+    """
+    if not tk.asbool(request.params.get("direct", False)):
+        return None
+    signer = load_signer()
+    if signer is None:
+        return None
+
+    site_url = config.get("ckan.site_url").rstrip("/")
+    expires_in = signed_url_expiry()
+    # the requesting user, even when the packages were found as another
+    context = {"model": model, "user": c.user, "auth_user_obj": c.userobj}
+
+    def sign(urls):
+        resources = []
+        for url in urls:
+            if not url.startswith(site_url + "/"):
+                continue
+            resource = portal_resource(url)
+            if resource is None or resource["package_id"] in required:
+                continue
+            try:
+                check_access("resource_show", dict(context), {"id": resource["id"]})
+            except (NotAuthorized, NotFound):
+                # left to the portal, which will refuse it
+                continue
+            resources.append(dict(resource, url=url))
+        return signer(resources, expires_in)
+
+    return sign
@@ -0,0 +1,38 @@
+import errno
+import os
+import stat
+import tempfile
+from ckan.plugins.toolkit import config
+
+
+def private_directory(directory):
+    """
+    `directory`, created (with its parents) accessible only by the user
+    this process runs as if it does not exist. Raises OSError if it is
+    not a directory owned by that user, or if others may write to it, as
+    its contents would then not be trustworthy.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError(errno.ENOTDIR, "not a directory", directory)
+    if st.st_uid != os.getuid():
+        raise OSError(errno.EPERM, "not owned by this process's user", directory)
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(errno.EPERM, "writable by other users", directory)
+    return directory
+
+
+def storage_directory(*components):
+    """
+    a directory under CKAN's `ckan.storage_path`, or None if it is not set
+    """
+    storage_path = config.get("ckan.storage_path")
+    if not storage_path:
+        return None
+    return os.path.join(storage_path, "ckanext-bulk", *components)
+
+
+def user_temp_directory():
+    # named for the user, so that other users' directories do not collide
+    return os.path.join(tempfile.gettempdir(), "ckanext-bulk-%d" % (os.getuid(),))
@@ -0,0 +1,318 @@
+import functools
+import importlib
+import logging
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bitmath
+import ckan.plugins.toolkit as tk
+from flask import Response, stream_with_context
+from ckan import model
+from ckan.common import c
+from ckan.plugins.toolkit import config
+from ckan.lib.base import abort
+from ckan.logic import NotAuthorized, NotFound, check_access
+from .timing import current_timer
+from .admission import release_on_close
+from .access import required_organizations
+from .signing import portal_resource, s3_client, s3_key
+from .zipoutput import MD5SUM_FNAME, build_manifest, size_or_none
+from . import metrics
+
+_ = tk._
+
+
+log = logging.getLogger(__name__)
+
+# bytes read from a file streamed in chunks, rather than read ahead whole
+CHUNK_SIZE = 1024 * 1024
+
+
+def tar_enabled():
+    return tk.asbool(config.get("ckanext.bulk.tar_enabled", False))
+
+
+def tar_max_bytes():
+    return tk.asint(config.get("ckanext.bulk.tar_max_bytes", 4 * 1024 * 1024 * 1024))
+
+
+def load_opener():
+    """
+    the configured resource opener, `ckanext.bulk.tar_opener` as
+    `module:callable`. An opener is called with a resource dict, and
+    returns its size and a binary file object to read it from, or None if
+    it is not held in storage the opener can read.
+    """
+    name = config.get("ckanext.bulk.tar_opener", "ckanext.bulk.tarstream:upload_opener")
+    module, _, attr = name.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def upload_opener(resource):
+    """
+    open resources uploaded to CKAN's own (filesystem) storage
+    """
+    from ckan.lib.uploader import get_resource_uploader
+
+    if resource.get("url_type") != "upload":
+        return None
+    uploader = get_resource_uploader(resource)
+    if not hasattr(uploader, "get_path"):
+        return None
+    try:
+        fd = open(uploader.get_path(resource["id"]), "rb")
+    except (IOError, OSError):
+        return None
+    return os.fstat(fd.fileno()).st_size, fd
+
+
+@functools.lru_cache(maxsize=1)
+def shared_s3_client():
+    # boto3 clients are thread safe, and slow to create
+    return s3_client()
+
+
+def s3_opener(resource):
+    """
+    open resources held in S3-compatible object storage, as configured for
+    signed URLs (see `signing.s3_signer`)
+    """
+    from botocore.exceptions import ClientError
+
+    location = portal_resource(resource["url"])
+    if location is None:
+        return None
+    try:
+        response = shared_s3_client().get_object(
+            Bucket=config.get("ckanext.bulk.s3.bucket"), Key=s3_key(location)
+        )
+    except ClientError:
+        return None
+    return response["ContentLength"], response["Body"]
+
+
+def readable_resources(entries, required):
+    """
+    the (path, resource) entries which the current user may read, and the
+    (path, resource, reason) of those they may not, including those of
+    packages which need membership of an organization (`required`, by
+    package id)
+    """
+    context = {"model": model, "user": c.user, "auth_user_obj": c.userobj}
+    readable = []
+    refused = []
+    for path, resource in entries:
+        required_org = required.get(resource.get("package_id"))
+        if required_org:
+            refused.append(
+                (path, resource, "requires membership of %s" % (required_org,))
+            )
+            continue
+        try:
+            check_access("resource_show", dict(context), {"id": resource["id"]})
+        except (NotAuthorized, NotFound):
+            refused.append((path, resource, "not authorized"))
+            continue
+        readable.append((path, resource))
+    return readable, refused
+
+
+def read_exactly(fileobj, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = fileobj.read(remaining)
+        if not chunk:
+            raise IOError("file is shorter than its size")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    # pax headers carry long names and sizes over 8 GiB
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def tar_padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def tar_member(name, data, mtime):
+    return tar_header(name, len(data), mtime) + data + tar_padding(len(data))
+
+
+def discard(future):
+    # close a file opened ahead of its turn
+    if not future.cancelled() and future.exception() is None:
+        fetched = future.result()
+        if fetched is not None and fetched[1] is not None:
+            fetched[1].close()
+
+
+def tar_stream(prefix, entries, refused, opener, jobs, read_ahead, max_bytes):
+    """
+    the bytes of a tar archive of the (path, resource) entries, under a
+    `prefix` directory. Up to `jobs` files are opened (and those of at most
+    `read_ahead / jobs` bytes read) ahead of the one being sent, so at most
+    `read_ahead` bytes are buffered; larger files are sent as they are
+    read. The MD5 list of the files sent, and the files which could not be
+    (with `refused`), follow them.
+    """
+    limit = max(CHUNK_SIZE, read_ahead // jobs)
+    mtime = int(time.time())
+    md5_attribute = config.get("ckanext.bulk.md5_attribute", "md5")
+
+    def fetch(resource):
+        opened = opener(resource)
+        if opened is None:
+            return None
+        size, fileobj = opened
+        if size > limit:
+            return size, fileobj, None
+        try:
+            return size, None, read_exactly(fileobj, size)
+        finally:
+            fileobj.close()
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    pending = deque()
+    remaining = iter(entries)
+    md5sums = []
+    skipped = list(refused)
+    sent = 0
+    try:
+        while True:
+            while len(pending) < jobs:
+                entry = next(remaining, None)
+                if entry is None:
+                    break
+                pending.append((entry, executor.submit(fetch, entry[1])))
+            if not pending:
+                break
+
+            (path, resource), future = pending.popleft()
+            try:
+                fetched = future.result()
+            except Exception as exception:
+                log.warning("Unable to read %s: %s", resource["url"], exception)
+                fetched = None
+            if fetched is None:
+                skipped.append((path, resource, "not available"))
+                metrics.stream_files_total.inc(result="skipped")
+                continue
+
+            size, fileobj, data = fetched
+            sent += size
+            if sent > max_bytes:
+                if fileobj is not None:
+                    fileobj.close()
+                raise IOError("bulk tar archive exceeds %d bytes" % (max_bytes,))
+            yield tar_header("%s/%s" % (prefix, path), size, mtime)
+            if data is not None:
+                yield data
+            else:
+                try:
+                    left = size
+                    while left:
+                        chunk = fileobj.read(min(CHUNK_SIZE, left))
+                        if not chunk:
+                            # the header promised more: fail the transfer
+                            # rather than send a corrupt archive
+                            raise IOError("%s is shorter than its size" % (path,))
+                        left -= len(chunk)
+                        yield chunk
+                finally:
+                    fileobj.close()
+            yield tar_padding(size)
+            metrics.stream_bytes_total.inc(size)
+            metrics.stream_files_total.inc(result="streamed")
+            if resource.get(md5_attribute):
+                md5sums.append((resource[md5_attribute], path))
+
+        yield tar_member(
+            "%s/%s" % (prefix, MD5SUM_FNAME.format(prefix=prefix)),
+            "".join("%s  %s\n" % t for t in md5sums).encode("utf-8"),
+            mtime,
+        )
+        if skipped:
+            yield tar_member(
+                "%s/SKIPPED.txt" % (prefix,),
+                "".join(
+                    "%s (%s)\n    %s\n" % (path, reason, resource["url"])
+                    for path, resource, reason in skipped
+                ).encode("utf-8"),
+                mtime,
+            )
+        # end of archive
+        yield b"\0" * (2 * tarfile.BLOCKSIZE)
+    finally:
+        # the client may have gone: release what was read ahead
+        for entry, future in pending:
+            future.cancel()
+            future.add_done_callback(discard)
+        executor.shutdown(wait=False)
+
+
+def generate_bulk_tar(pfx, packages, layout="flat", optional=False):
+    """
+    a streamed tar archive of the contents of the packages' resources
+    which the current user may read, in the directory layout, with the
+    optional files if requested
+    """
+    timer = current_timer()
+    # all at once: the archive's size is checked before it is started
+    packages = list(packages)
+    resources = [resource for package in packages for resource in package["resources"]]
+
+    with timer.stage("manifest"):
+        manifest = build_manifest(resources, packages, layout)
+    by_url = {resource["url"]: resource for resource in resources}
+    entries = list(zip(manifest["urls"], manifest["paths"]))
+    if optional:
+        entries.extend(zip(manifest["urls_optional"], manifest["paths_optional"]))
+    entries = [(path, by_url[url]) for url, path in entries]
+
+    max_bytes = tar_max_bytes()
+    total_size_bytes = sum(
+        size_or_none(resource.get("size")) or 0 for path, resource in entries
+    )
+    if total_size_bytes > max_bytes:
+        limit = bitmath.Byte(bytes=max_bytes).best_prefix().format("{value:.2f} {unit}")
+        abort(
+            413,
+            _(
+                "This download is larger than %s, the limit for a single archive: please use the download scripts instead"
+            )
+            % (limit,),
+        )
+
+    required = required_organizations(c.userobj, packages)
+    with timer.stage("access"):
+        entries, refused = readable_resources(entries, required)
+    timer.facts.update(
+        packages_streamed=len(packages),
+        files=len(entries),
+        refused=len(refused),
+        bytes_expected=total_size_bytes,
+    )
+
+    jobs = max(1, tk.asint(config.get("ckanext.bulk.tar_jobs", 4)))
+    read_ahead = tk.asint(config.get("ckanext.bulk.tar_read_ahead", 64 * 1024 * 1024))
+    response = Response(
+        stream_with_context(
+            tar_stream(
+                pfx, entries, refused, load_opener(), jobs, read_ahead, max_bytes
+            )
+        ),
+        mimetype="application/x-tar",
+        headers={"Content-Disposition": str('attachment; filename="%s.tar"' % pfx)},
+        direct_passthrough=True,
+    )
+    return release_on_close(response)
@@ -0,0 +1,26 @@
+import os
+import sys
+import types
+
+REPO = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+
+try:
+    import ckan.plugins  # noqa: F401
+except ImportError:
+    # outside of a CKAN instance, use the stand-in CKAN and
+    # ckanext-scheming modules from the benchmarks
+    sys.path.insert(0, os.path.join(REPO, "benchmarks"))
+    from bench_bulk import install_stand_ins
+
+    install_stand_ins()
+
+    # and of the group view helpers, which the blueprint imports
+    group = types.ModuleType("ckan.views.group")
+    group._db_to_form_schema = lambda group_type=None: None
+    group._action = lambda name: name
+    group._guess_group_type = lambda expecting_name=False: "organization"
+    sys.modules["ckan.views"] = types.ModuleType("ckan.views")
+    sys.modules["ckan.views"].group = group
+    sys.modules["ckan.views.group"] = group
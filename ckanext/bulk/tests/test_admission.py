@@ -0,0 +1,170 @@
+import threading
+import types
+import pytest
+from flask import Flask, g
+from ckanext.bulk import admission
+
+
+@pytest.fixture
+def lock_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(admission.config, "ckanext.bulk.lock_dir", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def bulk_request(lock_dir, monkeypatch):
+    """
+    make requests as a user, releasing the slots they take
+    """
+    app = Flask(__name__)
+
+    def as_user(name):
+        userobj = types.SimpleNamespace(name=name, sysadmin=False)
+        monkeypatch.setattr(admission, "c", types.SimpleNamespace(userobj=userobj))
+
+    with app.test_request_context():
+        g.bulk_slots = []
+        as_user("alice")
+        yield as_user
+        for fd in g.bulk_slots:
+            admission.release_slot(fd)
+
+
+def test_slots(lock_dir):
+    first = admission.acquire_slot("test", 2)
+    second = admission.acquire_slot("test", 2)
+    assert None not in (first, second)
+    assert admission.acquire_slot("test", 2) is None
+
+    admission.release_slot(first)
+    third = admission.acquire_slot("test", 2)
+    assert third is not None
+    for fd in (second, third):
+        admission.release_slot(fd)
+
+
+def test_build_lock(lock_dir):
+    key = "0123456789abcdef"
+    with admission.build_lock(key, 1) as waited:
+        assert not waited
+        # held by another worker: wait for it, then proceed without it
+        with admission.build_lock(key, 0.2) as waited:
+            assert waited
+    with admission.build_lock(key, 0) as waited:
+        assert not waited
+
+
+def test_lock_dir_must_be_private(lock_dir):
+    lock_dir.chmod(0o777)
+    with pytest.raises(OSError):
+        admission.acquire_slot("test", 1)
+
+
+def test_too_many_per_user(bulk_request, monkeypatch):
+    monkeypatch.setitem(admission.config, "ckanext.bulk.max_concurrent_per_user", "1")
+    monkeypatch.setitem(admission.config, "ckanext.bulk.retry_after", "7")
+    assert admission.admit() is None
+    response = admission.admit()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+
+    # others are admitted
+    bulk_request("bob")
+    assert admission.admit() is None
+
+
+def test_too_many_in_total(bulk_request, monkeypatch):
+    monkeypatch.setitem(admission.config, "ckanext.bulk.max_concurrent", "1")
+    assert admission.admit() is None
+    bulk_request("bob")
+    response = admission.admit()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "30"
+    # streams are limited separately from builds
+    assert admission.admit_stream() is None
+
+
+class CountingEvent(threading.Event):
+    # counts waiters, so that a test knows when callers are waiting
+    waiting = threading.Semaphore(0)
+
+    def wait(self, timeout=None):
+        self.waiting.release()
+        return super(CountingEvent, self).wait(timeout)
+
+
+class CountingSingleFlight(admission.SingleFlight):
+    class Call(admission.SingleFlight.Call):
+        def __init__(self):
+            super(CountingSingleFlight.Call, self).__init__()
+            self.done = CountingEvent()
+
+
+def coalesced(fn, followers=3):
+    """
+    call `fn` through a SingleFlight from a leader and `followers` which
+    wait for it, returning the results or exceptions of each
+    """
+    flight = CountingSingleFlight()
+    started = threading.Event()
+    finish = threading.Event()
+    results = []
+
+    def leader_fn():
+        started.set()
+        finish.wait()
+        return fn()
+
+    def call(fn):
+        try:
+            results.append(flight.do("key", fn))
+        except Exception as exception:
+            results.append(exception)
+
+    leader = threading.Thread(target=call, args=(leader_fn,))
+    leader.start()
+    started.wait()
+    threads = [
+        threading.Thread(target=call, args=(pytest.fail,)) for _ in range(followers)
+    ]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        CountingEvent.waiting.acquire()
+    finish.set()
+    for thread in [leader] + threads:
+        thread.join()
+    assert flight.calls == {}
+    return results
+
+
+def test_single_flight_shares_one_call():
+    calls = []
+
+    def build():
+        calls.append(1)
+        return "members"
+
+    results = coalesced(build)
+    assert len(calls) == 1
+    assert sorted(results) == [
+        ("members", False),
+        ("members", True),
+        ("members", True),
+        ("members", True),
+    ]
+
+
+def test_single_flight_shares_exceptions():
+    error = ValueError("failed")
+
+    def build():
+        raise error
+
+    assert coalesced(build) == [error] * 4
+
+
+def test_single_flight_runs_again_once_done():
+    flight = admission.SingleFlight()
+    assert flight.do("key", lambda: 1) == (1, False)
+    assert flight.do("key", lambda: 2) == (2, False)
@@ -0,0 +1,149 @@
+import datetime
+import types
+import pytest
+from flask import Flask
+from werkzeug.datastructures import ETags
+from ckanext.bulk import blueprint, signing
+from ckanext.bulk.search import parse_since
+
+FINGERPRINT = [("package-1", "2024-01-01T00:00:00"), ("package-2", "2024-01-02T00:00:00")]
+
+
+def user(name, sysadmin=False):
+    return types.SimpleNamespace(name=name, sysadmin=sysadmin)
+
+
+@pytest.fixture
+def bulk_request(monkeypatch):
+    """
+    set the parameters (and If-None-Match ETags) of the current request
+    """
+    app = Flask(__name__)
+
+    def set_request(params=None, if_none_match=()):
+        fake = types.SimpleNamespace(
+            path="/bulk/dataset/file_list",
+            params=dict(params or {}),
+            if_none_match=ETags(list(if_none_match)),
+        )
+        monkeypatch.setattr(blueprint, "request", fake)
+        monkeypatch.setattr(signing, "request", fake)
+
+    with app.test_request_context():
+        set_request()
+        yield set_request
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=1700000000.0)
+    monkeypatch.setattr(signing, "time", types.SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def test_conditional_get(bulk_request):
+    etag = blueprint.bulk_etag(user("alice"), [{"name": "org-1"}], FINGERPRINT)
+    assert blueprint.not_modified(etag) is None
+
+    bulk_request({}, [etag])
+    response = blueprint.not_modified(etag)
+    assert response.status_code == 304
+    assert response.get_etag() == (etag, False)
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+    bulk_request({}, ["something-else"])
+    assert blueprint.not_modified(etag) is None
+
+
+def test_etag_changes_with_packages_and_users(bulk_request):
+    etag = blueprint.bulk_etag(user("alice"), [{"name": "org-1"}], FINGERPRINT)
+    others = [
+        # a package is modified
+        blueprint.bulk_etag(
+            user("alice"),
+            [{"name": "org-1"}],
+            FINGERPRINT[:1] + [("package-2", "2024-01-03T00:00:00")],
+        ),
+        # a package is added
+        blueprint.bulk_etag(
+            user("alice"), [{"name": "org-1"}], FINGERPRINT + [("package-3", "")]
+        ),
+        # another user, with the same and with other memberships
+        blueprint.bulk_etag(user("bob"), [{"name": "org-1"}], FINGERPRINT),
+        blueprint.bulk_etag(user("alice"), [{"name": "org-2"}], FINGERPRINT),
+        blueprint.bulk_etag(
+            user("alice", sysadmin=True), [{"name": "org-1"}], FINGERPRINT
+        ),
+        blueprint.bulk_etag(None, None, FINGERPRINT),
+    ]
+    assert len(set(others + [etag])) == len(others) + 1
+    # memberships are compared whatever their order
+    assert (
+        blueprint.bulk_etag(
+            user("alice"), [{"name": "org-2"}, {"name": "org-1"}], FINGERPRINT
+        )
+        == blueprint.bulk_etag(
+            user("alice"), [{"name": "org-1"}, {"name": "org-2"}], FINGERPRINT
+        )
+    )
+
+    bulk_request({"q": "soil"})
+    assert blueprint.bulk_etag(user("alice"), [{"name": "org-1"}], FINGERPRINT) != etag
+
+
+def test_etag_changes_before_signed_urls_expire(bulk_request, clock, monkeypatch):
+    monkeypatch.setattr(signing, "load_signer", lambda: lambda resources, expires_in: {})
+    monkeypatch.setattr(signing, "signed_url_expiry", lambda: 3600)
+    bulk_request({"direct": "1"})
+    clock.value = 7200 * 1000
+    etag = blueprint.bulk_etag(user("alice"), [], FINGERPRINT)
+
+    clock.value += 1799
+    assert blueprint.bulk_etag(user("alice"), [], FINGERPRINT) == etag
+    bulk_request({"direct": "1"}, [etag])
+    assert blueprint.not_modified(etag).status_code == 304
+
+    # half the URLs' life has gone: the archive is rebuilt
+    clock.value += 1
+    changed = blueprint.bulk_etag(user("alice"), [], FINGERPRINT)
+    assert changed != etag
+    assert blueprint.not_modified(changed) is None
+
+
+def test_etag_without_signing_does_not_expire(bulk_request, clock, monkeypatch):
+    monkeypatch.setattr(signing, "load_signer", lambda: None)
+    bulk_request({"direct": "1"})
+    etag = blueprint.bulk_etag(user("alice"), [], FINGERPRINT)
+    clock.value += 10 * 24 * 60 * 60
+    assert blueprint.bulk_etag(user("alice"), [], FINGERPRINT) == etag
+
+
+def test_prefix_is_the_since_of_the_next_download():
+    searched_at = datetime.datetime(2024, 1, 2, 3, 4, 59)
+    prefix = blueprint.dataset_to_zip_prefix("package-1", searched_at)
+    assert prefix.endswith("_20240102T0304Z")
+    # rounded down, so that nothing modified after the search is missed
+    assert parse_since(prefix) == datetime.datetime(2024, 1, 2, 3, 4)
+
+
+class Aborted(Exception):
+    pass
+
+
+def raise_aborted(status_code, detail=None):
+    raise Aborted(status_code)
+
+
+@pytest.mark.parametrize("page", ["0", "-1", "two"])
+def test_invalid_page(bulk_request, monkeypatch, page):
+    monkeypatch.setattr(blueprint, "abort", raise_aborted)
+    bulk_request({"page": page})
+    with pytest.raises(Aborted) as aborted:
+        blueprint.page_param()
+    assert aborted.value.args == (400,)
+
+
+def test_page(bulk_request):
+    assert blueprint.page_param() == 1
+    bulk_request({"page": "3"})
+    assert blueprint.page_param() == 3
@@ -0,0 +1,150 @@
+import io
+import os
+import sys
+import time
+import zipfile
+import pytest
+from ckanext.bulk import membercache
+from ckanext.bulk.membercache import (
+    cache_get,
+    cache_put,
+    cache_touch,
+    can_splice,
+    compress_member,
+    write_compressed,
+)
+
+CONTENTS = {
+    "README.txt": "A bulk download\n",
+    "urls.txt": "".join("https://data.example.org/%d.csv\n" % i for i in range(1000)),
+    "empty.txt": "",
+}
+
+
+class Unseekable(io.RawIOBase):
+    # a write-only stream, as a response being sent is
+    def __init__(self):
+        self.written = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.written.write(data)
+
+
+def build_zip(fileobj):
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zf:
+        spliced = can_splice(zf)
+        for name, data in CONTENTS.items():
+            write_compressed(zf, name, compress_member(name, data))
+        zf.writestr("script.sh", "#!/bin/sh\n")
+    return spliced
+
+
+def assert_round_trip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(CONTENTS) + ["script.sh"]
+        for name, contents in CONTENTS.items():
+            assert zf.read(name) == contents.encode("utf-8")
+            assert zf.getinfo(name).compress_type == zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.skipif(
+    not membercache.SPLICE_VERSIONS[0]
+    <= sys.version_info[:2]
+    <= membercache.SPLICE_VERSIONS[1],
+    reason="ZipFile internals not known",
+)
+def test_splice_is_used():
+    assert build_zip(io.BytesIO())
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+@pytest.mark.parametrize("splice", [True, False])
+def test_write_compressed(monkeypatch, seekable, splice):
+    if not splice:
+        # as on an unknown Python, whose members are recompressed
+        monkeypatch.setattr(membercache, "SPLICE_VERSIONS", ((2, 0), (2, 7)))
+    fileobj = io.BytesIO() if seekable else Unseekable()
+    spliced = build_zip(fileobj)
+    if not splice:
+        assert not spliced
+    assert_round_trip(fileobj.getvalue() if seekable else fileobj.written.getvalue())
+
+
+def test_compress_file_in_chunks(monkeypatch):
+    monkeypatch.setattr(membercache, "CHUNK_SIZE", 100)
+    contents = CONTENTS["urls.txt"].encode("utf-8")
+    member = compress_member("urls.txt", io.BytesIO(contents))
+    assert member == compress_member("urls.txt", contents)
+    assert membercache.decompress_member(member) == contents
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(membercache.config, "ckanext.bulk.cache_dir", str(tmp_path))
+    monkeypatch.setitem(membercache.config, "ckanext.bulk.cache_ttl", "3600")
+    return tmp_path
+
+
+def entry(*names):
+    return {
+        "members": [compress_member(name, CONTENTS[name]) for name in names],
+        "packages": 2,
+    }
+
+
+def age(cache_dir, key, seconds):
+    path = str(cache_dir / ("%s.members" % (key,)))
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_cache_round_trip(cache_dir):
+    value = entry("README.txt", "urls.txt", "empty.txt")
+    cache_put("a" * 40, value)
+    assert cache_get("a" * 40) == value
+    assert cache_get("b" * 40) is None
+    assert [p.name for p in cache_dir.iterdir()] == ["a" * 40 + ".members"]
+
+
+def test_cache_touch(cache_dir):
+    cache_put("a" * 40, entry("README.txt"))
+    age(cache_dir, "a" * 40, 3601)
+    assert cache_get("a" * 40) is None
+    assert cache_touch("a" * 40)
+    assert cache_get("a" * 40) == entry("README.txt")
+    assert not cache_touch("b" * 40)
+
+
+def test_cache_prune(cache_dir):
+    cache_put("a" * 40, entry("README.txt"))
+    cache_put("b" * 40, entry("README.txt"))
+    age(cache_dir, "a" * 40, 3601)
+    age(cache_dir, "b" * 40, 3599)
+    cache_put("c" * 40, entry("README.txt"))
+    assert sorted(p.name[0] for p in cache_dir.iterdir()) == ["b", "c"]
+
+
+def test_truncated_entry(cache_dir):
+    cache_put("a" * 40, entry("urls.txt"))
+    path = cache_dir / ("a" * 40 + ".members")
+    path.write_bytes(path.read_bytes()[:-1])
+    assert cache_get("a" * 40) is None
+
+
+def test_cache_disabled(monkeypatch):
+    monkeypatch.delitem(membercache.config, "ckanext.bulk.cache_dir", raising=False)
+    monkeypatch.delitem(membercache.config, "ckan.storage_path", raising=False)
+    assert not membercache.cache_enabled()
+    cache_put("a" * 40, entry("README.txt"))
+    assert cache_get("a" * 40) is None
+    assert not cache_touch("a" * 40)
+
+
+def test_cache_dir_must_be_private(cache_dir):
+    cache_dir.chmod(0o777)
+    assert not membercache.cache_enabled()
+    assert cache_get("a" * 40) is None
@@ -0,0 +1,50 @@
+import re
+from ckanext.bulk import metrics
+from ckanext.bulk.metrics import Counter, Histogram
+
+# a sample line of the Prometheus text exposition format
+SAMPLE_RE = re.compile(
+    r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{[a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*"'
+    r'(,[a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*")*\})? \S+$'
+)
+
+
+def test_render(monkeypatch):
+    requests = Counter("test_requests_total", "Requests.", ["route", "status"])
+    requests.inc(route="dataset", status=200)
+    requests.inc(route="dataset", status=200)
+    requests.inc(route='a "quoted"\\route\n', status=429)
+    duration = Histogram("test_duration_seconds", "Latency.", ["route"], [0.5, 1])
+    duration.observe(0.25, route="dataset")
+    duration.observe(0.75, route="dataset")
+    duration.observe(2, route="dataset")
+    unlabelled = Counter("test_bytes_total", "Bytes.")
+    unlabelled.inc(1.5)
+    monkeypatch.setattr(metrics, "REGISTRY", [requests, duration, unlabelled])
+
+    assert metrics.render() == (
+        "# HELP test_requests_total Requests.\n"
+        "# TYPE test_requests_total counter\n"
+        'test_requests_total{route="dataset",status="200"} 2\n'
+        'test_requests_total{route="a \\"quoted\\"\\\\route\\n",status="429"} 1\n'
+        "# HELP test_duration_seconds Latency.\n"
+        "# TYPE test_duration_seconds histogram\n"
+        'test_duration_seconds_bucket{route="dataset",le="0.5"} 1\n'
+        'test_duration_seconds_bucket{route="dataset",le="1"} 2\n'
+        'test_duration_seconds_bucket{route="dataset",le="+Inf"} 3\n'
+        'test_duration_seconds_sum{route="dataset"} 3\n'
+        'test_duration_seconds_count{route="dataset"} 3\n'
+        "# HELP test_bytes_total Bytes.\n"
+        "# TYPE test_bytes_total counter\n"
+        "test_bytes_total 1.5\n"
+    )
+
+
+def test_render_registry():
+    metrics.cache_result("etag", True)
+    metrics.stage_duration.observe(0.1, stage="search")
+    lines = metrics.render().splitlines()
+    for metric in metrics.REGISTRY:
+        assert "# TYPE %s %s" % (metric.name, metric.kind) in lines
+    for line in lines:
+        assert line.startswith("# ") or SAMPLE_RE.match(line), line
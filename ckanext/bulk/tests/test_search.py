@@ -0,0 +1,224 @@
+import datetime
+import json
+import pytest
+from ckanext.bulk import search
+from ckanext.bulk.search import (
+    ID_BATCH_SIZE,
+    changed_since,
+    ids_data_dicts,
+    ids_filter,
+    parse_since,
+    search_data_dict,
+    search_filters,
+    since_filter,
+)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "2024-01-02T03:04:05",
+        "2024-01-02T03:04:05Z",
+        " 2024-01-02T13:04:05+10:00 ",
+        "2024-01-01T22:04:05-05:00",
+    ],
+)
+def test_parse_since_timestamps(value):
+    assert parse_since(value) == datetime.datetime(2024, 1, 2, 3, 4, 5)
+
+
+def test_parse_since_prefix():
+    # the UTC time of the search the archive was built from
+    assert parse_since("bpa_1a2b3c4d_20240101T0930Z") == datetime.datetime(
+        2024, 1, 1, 9, 30
+    )
+
+
+# the last, a prefix in the local time the archive was built at
+@pytest.mark.parametrize(
+    "value", ["", "yesterday", "bpa_1a2b3c4d_2024", "bpa_1a2b3c4d_20240101T0930"]
+)
+def test_parse_since_invalid(value):
+    with pytest.raises(ValueError):
+        parse_since(value)
+
+
+def test_search_filters():
+    fq, extras = search_filters(
+        {
+            "res_format": "CSV",
+            "tags": "soil",
+            "ext_bbox": "1,2,3,4",
+            "_private": "x",
+            "empty": "",
+            "q": "query",
+            "since": "2024-01-01",
+        }
+    )
+    assert fq == ' res_format:"CSV" tags:"soil"'
+    assert extras == {"ext_bbox": "1,2,3,4"}
+
+
+def test_search_data_dict_since():
+    since = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    data_dict = search_data_dict({"tags": "soil"}, 10, fq="+type:x", since=since)
+    assert data_dict["fq"] == (
+        '+type:x +metadata_modified:[2024-01-02T03:04:05Z TO *] tags:"soil"'
+    )
+    assert since_filter(since) in data_dict["fq"]
+    assert data_dict["rows"] == 10
+
+
+def test_search_data_dict_sort_and_start():
+    data_dict = search_data_dict({}, 10)
+    assert data_dict["start"] == 0
+    assert "sort" not in data_dict
+    data_dict = search_data_dict({}, 10, sort="title_string asc", start=20)
+    assert data_dict["sort"] == "title_string asc"
+    assert data_dict["start"] == 20
+
+
+def test_ids_filter():
+    assert ids_filter(["a", "b"]) == '+(id:("a" OR "b") OR name:("a" OR "b"))'
+
+
+def test_changed_since():
+    packages = [
+        {
+            "id": "old",
+            "metadata_modified": "2023-12-31T00:00:00.000000",
+            "resources": [],
+        },
+        {
+            "id": "new",
+            "metadata_modified": "2024-01-02T00:00:00.000000",
+            "resources": [
+                {"id": "r1", "metadata_modified": "2023-06-01T00:00:00"},
+                {"id": "r2", "metadata_modified": "2024-01-01T12:00:00"},
+                {"id": "r3", "metadata_modified": None, "created": "2024-01-01T00:00:00"},
+                {"id": "r4"},
+            ],
+        },
+    ]
+    assert list(changed_since(iter(packages), None)) == packages
+
+    changed = list(changed_since(iter(packages), datetime.datetime(2024, 1, 1)))
+    assert [package["id"] for package in changed] == ["new"]
+    assert [r["id"] for r in changed[0]["resources"]] == ["r2", "r3", "r4"]
+    # the packages given are not modified
+    assert len(packages[1]["resources"]) == 4
+
+
+def test_reserved_params_are_not_filters():
+    data_dict = search_data_dict(
+        {"layout": "flat", "direct": "1", "optional": "1", "q": "x"}, 10
+    )
+    assert data_dict["q"] == "x"
+    assert data_dict["fq"] == ""
+
+
+def test_ids_are_searched_in_batches():
+    ids = ["package-%d" % i for i in range(ID_BATCH_SIZE * 2 + 1)]
+    data_dicts = ids_data_dicts(ids)
+    assert [d["rows"] for d in data_dicts] == [ID_BATCH_SIZE, ID_BATCH_SIZE, 1]
+    for data_dict in data_dicts:
+        assert data_dict["fq"].count('"package-') <= 2 * ID_BATCH_SIZE
+    assert ids_data_dicts([]) == []
+
+
+def fake_package_search(matched):
+    # package_search over `matched` packages, honouring ids_filter and paging
+    def package_search(context, data_dict):
+        found = [
+            package
+            for package in matched
+            if '"%s"' % (package["id"],) in data_dict["fq"]
+        ]
+        start = data_dict.get("start", 0)
+        return {
+            "count": len(found),
+            "results": found[start : start + data_dict["rows"]],
+            "facets": {
+                "num_resources": {"2": len(found)},
+                search.SIZE_FIELD: {"10": len(found)},
+            },
+        }
+
+    return package_search
+
+
+def test_ids_fingerprint_and_estimate_merge_batches(monkeypatch):
+    matched = [
+        {"id": "package-%d" % i, "metadata_modified": "2024-01-01T00:00:00"}
+        for i in range(ID_BATCH_SIZE + 10)
+    ]
+    monkeypatch.setattr(
+        search, "get_action", lambda name: fake_package_search(matched)
+    )
+    data_dicts = ids_data_dicts([p["id"] for p in matched] + ["missing"])
+    assert len(data_dicts) == 2
+
+    fingerprint = search.ids_fingerprint({}, data_dicts)
+    assert fingerprint == sorted((p["id"], p["metadata_modified"]) for p in matched)
+
+    estimate = search.ids_estimate({}, data_dicts)
+    assert estimate == {
+        "count": len(matched),
+        "packages": len(matched),
+        "resources": 2 * len(matched),
+        "size": 10 * len(matched),
+    }
+
+
+def test_packages_by_id_are_searched_in_batches(monkeypatch):
+    matched = [
+        {"id": "package-%d" % i, "name": "name-%d" % i, "resources": []}
+        for i in range(ID_BATCH_SIZE + 10)
+    ]
+    searches = []
+
+    def package_search(context, data_dict):
+        searches.append(data_dict["fq"].count('"package-'))
+        result = fake_package_search(matched)(context, data_dict)
+        result["results"] = [
+            dict(package, validated_data_dict=json.dumps(package))
+            for package in result["results"]
+        ]
+        return result
+
+    monkeypatch.setattr(search, "get_action", lambda name: package_search)
+    monkeypatch.setattr(search, "page_size", lambda: 1000)
+    ids = [p["id"] for p in reversed(matched)]
+    packages = list(search.iter_packages_by_id({}, ids))
+    assert [p["id"] for p in packages] == ids
+    assert max(searches) <= 2 * ID_BATCH_SIZE
+
+
+def test_search_pages_from_start(monkeypatch):
+    matched = [{"id": "package-%d" % i} for i in range(25)]
+    monkeypatch.setattr(
+        search, "get_action", lambda name: fake_package_search(matched)
+    )
+    monkeypatch.setattr(search, "page_size", lambda: 4)
+    data_dict = dict(ids_data_dicts([p["id"] for p in matched])[0], rows=10, start=20)
+    pages = list(search.search_pages({}, data_dict))
+    assert [p["id"] for page in pages for p in page] == [
+        "package-%d" % i for i in range(20, 25)
+    ]
+    assert search.index_estimate({}, data_dict)["packages"] == 5
+
+
+def test_sorted_search_fingerprint_keeps_its_order(monkeypatch):
+    matched = [
+        {"id": "package-%d" % i, "metadata_modified": "2024-01-01T00:00:00"}
+        for i in (2, 1, 3)
+    ]
+    monkeypatch.setattr(
+        search, "get_action", lambda name: fake_package_search(matched)
+    )
+    data_dict = ids_data_dicts([p["id"] for p in matched])[0]
+    ids = [pair[0] for pair in search.index_fingerprint({}, data_dict)]
+    assert ids == ["package-1", "package-2", "package-3"]
+    data_dict = dict(data_dict, sort="title_string desc")
+    ids = [pair[0] for pair in search.index_fingerprint({}, data_dict)]
+    assert ids == ["package-2", "package-1", "package-3"]
@@ -0,0 +1,128 @@
+import types
+from urllib.parse import parse_qs, urlparse
+import pytest
+from ckanext.bulk import signing
+
+SITE_URL = "https://data.example.org"
+
+
+def resource_url(package_id, id, filename="data.csv", site_url=SITE_URL):
+    return "%s/dataset/%s/resource/%s/download/%s" % (
+        site_url,
+        package_id,
+        id,
+        filename,
+    )
+
+
+@pytest.fixture
+def signed(monkeypatch):
+    """
+    sign URLs with a stand-in signer, recording the resources signed
+    """
+    monkeypatch.setitem(signing.config, "ckan.site_url", SITE_URL + "/")
+    monkeypatch.setattr(
+        signing, "c", types.SimpleNamespace(user="alice", userobj=None)
+    )
+    signed = []
+
+    def signer(resources, expires_in):
+        signed.extend(resources)
+        return {
+            resource["url"]: "https://objects.example.org/%s?expires=%d"
+            % (resource["id"], expires_in)
+            for resource in resources
+        }
+
+    def check_access(action, context, data_dict):
+        assert action == "resource_show" and context["user"] == "alice"
+        if data_dict["id"] == "private":
+            raise signing.NotAuthorized()
+        if data_dict["id"] == "deleted":
+            raise signing.NotFound()
+
+    monkeypatch.setattr(signing, "load_signer", lambda: signer)
+    monkeypatch.setattr(signing, "check_access", check_access)
+    return signed
+
+
+def direct(monkeypatch, value="1"):
+    params = {"direct": value} if value is not None else {}
+    monkeypatch.setattr(signing, "request", types.SimpleNamespace(params=params))
+
+
+def test_url_signer(signed, monkeypatch):
+    direct(monkeypatch)
+    monkeypatch.setitem(signing.config, "ckanext.bulk.signed_url_expiry", "600")
+    sign = signing.url_signer({"members-only", "members-only-name"})
+    urls = [
+        resource_url("open", "public"),
+        resource_url("open", "private"),
+        resource_url("open", "deleted"),
+        resource_url("members-only", "public"),
+        resource_url("members-only-name", "public"),
+        # elsewhere, or not a resource download
+        resource_url("open", "public", site_url="https://other.example.org"),
+        resource_url("open", "public", site_url=SITE_URL + ".example.com"),
+        SITE_URL + "/dataset/open",
+        "ftp://data.example.org/dataset/open/resource/x/download/a",
+    ]
+    assert sign(urls) == {
+        resource_url("open", "public"): "https://objects.example.org/public?expires=600"
+    }
+    assert signed == [
+        {
+            "id": "public",
+            "package_id": "open",
+            "filename": "data.csv",
+            "url": resource_url("open", "public"),
+        }
+    ]
+
+
+@pytest.mark.parametrize("value", [None, "0", "false"])
+def test_url_signer_needs_direct(signed, monkeypatch, value):
+    direct(monkeypatch, value)
+    assert signing.url_signer(set()) is None
+    assert signing.signing_window() is None
+
+
+def test_url_signer_needs_signer(monkeypatch):
+    direct(monkeypatch)
+    monkeypatch.delitem(signing.config, "ckanext.bulk.url_signer", raising=False)
+    assert signing.load_signer() is None
+    assert signing.url_signer(set()) is None
+
+
+def test_load_signer(monkeypatch):
+    monkeypatch.setitem(
+        signing.config, "ckanext.bulk.url_signer", "ckanext.bulk.signing:s3_signer"
+    )
+    assert signing.load_signer() is signing.s3_signer
+
+
+def test_s3_signer(monkeypatch):
+    # a MinIO-style S3-compatible store; presigning needs no connection
+    pytest.importorskip("boto3")
+    for key, value in {
+        "ckanext.bulk.s3.endpoint_url": "http://minio.example.org:9000",
+        "ckanext.bulk.s3.region_name": "us-east-1",
+        "ckanext.bulk.s3.access_key_id": "minioadmin",
+        "ckanext.bulk.s3.secret_access_key": "minioadmin-secret",
+        "ckanext.bulk.s3.bucket": "ckan",
+        "ckanext.bulk.s3.key_template": "resources/{package_id}/{id}/{filename}",
+    }.items():
+        monkeypatch.setitem(signing.config, key, value)
+    url = resource_url("open", "public")
+    resource = dict(signing.portal_resource(url), url=url)
+
+    signed = signing.s3_signer([resource], 600)
+    assert list(signed) == [url]
+    presigned = urlparse(signed[url])
+    assert presigned.scheme == "http"
+    assert presigned.netloc == "minio.example.org:9000"
+    assert presigned.path == "/ckan/resources/open/public/data.csv"
+    query = parse_qs(presigned.query)
+    assert query["X-Amz-Expires"] == ["600"]
+    assert query["X-Amz-Credential"][0].startswith("minioadmin/")
+    assert "X-Amz-Signature" in query
@@ -0,0 +1,72 @@
+import io
+import tarfile
+import pytest
+from ckanext.bulk.tarstream import CHUNK_SIZE, tar_stream
+
+CONTENTS = {
+    "small": b"small file\n",
+    "empty": b"",
+    # larger than read ahead allows, so sent as it is read
+    "large": bytes(range(256)) * (CHUNK_SIZE // 128),
+}
+
+
+class Closing(io.BytesIO):
+    opened = []
+
+    def __init__(self, data):
+        super().__init__(data)
+        Closing.opened.append(self)
+
+
+def opener(resource):
+    if resource["id"] not in CONTENTS:
+        return None
+    data = CONTENTS[resource["id"]]
+    return len(data), Closing(data)
+
+
+def resource(_id):
+    return {"id": _id, "url": "https://example.org/%s" % (_id,), "md5": "md5-" + _id}
+
+
+def read_tar(chunks):
+    data = b"".join(chunks)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return {
+            member.name: tar.extractfile(member).read() for member in tar.getmembers()
+        }
+
+
+def test_tar_stream():
+    Closing.opened = []
+    entries = [
+        ("a/small.txt", resource("small")),
+        ("missing.txt", resource("missing")),
+        ("large.bin", resource("large")),
+        ("empty.txt", resource("empty")),
+    ]
+    refused = [("secret.txt", resource("secret"), "not authorized")]
+    members = read_tar(
+        tar_stream("pfx", entries, refused, opener, 2, 1024, 1024 * 1024 * 1024)
+    )
+    assert members["pfx/a/small.txt"] == CONTENTS["small"]
+    assert members["pfx/large.bin"] == CONTENTS["large"]
+    assert members["pfx/empty.txt"] == b""
+    assert "pfx/missing.txt" not in members
+    assert members["pfx/tmp/pfx_md5sum.txt"] == (
+        b"md5-small  a/small.txt\nmd5-large  large.bin\nmd5-empty  empty.txt\n"
+    )
+    skipped = members["pfx/SKIPPED.txt"].decode("utf-8")
+    assert "secret.txt (not authorized)" in skipped
+    assert "missing.txt (not available)" in skipped
+    assert all(fileobj.closed for fileobj in Closing.opened)
+
+
+def test_tar_stream_limit():
+    Closing.opened = []
+    entries = [("small.txt", resource("small")), ("large.bin", resource("large"))]
+    stream = tar_stream("pfx", entries, [], opener, 1, 1024, len(CONTENTS["small"]))
+    with pytest.raises(IOError):
+        b"".join(stream)
+    assert all(fileobj.closed for fileobj in Closing.opened)
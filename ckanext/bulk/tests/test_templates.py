@@ -0,0 +1,14 @@
+import warnings
+import pytest
+from ckanext.bulk import bash, powershell, python
+
+
+@pytest.mark.parametrize("module", [bash, powershell, python])
+def test_templates_have_no_invalid_escapes(module):
+    # invalid escapes are a SyntaxWarning from Python 3.12 (and will be
+    # errors), a DeprecationWarning before
+    with open(module.__file__, encoding="utf-8") as f:
+        source = f.read()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        compile(source, module.__file__, "exec")
@@ -0,0 +1,171 @@
+import hashlib
+from xml.etree import ElementTree
+import pytest
+from ckanext.bulk.membercache import compress_member, decompress_member
+from ckanext.bulk.zipoutput import (
+    ARIA2_FNAME,
+    METALINK_FNAME,
+    URLS_FNAME,
+    aria2_input,
+    build_manifest,
+    json_cell,
+    layout_directory,
+    metalink,
+    names_cell,
+    serialize_rows,
+    signed_member,
+)
+
+PACKAGE = {
+    "id": "package-id",
+    "name": "package-name",
+    "organization": {"name": "org-name"},
+}
+
+
+def resource(n, **fields):
+    return dict(
+        {
+            "id": "resource-%d" % (n,),
+            "package_id": "package-id",
+            "url": "https://data.example.org/dataset/package-id/resource/resource-%d/download/file_%d.txt"
+            % (n, n),
+            "size": 10 * n,
+            "md5": "md5-%d" % (n,),
+        },
+        **fields
+    )
+
+
+@pytest.mark.parametrize(
+    "layout, expected",
+    [
+        ("flat", ""),
+        ("by-package", "package-name"),
+        ("by-org/package", "org-name/package-name"),
+        ("hashed", hashlib.sha1(b"resource-1").hexdigest()[:2]),
+    ],
+)
+def test_layout_directory(layout, expected):
+    assert layout_directory(layout, resource(1), PACKAGE) == expected
+
+
+def test_layout_directory_without_package():
+    assert layout_directory("by-package", resource(1), None) == "package-id"
+    assert layout_directory("by-org/package", resource(1), None) == (
+        "unknown/package-id"
+    )
+
+
+def test_build_manifest():
+    resources = [
+        resource(2, optional_file="true"),
+        resource(1),
+        resource(3, shared_file=True, url="https://example.org/shared.txt"),
+        resource(4, shared_file=True, url="https://example.org/shared.txt"),
+    ]
+    manifest = build_manifest(resources, [PACKAGE], "by-package")
+    # sorted by URL, and shared files are only listed once
+    assert manifest["urls"] == [
+        "https://data.example.org/dataset/package-id/resource/resource-1/download/file_1.txt",
+        "https://example.org/shared.txt",
+    ]
+    assert manifest["paths"] == ["package-name/file_1.txt", "package-name/shared.txt"]
+    assert manifest["md5sums"] == [
+        ("md5-1", "package-name/file_1.txt"),
+        ("md5-3", "package-name/shared.txt"),
+    ]
+    assert manifest["urls_optional"] == [resources[0]["url"]]
+    assert manifest["paths_optional"] == ["package-name/file_2.txt"]
+    assert manifest["md5sums_optional"] == [("md5-2", "package-name/file_2.txt")]
+    assert manifest["shared_files"] == ["https://example.org/shared.txt"]
+    assert manifest["total_size_bytes"] == 10 + 20 + 30
+    assert manifest["collisions"] == []
+
+
+def test_build_manifest_collisions():
+    first = resource(1, url="https://a.example.org/file.txt")
+    second = resource(2, url="https://b.example.org/file.txt")
+    manifest = build_manifest([second, first])
+    assert manifest["paths"] == ["file.txt", "resource-2/file.txt"]
+    assert manifest["collisions"] == [
+        ("file.txt", "resource-2/file.txt", "https://b.example.org/file.txt")
+    ]
+
+
+def test_serialize_rows():
+    rows = [
+        ["a", 1, ["x"], [{"name": "t1"}], None],
+        ["b", 2.5, {"k": "v"}, "t2,t3", None],
+    ]
+    assert serialize_rows([None, None, None, names_cell, json_cell], rows) is rows
+    assert rows == [
+        ["a", 1, '["x"]', "t1", None],
+        ["b", 2.5, '{"k": "v"}', "t2,t3", None],
+    ]
+    assert serialize_rows([None], []) == []
+
+
+def test_json_cell():
+    assert json_cell({"b": 1, "a": ["é"]}) == '{"a": ["é"], "b": 1}'
+    # strings, e.g. multiple_select values stored as JSON, are not quoted
+    assert json_cell('["x", "y"]') == '["x", "y"]'
+    assert json_cell("plain") == "plain"
+
+
+SITE_URL = "https://data.example.org"
+PORTAL_URL = SITE_URL + "/dataset/p/resource/r/download/a&b.txt"
+OTHER_URL = "https://other.example.org/file.txt"
+DOWNLOADS = [
+    (PORTAL_URL, "a&b.txt", 10, "md5-a", [("md5", "md5-a")]),
+    (OTHER_URL, "file.txt", 20, "md5-b", [("md5", "md5-b")]),
+]
+
+
+def test_aria2_input_only_sends_token_to_portal():
+    assert aria2_input(DOWNLOADS, SITE_URL).splitlines() == [
+        PORTAL_URL,
+        "  out=a&b.txt",
+        "  header=Authorization: ${CKAN_API_TOKEN}",
+        "  checksum=md5=md5-a",
+        OTHER_URL,
+        "  out=file.txt",
+        "  checksum=md5=md5-b",
+    ]
+    # nor to a host whose name merely starts with the portal's
+    lookalike = [(SITE_URL + ".evil.org/x", "x", None, None, [])]
+    assert "header=" not in aria2_input(lookalike, SITE_URL)
+
+
+def sign(urls):
+    return {url: url + "?sig=1&x=2" for url in urls if url.startswith(SITE_URL)}
+
+
+def test_signed_member_urls():
+    member = compress_member(URLS_FNAME, "%s\n%s\n" % (PORTAL_URL, OTHER_URL))
+    signed = decompress_member(signed_member(member, sign)).decode("utf-8")
+    assert signed == "%s?sig=1&x=2\n%s\n" % (PORTAL_URL, OTHER_URL)
+
+
+def test_signed_member_aria2_drops_token():
+    member = compress_member(ARIA2_FNAME, aria2_input(DOWNLOADS, SITE_URL))
+    lines = decompress_member(signed_member(member, sign)).decode("utf-8").splitlines()
+    assert lines == [
+        PORTAL_URL + "?sig=1&x=2",
+        "  out=a&b.txt",
+        "  checksum=md5=md5-a",
+        OTHER_URL,
+        "  out=file.txt",
+        "  checksum=md5=md5-b",
+    ]
+
+
+def test_signed_member_metalink():
+    member = compress_member(METALINK_FNAME, metalink(DOWNLOADS))
+    document = decompress_member(signed_member(member, sign)).decode("utf-8")
+    root = ElementTree.fromstring(document)
+    ns = {"m": "urn:ietf:params:xml:ns:metalink"}
+    assert [url.text for url in root.findall("m:file/m:url", ns)] == [
+        PORTAL_URL + "?sig=1&x=2",
+        OTHER_URL,
+    ]
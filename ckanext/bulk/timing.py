@@ -0,0 +1,174 @@
+import cProfile
+import functools
+import json
+import logging
+import marshal
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import g, has_request_context
+from werkzeug.exceptions import HTTPException
+import ckan.plugins.toolkit as tk
+from ckan.common import request, c
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+def metric_name(s):
+    # Server-Timing metric names must be HTTP tokens
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", s)
+
+
+def stage_label(s):
+    # one label per kind of CSV, rather than one per schema
+    return re.sub(r"^(csv_[a-z]+)_.*$", r"\1", s)
+
+
+class StageTimer(object):
+    """
+    wall clock time spent in each named stage of a bulk request
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = OrderedDict()
+        # counts describing the archive, e.g. packages and resources
+        self.facts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        metrics = [
+            "%s;dur=%.1f" % (metric_name(name), elapsed * 1000)
+            for name, elapsed in self.stages.items()
+        ]
+        metrics.append("total;dur=%.1f" % (self.total() * 1000,))
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        stages = OrderedDict(
+            (name, round(elapsed * 1000, 1)) for name, elapsed in self.stages.items()
+        )
+        stages["total"] = round(self.total() * 1000, 1)
+        return stages
+
+
+def current_timer():
+    """
+    the timer for the current bulk request; outside a request (or an
+    instrumented view) a throwaway timer is returned
+    """
+    if has_request_context() and getattr(g, "bulk_timer", None) is not None:
+        return g.bulk_timer
+    return StageTimer()
+
+
+def stage(name):
+    """
+    decorate a function so that its calls are timed as the named stage
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with current_timer().stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_profiler():
+    """
+    the profiler for the current bulk request, if one was requested
+    """
+    if has_request_context():
+        return getattr(g, "bulk_profiler", None)
+    return None
+
+
+def profile_stats(profiler):
+    # same format as `Profile.dump_stats`, so it can be loaded with pstats
+    profiler.disable()
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+
+def profile_requested():
+    # profiling is opt-in, and only for sysadmins
+    return (
+        tk.asbool(request.params.get("profile", False))
+        and c.userobj is not None
+        and c.userobj.sysadmin is True
+    )
+
+
+def record_metrics(route, response, timer):
+    metrics.requests_total.inc(route=route, status=response.status_code)
+    metrics.request_duration.observe(timer.total(), route=route)
+    for name, elapsed in timer.stages.items():
+        metrics.stage_duration.observe(elapsed, stage=stage_label(name))
+    if "packages" in timer.facts:
+        # an archive was generated
+        metrics.archive_bytes.observe(response.content_length or 0, route=route)
+        metrics.archive_packages.observe(timer.facts["packages"], route=route)
+        metrics.archive_resources.observe(timer.facts["resources"], route=route)
+
+
+def timed(route):
+    """
+    decorate a bulk view so that each stage is timed; the breakdown is
+    returned in a Server-Timing header, logged as a JSON line and
+    recorded in the bulk metrics
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.bulk_timer = timer = StageTimer()
+            g.bulk_profiler = None
+            if profile_requested():
+                g.bulk_profiler = cProfile.Profile()
+                g.bulk_profiler.enable()
+            try:
+                response = view(*args, **kwargs)
+            except HTTPException as exception:
+                metrics.requests_total.inc(route=route, status=exception.code)
+                raise
+            finally:
+                if g.bulk_profiler is not None:
+                    g.bulk_profiler.disable()
+            response.headers["Server-Timing"] = timer.server_timing()
+            log.info(
+                "bulk timing %s",
+                json.dumps(
+                    {
+                        "route": route,
+                        "user": c.user,
+                        "status": response.status_code,
+                        "bytes": response.content_length,
+                        "facts": timer.facts,
+                        "stages": timer.as_dict(),
+                    }
+                ),
+            )
+            record_metrics(route, response, timer)
+            return response
+
+        return wrapper
+
+    return decorator
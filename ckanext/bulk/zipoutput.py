@@ -2,22 +2,47 @@ import jinja2
 import ckan.lib.helpers as h
 import sys
 import datetime
+import hashlib
+import json
 import codecs
 import csv
 import bitmath
 import os
+import logging
+import mmap
+import pickle
+import posixpath
+import re
+import tempfile
 import ckan.plugins.toolkit as tk
-from collections import defaultdict
+from collections import namedtuple
 from ckan.plugins.toolkit import config
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape, quoteattr, unescape
 from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 from flask import make_response
 from io import BytesIO, TextIOWrapper
 from .bash import SH_TEMPLATE
 from .powershell import POWERSHELL_TEMPLATE
 from .python import PY_TEMPLATE
+from .timing import current_timer, current_profiler, profile_stats
+from .admission import SingleFlight, build_lock
+from .search import format_since, utc_now
+from .membercache import (
+    compress_member,
+    write_compressed,
+    cache_get,
+    cache_put,
+    cache_enabled,
+    cache_touch,
+    decompress_member,
+)
+from .signing import signed_url_expiry
+from . import metrics
 from ckanext.scheming.helpers import scheming_get_dataset_schema
 
+log = logging.getLogger(__name__)
+
 BULK_EXPLANATORY_NOTE = """\
 CKAN Bulk Download
 ------------------
@@ -50,6 +75,11 @@ UNIX shell script, which when executed will download the files,
 and then checksum them. This is supported on any Linux or MacOS/BSD
 system, so long as `curl` is installed.
 
+To check files already downloaded, without downloading anything, run
+any of the scripts with --verify-only (download.ps1 -VerifyOnly), or
+with --fast-verify (download.ps1 -FastVerify) to hash only files whose
+size or modification time has changed since they were last verified.
+
 Before running either of these scripts, please set the CKAN_API_TOKEN
 environment variable.
 
@@ -88,7 +118,9 @@ Contains metadata spreadsheets as CSV for all selected data resources (files).
 
 QUERY.txt:
 Text file which contains metadata about the download results and the original
-query
+query. For a download of only what has changed since an earlier download, it
+also records the cut-off used ("Since") and the cut-off to use for the next
+such download ("Next Since").
 
 MEMBERSHIPS.txt:
 Text file which contains information about the organization memberships
@@ -98,9 +130,19 @@ OPTIONAL.txt:
 (when present) Text file which contains information about the process
 to download any files considered optional.
 
+COLLISIONS.txt:
+(when present) Text file which lists files which would have had the same
+path as another file, and the paths they were given instead.
+
 tmp folder:
 This folder contains files required by the download scripts. Its
-contents can be ignored.
+contents can be ignored, unless you prefer to use your own download
+tool: it also contains an aria2 input file ({prefix}_aria2.txt) and a
+Metalink 4 document ({prefix}.meta4) listing every file with its size
+and MD5 checksum, and a list of every checksum of each file held by the
+portal ({prefix}_checksums.txt), from which the download scripts use the
+fastest they support. Files are downloaded to the paths listed in
+{prefix}_paths.txt (directory layout: {layout}).
 
 
 Note all CSV files are encoded as UTF-8 with a Byte Order Mark (BOM) to
@@ -115,6 +157,9 @@ User Page              : {user_page}
 Query                  : {query}
 QueryURL               : {query_url}
 Download URL           : {download_url}
+Since                  : {since}
+Next Since             : {next_since}
+Signed URLs Expire     : {signed_expires}
 URL Count              : {url_count}
 MD5 Sum Count          : {md5_count}
 URL Count Optional     : {url_optional_count}
@@ -123,6 +168,8 @@ Organization Count     : {organization_count}
 Package Count          : {package_count}
 Resource Count         : {resource_count}
 Shared Files           : {shared_files_count}
+Layout                 : {layout}
+Renamed Files          : {collision_count}
 Total Space            : {total_size}
 Total Bytes            : {total_size_bytes}
 """
@@ -155,6 +202,64 @@ For example:
     download.ps1 -o
 """
 
+# archive member names, formatted with the archive prefix
+URLS_FNAME = "tmp/{prefix}_urls.txt"
+MD5SUM_FNAME = "tmp/{prefix}_md5sum.txt"
+URLS_OPTIONAL_FNAME = "tmp/{prefix}_urls_optional.txt"
+MD5SUM_OPTIONAL_FNAME = "tmp/{prefix}_md5sum_optional.txt"
+SIZES_FNAME = "tmp/{prefix}_sizes.txt"
+SIZES_OPTIONAL_FNAME = "tmp/{prefix}_sizes_optional.txt"
+ARIA2_FNAME = "tmp/{prefix}_aria2.txt"
+ARIA2_OPTIONAL_FNAME = "tmp/{prefix}_aria2_optional.txt"
+METALINK_FNAME = "tmp/{prefix}.meta4"
+METALINK_OPTIONAL_FNAME = "tmp/{prefix}_optional.meta4"
+CHECKSUMS_FNAME = "tmp/{prefix}_checksums.txt"
+CHECKSUMS_OPTIONAL_FNAME = "tmp/{prefix}_checksums_optional.txt"
+# the path of each file, relative to the scripts, in the order of the URLs
+PATHS_FNAME = "tmp/{prefix}_paths.txt"
+PATHS_OPTIONAL_FNAME = "tmp/{prefix}_paths_optional.txt"
+# written by the download scripts, recording files already verified
+VERIFIED_FNAME = "tmp/{prefix}_verified.txt"
+VERIFIED_OPTIONAL_FNAME = "tmp/{prefix}_verified_optional.txt"
+
+# members listing URLs which are replaced with signed URLs for direct
+# downloads from object storage
+SIGNED_FNAMES = (
+    URLS_FNAME,
+    URLS_OPTIONAL_FNAME,
+    ARIA2_FNAME,
+    ARIA2_OPTIONAL_FNAME,
+    METALINK_FNAME,
+    METALINK_OPTIONAL_FNAME,
+)
+
+# in the aria2 input file, for files on this portal only; substitute with
+# e.g. `envsubst`
+AUTH_HEADER_PLACEHOLDER = "Authorization: ${CKAN_API_TOKEN}"
+
+# Metalink hash types (IANA hash function textual names) of the checksum
+# algorithms which have one
+METALINK_HASH_TYPES = {
+    "md5": "md5",
+    "sha1": "sha-1",
+    "sha256": "sha-256",
+    "sha512": "sha-512",
+}
+
+# a URL line of a Metalink document, as written by `metalink`
+METALINK_URL_RE = re.compile(r"^(\s*<url>)(.*)(</url>)$")
+
+# directory layouts of the downloaded files: all in the script directory,
+# in a directory per package, or per organization and package, or fanned
+# out over 256 directories named by a hash of the resource id
+LAYOUTS = ("flat", "by-package", "by-org/package", "hashed")
+
+COLLISIONS_NOTE = """\
+These files would have had the same path as another file in this download,
+so have been given a path including their resource id instead:
+
+"""
+
 amd_data_types = [
     "base-genomics-amplicon",
     "base-genomics-amplicon-control",
@@ -196,13 +301,6 @@ def get_timestamp():
     )
 
 
-def objects_by_attr(objects, attr, default):
-    by_attr = defaultdict(list)
-    for obj in objects:
-        by_attr[obj.get(attr, default)].append(obj)
-    return by_attr
-
-
 def debug(s):
     sys.stderr.write(repr(s))
     sys.stderr.write("\n")
@@ -267,23 +365,271 @@ def schema_to_csv(typ, schema_key, objects):
     else:
         w = csv.writer(fd)
 
-    header = []
-    field_names = []
-    for field in schema[schema_key]:
-        field_names.append(field["field_name"])
-        header.append(encode_field(choose_header_label(typ, schema_key, field)))
+    header, rows = csv_rows(
+        sorted(objects, key=lambda p: p["name"]),
+        csv_columns(typ, schema_key, schema[schema_key]),
+    )
     w.writerow(header)
-    for obj in sorted(objects, key=lambda p: p["name"]):
-        w.writerow(
-            [encode_field(obj.get(field_name, "")) for field_name in field_names]
-        )
+    w.writerows(rows)
     return fd.getvalue()
 
 
+def json_cell(value):
+    # sorted keys, so that the same value is always written the same way;
+    # a string (e.g. a value already stored as JSON) is written as it is
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def names_cell(value):
+    # tags or groups, as a comma separated list of names (as in tag_string)
+    if isinstance(value, str):
+        return value
+    return ",".join(item["name"] for item in value)
+
+
+def extras_cell(value):
+    # a list of {key, value}, as a JSON object
+    if isinstance(value, str):
+        return value
+    return json_cell({extra["key"]: extra["value"] for extra in value})
+
+
+# the serializers of CSV columns, by ckanext-scheming preset or field name:
+# (the field read instead of the column's own, or None; a function from a
+# (non-missing) value to a cell). Other columns are written as they are,
+# or with `encode_field` if they hold values the CSV writer can not.
+CSV_SERIALIZERS = {
+    "tag_string_autocomplete": ("tags", names_cell),
+    "multiple_checkbox": (None, json_cell),
+    "multiple_select": (None, json_cell),
+    "multiple_text": (None, json_cell),
+    "json_object": (None, json_cell),
+    "tags": (None, names_cell),
+    "groups": (None, names_cell),
+    "extras": (None, extras_cell),
+}
+
+
+def register_csv_serializer(name, serializer, source=None):
+    """
+    serialize the CSV columns of fields with the preset or field name
+    `name` with `serializer`, reading the field `source` if given
+    """
+    CSV_SERIALIZERS[name] = (source, serializer)
+
+
+# a column of a metadata CSV; subfields are the columns of each entry of
+# a field with repeating subfields
+CsvColumn = namedtuple("CsvColumn", ["header", "source", "serializer", "subfields"])
+
+
+def repeating_subfields_mode():
+    # "columns", or "json" for a single JSON cell per field
+    return config.get("ckanext.bulk.repeating_subfields", "columns")
+
+
+def csv_columns(typ, schema_key, fields):
+    """
+    the columns of a metadata CSV for the scheming fields, with their
+    serializers chosen once per column
+    """
+    columns = []
+    for field in fields:
+        source, serializer = CSV_SERIALIZERS.get(
+            field.get("preset")
+        ) or CSV_SERIALIZERS.get(field["field_name"], (None, None))
+        subfields = None
+        if field.get("repeating_subfields"):
+            if repeating_subfields_mode() == "json":
+                serializer = json_cell
+            else:
+                subfields = csv_columns(typ, schema_key, field["repeating_subfields"])
+        columns.append(
+            CsvColumn(
+                encode_field(choose_header_label(typ, schema_key, field)),
+                source or field["field_name"],
+                serializer,
+                subfields,
+            )
+        )
+    return columns
+
+
+def expanded_columns(columns, widths):
+    """
+    the header and serializers of the columns, with each column of
+    repeating subfields (by index in `widths`) expanded to a column for
+    each subfield of as many entries as its width
+    """
+    header = []
+    serializers = []
+    for i, column in enumerate(columns):
+        if not column.subfields:
+            header.append(column.header)
+            serializers.append(column.serializer)
+            continue
+        for n in range(widths[i]):
+            for subfield in column.subfields:
+                header.append("%s %d %s" % (column.header, n + 1, subfield.header))
+                serializers.append(subfield.serializer)
+    return header, serializers
+
+
+def subfield_widths(columns, rows):
+    # the most entries any row has in each column of repeating subfields
+    return {
+        i: max([len(row[i]) for row in rows if isinstance(row[i], list)] + [1])
+        for i, column in enumerate(columns)
+        if column.subfields
+    }
+
+
+def expand_rows(columns, widths, rows):
+    """
+    replace the cell of each column of repeating subfields, in each row,
+    with a cell for each subfield of each entry, blank beyond the entries
+    the row has
+    """
+    # from the right, so that the indexes of those to come are unchanged
+    for i in reversed(range(len(columns))):
+        if not columns[i].subfields:
+            continue
+        sources = [subfield.source for subfield in columns[i].subfields]
+        blank = [None] * len(sources)
+        for row in rows:
+            entries = row[i] if isinstance(row[i], list) else []
+            expanded = []
+            for entry in entries:
+                expanded.extend(map(entry.get, sources))
+            row[i : i + 1] = expanded + blank * (widths[i] - len(entries))
+
+
+# values which the CSV writer formats as `encode_field` would (None, for a
+# missing field, is written as an empty cell)
+CSV_NATIVE_TYPES = frozenset([str, int, float, bool, type(None)])
+
+
+def serialize_rows(serializers, rows):
+    """
+    serialize each column of the rows (in place) with its serializer, or
+    if it has none, check the types in the column once, so that only
+    columns holding other values are converted with `encode_field`
+    """
+    if not rows:
+        return rows
+    convert = []
+    for i, column in enumerate(zip(*rows)):
+        if serializers[i] is not None:
+            convert.append((i, serializers[i]))
+        elif not CSV_NATIVE_TYPES.issuperset(map(type, column)):
+            convert.append((i, encode_field))
+    if convert:
+        for row in rows:
+            for i, serializer in convert:
+                if row[i] is not None:
+                    row[i] = serializer(row[i])
+    return rows
+
+
+def csv_rows(objects, columns):
+    """
+    the header and rows of a CSV of the objects' columns. Each row is
+    extracted with a single `map` over the fields, repeating subfields are
+    expanded, and then the columns are serialized (see `serialize_rows`).
+    """
+    sources = [column.source for column in columns]
+    rows = [list(map(obj.get, sources)) for obj in objects]
+    widths = subfield_widths(columns, rows)
+    header, serializers = expanded_columns(columns, widths)
+    expand_rows(columns, widths, rows)
+    return header, serialize_rows(serializers, rows)
+
+
+class CsvSpool(object):
+    """
+    the rows of a metadata CSV, added an object at a time and spooled to a
+    temporary file, so that only their names (to sort them by) are held in
+    memory until the CSV is written
+    """
+
+    # rows serialized and written at a time
+    batch_size = 1000
+
+    def __init__(self, typ, schema_key):
+        schema = scheming_get_dataset_schema(typ)
+        # some objects may not have a ckanext-scheming schema
+        self.columns = None
+        if schema is not None:
+            self.columns = csv_columns(typ, schema_key, schema[schema_key])
+        self.sources = [column.source for column in self.columns or []]
+        self.widths = {
+            i: 1 for i, column in enumerate(self.columns or []) if column.subfields
+        }
+        self.fd = tempfile.TemporaryFile()
+        self.size = 0
+        # (name, order added, offset, length) of each row
+        self.index = []
+
+    def add(self, obj):
+        if self.columns is None:
+            return
+        row = list(map(obj.get, self.sources))
+        for i, width in self.widths.items():
+            if isinstance(row[i], list) and len(row[i]) > width:
+                self.widths[i] = len(row[i])
+        data = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        self.index.append((obj["name"], len(self.index), self.size, len(data)))
+        self.fd.write(data)
+        self.size += len(data)
+
+    def csv(self):
+        """
+        a temporary file holding the CSV, its rows sorted by name (or, if
+        there is no schema, empty)
+        """
+        fd = tempfile.TemporaryFile()
+        if self.columns is None:
+            return fd
+        # Write the Byte Order Mark to signal to Excel that this CSV is in UTF-8
+        fd.write(codecs.BOM_UTF8)
+        t = TextIOWrapper(fd, write_through=True, encoding="utf-8")
+        w = csv.writer(t)
+        header, serializers = expanded_columns(self.columns, self.widths)
+        w.writerow(header)
+        if self.index:
+            self.fd.flush()
+            spooled = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.index.sort()
+                for start in range(0, len(self.index), self.batch_size):
+                    rows = [
+                        pickle.loads(spooled[offset : offset + length])
+                        for name, n, offset, length in self.index[
+                            start : start + self.batch_size
+                        ]
+                    ]
+                    expand_rows(self.columns, self.widths, rows)
+                    w.writerows(serialize_rows(serializers, rows))
+            finally:
+                spooled.close()
+        # leave the file open once the wrapper is gone
+        t.detach()
+        fd.seek(0)
+        return fd
+
+    def close(self):
+        self.fd.close()
+
+
 def encode_field(field_name):
     # fix for AttributeError: 'int' object has no attribute 'encode'
     if isinstance(field_name, (int, float)):
         field_name = str(field_name)
+    # e.g. the values of fields with no serializer (see CSV_SERIALIZERS)
+    if isinstance(field_name, (list, dict)):
+        return json_cell(field_name)
     if sys.version_info >= (3, 0) and isinstance(field_name, str):
         return field_name
     else:
@@ -374,69 +720,81 @@ def generate_memberships_information(
     return output
 
 
-def generate_bulk_zip(
-    pfx,
-    title,
-    user,
-    memberships,
-    access_required,
-    organizations,
-    packages,
-    resources,
-    query=None,
-    query_url=None,
-    download_url=None,
-):
-    user_page = None
-    username = ""
-    includes_optional = ""
-    site_url = config.get("ckan.site_url").rstrip("/")
-    if user:
-        user_page = "%s%s" % (
-            site_url,
-            h.url_for("user.read", id=user.name),
-        )
-        username = user.name
+def str2bool(v):
+    if type(v)==bool:
+        return v
+    if v.lower() in ("yes", "true", "t", "y", "1"):
+        return True
+    return False
 
-    def str2bool(v):
-        if type(v)==bool:
-            return v
-        if v.lower() in ("yes", "true", "t", "y", "1"):
-            return True
-        return False
 
-    def ip(s):
-        return pfx + "/" + s
+def checksum_attributes():
+    """
+    (algorithm, resource attribute) of the checksums to list: MD5, from
+    `ckanext.bulk.md5_attribute`, and those in
+    `ckanext.bulk.checksum_attributes`, e.g. `sha256 blake3:b3sum`, with
+    the attribute defaulting to the algorithm name
+    """
+    attributes = [("md5", config.get("ckanext.bulk.md5_attribute", "md5"))]
+    for item in config.get("ckanext.bulk.checksum_attributes", "").split():
+        algorithm, _, attribute = item.partition(":")
+        attributes.append((algorithm.lower(), attribute or algorithm))
+    return attributes
 
-    def write_script(filename, contents):
-        info = ZipInfo(ip(filename))
-        info.external_attr = 0o755 << 16  # mark script as executable
-        contents = (
-            jinja2.Environment()
-            .from_string(contents)
-            .render(
-                user_page=user_page,
-                md5sum_fname=md5sum_fname,
-                urls_fname=urls_fname,
-                md5sum_optional_fname=md5sum_optional_fname,
-                urls_optional_fname=urls_optional_fname,
-                prefix=pfx,
-                username=username,
-            )
+
+def default_layout():
+    return config.get("ckanext.bulk.layout", "flat")
+
+
+def layout_directory(layout, resource, package):
+    """
+    the directory (or "" for none) of a resource's file in a layout
+    """
+    package = package or {}
+    package_name = package.get("name") or resource.get("package_id") or "unknown"
+    if layout == "by-package":
+        return package_name
+    if layout == "by-org/package":
+        organization = package.get("organization") or {}
+        return "%s/%s" % (
+            organization.get("name") or package.get("owner_org") or "unknown",
+            package_name,
         )
-        zf.writestr(info, contents.encode("utf-8"))
+    if layout == "hashed":
+        return hashlib.sha1(resource["id"].encode("utf-8")).hexdigest()[:2]
+    return ""
 
+
+def build_manifest(resources, packages=None, layout="flat"):
+    """
+    the URL and checksum lists for the resources, split into main and
+    optional files, with shared files only listed once, and the path of
+    each file in the directory layout. A file which would have the same
+    path as another is renamed into a directory named by its resource id.
+    """
     urls = []
+    # relative paths, in the order of the URLs
+    paths = []
+    paths_optional = []
+    # (path, renamed path, url) of colliding files
+    collisions = []
+    path_urls = {}
     md5sums = []
     urls_optional = []
     md5sums_optional = []
+    # (algorithm, checksum, filename)
+    checksums = []
+    checksums_optional = []
     shared_files = []
     total_size_bytes = 0
-    resource_count = len(resources)
-    package_count = len(packages)
-    organization_count = len(organizations)
+    # (url, filename, size, md5, [(algorithm, checksum)]) for the aria2 and
+    # Metalink files
+    downloads = []
+    downloads_optional = []
 
     md5_attribute = config.get("ckanext.bulk.md5_attribute", "md5")
+    attributes = checksum_attributes()
+    packages_by_id = {package["id"]: package for package in packages or []}
     for resource in sorted(resources, key=lambda r: r["url"]):
         optional = False
         shared = False
@@ -456,26 +814,548 @@ def generate_bulk_zip(
             if str2bool(resource["optional_file"]):
                 optional = True
 
+        if "size" in resource:
+            if resource["size"]:
+                total_size_bytes = total_size_bytes + resource["size"]
+
+        directory = layout_directory(
+            layout, resource, packages_by_id.get(resource.get("package_id"))
+        )
+        basename = urlparse(url).path.split("/")[-1]
+        filename = posixpath.join(directory, basename)
+        if path_urls.setdefault(filename, url) != url:
+            renamed = posixpath.join(directory, resource["id"], basename)
+            log.warning(
+                "Bulk download path collision: %s renamed %s", filename, renamed
+            )
+            collisions.append((filename, renamed, url))
+            filename = renamed
+            path_urls[filename] = url
+
         if optional:
             urls_optional.append(url)
+            paths_optional.append(filename)
         else:
             urls.append(url)
-
-        if "size" in resource:
-            if resource["size"]:
-                total_size_bytes = total_size_bytes + resource["size"]
+            paths.append(filename)
 
         if md5_attribute in resource:
-            filename = urlparse(url).path.split("/")[-1]
             if optional:
                 md5sums_optional.append((resource[md5_attribute], filename))
             else:
                 md5sums.append((resource[md5_attribute], filename))
 
-    if len(urls_optional):
-        includes_optional = "(includes optional)"
+        resource_checksums = [
+            (algorithm, resource[attribute])
+            for algorithm, attribute in attributes
+            if resource.get(attribute)
+        ]
+        (checksums_optional if optional else checksums).extend(
+            (algorithm, checksum, filename) for algorithm, checksum in resource_checksums
+        )
+
+        download = (
+            url,
+            filename,
+            resource.get("size"),
+            resource.get(md5_attribute),
+            resource_checksums,
+        )
+        if optional:
+            downloads_optional.append(download)
+        else:
+            downloads.append(download)
+
+    return {
+        "urls": urls,
+        "md5sums": md5sums,
+        "urls_optional": urls_optional,
+        "md5sums_optional": md5sums_optional,
+        "paths": paths,
+        "paths_optional": paths_optional,
+        "collisions": collisions,
+        "checksums": checksums,
+        "checksums_optional": checksums_optional,
+        "shared_files": shared_files,
+        "total_size_bytes": total_size_bytes,
+        "downloads": downloads,
+        "downloads_optional": downloads_optional,
+    }
+
+
+def size_or_none(size):
+    try:
+        return int(size)
+    except (TypeError, ValueError):
+        return None
+
+
+def sizes_list(downloads):
+    """
+    "size  filename" lines, for the downloads of known size
+    """
+    lines = []
+    for url, filename, size, md5, checksums in downloads:
+        size = size_or_none(size)
+        if size is not None:
+            lines.append("%d  %s" % (size, filename))
+    return "\n".join(lines) + "\n"
+
+
+def aria2_input(downloads, site_url):
+    """
+    an aria2c input file (`aria2c -i`) for the downloads, with MD5
+    checksums, and an authorization header placeholder for those on the
+    portal at `site_url`, so that the API token is not sent elsewhere
+    """
+    lines = []
+    for url, filename, size, md5, checksums in downloads:
+        lines.append(url)
+        lines.append("  out=%s" % (filename,))
+        if url.startswith(site_url + "/"):
+            lines.append("  header=%s" % (AUTH_HEADER_PLACEHOLDER,))
+        if md5:
+            lines.append("  checksum=md5=%s" % (md5,))
+    return "\n".join(lines) + "\n"
+
+
+def metalink(downloads):
+    """
+    a Metalink 4 (RFC 5854) document for the downloads
+    """
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<metalink xmlns="urn:ietf:params:xml:ns:metalink">',
+        "  <generator>ckanext-bulk</generator>",
+    ]
+    for url, filename, size, md5, checksums in downloads:
+        lines.append("  <file name=%s>" % (quoteattr(filename),))
+        size = size_or_none(size)
+        if size is not None:
+            lines.append("    <size>%d</size>" % (size,))
+        for algorithm, checksum in checksums:
+            if algorithm in METALINK_HASH_TYPES:
+                lines.append(
+                    "    <hash type=%s>%s</hash>"
+                    % (quoteattr(METALINK_HASH_TYPES[algorithm]), escape(checksum))
+                )
+        lines.append("    <url>%s</url>" % (escape(url),))
+        lines.append("  </file>")
+    lines.append("</metalink>")
+    return "\n".join(lines) + "\n"
+
+
+def checksums_list(checksums):
+    """
+    "algorithm checksum  filename" lines
+    """
+    return "".join("%s %s  %s\n" % t for t in checksums)
+
+
+def shared_fingerprint(fingerprint, since=None, layout="flat"):
+    """
+    fingerprint of everything the user-independent archive members are
+    generated from, computed from the search index (see
+    `index_fingerprint`) so that cached members are found before any
+    packages are loaded
+    """
+    components = {
+        "md5_attribute": config.get("ckanext.bulk.md5_attribute", "md5"),
+        "checksum_attributes": checksum_attributes(),
+        "layout": layout,
+        "repeating_subfields": repeating_subfields_mode(),
+        "packages": fingerprint,
+        "since": str(since) if since else None,
+        # only URLs on the portal are sent the API token
+        "site_url": config.get("ckan.site_url", "").rstrip("/"),
+    }
+    return hashlib.sha1(
+        json.dumps(components, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def manifest_fields():
+    # the resource fields `build_manifest` reads
+    return [
+        "id",
+        "package_id",
+        "url",
+        "size",
+        "shared_file",
+        "optional_file",
+        config.get("ckanext.bulk.md5_attribute", "md5"),
+    ] + [attribute for algorithm, attribute in checksum_attributes()]
+
+
+def manifest_package(package):
+    # enough of a package to place its files in any layout
+    organization = package.get("organization") or {}
+    return {
+        "id": package["id"],
+        "name": package.get("name"),
+        "owner_org": package.get("owner_org"),
+        "organization": {"name": organization.get("name")},
+    }
+
+
+def build_shared_members(packages, layout="flat"):
+    """
+    the archive members which are the same for every user downloading the
+    same packages: the URL and MD5 lists, and the package and resource
+    metadata CSVs. Member names are templates, formatted with the archive
+    prefix. `packages` is read once, a package at a time (e.g. from
+    `iter_packages`): its rows are spooled to the CSV of its type, and only
+    the fields of its resources the manifest needs are kept.
+    """
+    timer = current_timer()
+    members = []
+    fields = manifest_fields()
+    manifest_packages = []
+    manifest_resources = []
+    package_spools = {}
+    resource_spools = {}
+    # of the packages' organizations, in the order first seen
+    organization_ids = {}
+    access_packages = []
+    package_ids = []
+
+    def spool(spools, typ, schema_key):
+        if typ not in spools:
+            spools[typ] = CsvSpool(typ, schema_key)
+        return spools[typ]
+
+    for package in packages:
+        with timer.stage("spool"):
+            package_ids.append(package["id"])
+            organization = package.get("organization") or {}
+            if organization.get("id"):
+                organization_ids.setdefault(organization["id"], None)
+            manifest_packages.append(manifest_package(package))
+            # some objects may not have a ckanext-scheming schema
+            typ = package.get("type", "unknown")
+            if typ is not None:
+                spool(package_spools, typ, "dataset_fields").add(package)
+            for resource in package["resources"]:
+                manifest_resources.append(
+                    {field: resource[field] for field in fields if field in resource}
+                )
+                typ = resource.get("resource_type", "unknown")
+                if typ is not None:
+                    spool(resource_spools, typ, "resource_fields").add(resource)
+            if package["resources"]:
+                # enough of each package to check initiative access
+                first = package["resources"][0]
+                access_packages.append(
+                    {
+                        "id": package["id"],
+                        "name": package.get("name"),
+                        "resources": [{"id": first["id"]}],
+                    }
+                )
+
+    with timer.stage("manifest"):
+        manifest = build_manifest(manifest_resources, manifest_packages, layout)
+
+    members.append((URLS_FNAME, "\n".join(manifest["urls"]) + "\n"))
+    members.append((PATHS_FNAME, "\n".join(manifest["paths"]) + "\n"))
+    members.append(
+        (MD5SUM_FNAME, "\n".join("%s  %s" % t for t in manifest["md5sums"]) + "\n")
+    )
+    members.append((SIZES_FNAME, sizes_list(manifest["downloads"])))
+    members.append((CHECKSUMS_FNAME, checksums_list(manifest["checksums"])))
+    site_url = config.get("ckan.site_url", "").rstrip("/")
+    members.append((ARIA2_FNAME, aria2_input(manifest["downloads"], site_url)))
+    members.append((METALINK_FNAME, metalink(manifest["downloads"])))
+
+    if len(manifest["urls_optional"]):
+        members.append(
+            (URLS_OPTIONAL_FNAME, "\n".join(manifest["urls_optional"]) + "\n")
+        )
+        members.append(
+            (PATHS_OPTIONAL_FNAME, "\n".join(manifest["paths_optional"]) + "\n")
+        )
+        members.append(
+            (
+                MD5SUM_OPTIONAL_FNAME,
+                "\n".join("%s  %s" % t for t in manifest["md5sums_optional"]) + "\n",
+            )
+        )
+        members.append(
+            (SIZES_OPTIONAL_FNAME, sizes_list(manifest["downloads_optional"]))
+        )
+        members.append(
+            (CHECKSUMS_OPTIONAL_FNAME, checksums_list(manifest["checksums_optional"]))
+        )
+        members.append(
+            (
+                ARIA2_OPTIONAL_FNAME,
+                aria2_input(manifest["downloads_optional"], site_url),
+            )
+        )
+        members.append(
+            (METALINK_OPTIONAL_FNAME, metalink(manifest["downloads_optional"]))
+        )
+        members.append(("OPTIONAL.txt", str_crlf(OPTIONAL_NOTE.format())))
+
+    if manifest["collisions"]:
+        members.append(
+            (
+                "COLLISIONS.txt",
+                str_crlf(
+                    COLLISIONS_NOTE
+                    + "".join(
+                        "%s\n    renamed %s\n    from %s\n" % t
+                        for t in manifest["collisions"]
+                    )
+                ),
+            )
+        )
+
+    for typ, typ_spool in package_spools.items():
+        with timer.stage("csv_package_{}".format(typ)):
+            members.append(
+                (
+                    "package_metadata/package_metadata_{prefix}_%s.csv" % (typ,),
+                    typ_spool.csv(),
+                )
+            )
+        typ_spool.close()
+
+    for typ, typ_spool in resource_spools.items():
+        with timer.stage("csv_resource_{}".format(typ)):
+            members.append(
+                (
+                    "resource_metadata/resource_metadata_{prefix}_%s.csv" % (typ,),
+                    typ_spool.csv(),
+                )
+            )
+        typ_spool.close()
+
+    return {
+        "members": members,
+        "url_count": len(manifest["urls"]),
+        "md5_count": len(manifest["md5sums"]),
+        "url_optional_count": len(manifest["urls_optional"]),
+        "md5_optional_count": len(manifest["md5sums_optional"]),
+        "shared_files_count": len(manifest["shared_files"]),
+        "layout": layout,
+        "collision_count": len(manifest["collisions"]),
+        "total_size_bytes": manifest["total_size_bytes"],
+        "package_count": len(package_ids),
+        "resource_count": len(manifest_resources),
+        "organization_ids": list(organization_ids),
+        "access_packages": access_packages,
+        "package_ids": package_ids,
+    }
+
+
+def build_compressed_members(key, fingerprint, packages, layout):
+    shared = build_shared_members(packages, layout)
+    with current_timer().stage("compression"):
+        members = shared["members"]
+        shared["members"] = []
+        for name, data in members:
+            shared["members"].append(compress_member(name, data))
+            if hasattr(data, "close"):
+                data.close()
+    shared["key"] = key
+    # the key is only good for these members if the packages read are
+    # those fingerprinted: not if the index has changed since, or a
+    # package was looked up without being in it
+    if sorted(shared.pop("package_ids")) == sorted(t[0] for t in fingerprint):
+        cache_put(key, shared)
+    else:
+        log.info("Bulk archive members not cached: the search index has changed")
+    return shared
+
+
+def build_wait():
+    # seconds to wait for another worker process building the same members
+    return tk.asint(config.get("ckanext.bulk.build_wait", 30))
+
+
+def build_members_once(key, fingerprint, packages, layout):
+    """
+    build and cache the members, unless another worker process on this
+    host is already doing so: then wait for it (up to `build_wait`
+    seconds) and use the members it cached
+    """
+    if not cache_enabled():
+        return build_compressed_members(key, fingerprint, packages, layout)
+    with build_lock(key, build_wait()) as waited:
+        if waited:
+            shared = cache_get(key)
+            metrics.cache_result("shared_building", shared is not None)
+            if shared is not None:
+                return shared
+        return build_compressed_members(key, fingerprint, packages, layout)
+
+
+# concurrent requests for the same packages in this process share one
+# build of the user-independent members; those in other processes wait
+# for it (see `build_members_once`)
+shared_builds = SingleFlight()
 
-    shared_files_count = len(shared_files)
+
+def shared_members(fingerprint, packages, since=None, layout="flat"):
+    """
+    the user-independent members, precompressed, from the member cache
+    or built (once, for concurrent requests) and cached. `packages` is
+    only read if the members are built, so it is best a generator which
+    loads them as they are read.
+    """
+    key = shared_fingerprint(fingerprint, since, layout)
+    with current_timer().stage("member_cache"):
+        shared = cache_get(key)
+    metrics.cache_result("members", shared is not None)
+    if shared is None:
+        shared, reused = shared_builds.do(
+            key,
+            lambda: build_members_once(key, fingerprint, packages, layout),
+        )
+        metrics.cache_result("shared_inflight", reused)
+    return shared
+
+
+def signed_lines(name, lines, signed):
+    """
+    the lines of a member listing URLs (see `SIGNED_FNAMES`), with the
+    URLs in `signed` replaced
+    """
+    if name in (ARIA2_FNAME, ARIA2_OPTIONAL_FNAME):
+        # a signed URL is not on the portal, so is not sent the API token
+        result = []
+        skip_header = False
+        for line in lines:
+            if not line.startswith(" "):
+                skip_header = line in signed
+                result.append(signed.get(line, line))
+            elif not (skip_header and line.startswith("  header=")):
+                result.append(line)
+        return result
+    if name in (METALINK_FNAME, METALINK_OPTIONAL_FNAME):
+        result = []
+        for line in lines:
+            match = METALINK_URL_RE.match(line)
+            if match and unescape(match.group(2)) in signed:
+                line = "%s%s%s" % (
+                    match.group(1),
+                    escape(signed[unescape(match.group(2))]),
+                    match.group(3),
+                )
+            result.append(line)
+        return result
+    return [signed.get(line, line) for line in lines]
+
+
+def member_urls(name, lines):
+    # the URLs listed in a member (see `SIGNED_FNAMES`)
+    if name in (ARIA2_FNAME, ARIA2_OPTIONAL_FNAME):
+        return [line for line in lines if line and not line.startswith(" ")]
+    if name in (METALINK_FNAME, METALINK_OPTIONAL_FNAME):
+        return [
+            unescape(match.group(2))
+            for match in map(METALINK_URL_RE.match, lines)
+            if match
+        ]
+    return lines
+
+
+def signed_member(member, sign):
+    """
+    a copy of a member listing URLs, with the URLs signed by `sign`
+    """
+    lines = decompress_member(member).decode("utf-8").splitlines()
+    signed = sign(member_urls(member.name, lines))
+    return compress_member(
+        member.name, "\n".join(signed_lines(member.name, lines, signed)) + "\n"
+    )
+
+
+def refresh_members(fingerprint, since=None, layout="flat"):
+    """
+    extend the life of the cached members for the fingerprinted packages,
+    returning False if there are none
+    """
+    return cache_touch(shared_fingerprint(fingerprint, since, layout))
+
+
+def generate_bulk_zip(
+    pfx,
+    title,
+    user,
+    memberships,
+    access_required,
+    organizations,
+    shared,
+    query=None,
+    query_url=None,
+    download_url=None,
+    since=None,
+    next_since=None,
+    sign=None,
+):
+    user_page = None
+    username = ""
+    includes_optional = ""
+    site_url = config.get("ckan.site_url").rstrip("/")
+    if user:
+        user_page = "%s%s" % (
+            site_url,
+            h.url_for("user.read", id=user.name),
+        )
+        username = user.name
+
+    timer = current_timer()
+
+    def ip(s):
+        return pfx + "/" + s.format(prefix=pfx)
+
+    def writestr(name, data):
+        with timer.stage("compression"):
+            zf.writestr(name, data)
+
+    def write_script(filename, contents):
+        info = ZipInfo(ip(filename))
+        info.external_attr = 0o755 << 16  # mark script as executable
+        with timer.stage("scripts"):
+            contents = (
+                jinja2.Environment()
+                .from_string(contents)
+                .render(
+                    user_page=user_page,
+                    md5sum_fname=MD5SUM_FNAME.format(prefix=pfx),
+                    urls_fname=URLS_FNAME.format(prefix=pfx),
+                    md5sum_optional_fname=MD5SUM_OPTIONAL_FNAME.format(prefix=pfx),
+                    urls_optional_fname=URLS_OPTIONAL_FNAME.format(prefix=pfx),
+                    paths_fname=PATHS_FNAME.format(prefix=pfx),
+                    paths_optional_fname=PATHS_OPTIONAL_FNAME.format(prefix=pfx),
+                    sizes_fname=SIZES_FNAME.format(prefix=pfx),
+                    sizes_optional_fname=SIZES_OPTIONAL_FNAME.format(prefix=pfx),
+                    checksums_fname=CHECKSUMS_FNAME.format(prefix=pfx),
+                    checksums_optional_fname=CHECKSUMS_OPTIONAL_FNAME.format(prefix=pfx),
+                    verified_fname=VERIFIED_FNAME.format(prefix=pfx),
+                    verified_optional_fname=VERIFIED_OPTIONAL_FNAME.format(prefix=pfx),
+                    prefix=pfx,
+                    username=username,
+                    site_url=site_url,
+                )
+            )
+        writestr(info, contents.encode("utf-8"))
+
+    resource_count = shared["resource_count"]
+    package_count = shared["package_count"]
+    organization_count = len(organizations)
+    timer.facts.update(
+        packages=package_count,
+        resources=resource_count,
+        organizations=organization_count,
+    )
+
+    total_size_bytes = shared["total_size_bytes"]
+
+    if shared["url_optional_count"]:
+        includes_optional = "(includes optional)"
 
     headers = {
         "Content-Type": "application/zip",
@@ -484,7 +1364,7 @@ def generate_bulk_zip(
 
     fd = BytesIO()
     zf = ZipFile(fd, mode="w", compression=ZIP_DEFLATED)
-    zf.writestr(
+    writestr(
         ip("README.txt"),
         str_crlf(
             BULK_EXPLANATORY_NOTE.format(
@@ -498,62 +1378,44 @@ def generate_bulk_zip(
                 package_count=package_count,
                 total_size_bytes=total_size_bytes,
                 includes_optional=includes_optional,
+                layout=shared["layout"],
             )
         ),
     )
 
-    urls_fname = "tmp/{}_urls.txt".format(pfx)
-    md5sum_fname = "tmp/{}_md5sum.txt".format(pfx)
-
-    urls_optional_fname = "tmp/{}_urls_optional.txt".format(pfx)
-    md5sum_optional_fname = "tmp/{}_md5sum_optional.txt".format(pfx)
-
-    zf.writestr(ip(urls_fname), "\n".join(urls) + "\n")
-    zf.writestr(ip(md5sum_fname), "\n".join("%s  %s" % t for t in md5sums) + "\n")
-
-    if len(urls_optional):
-        zf.writestr(ip(urls_optional_fname), "\n".join(urls_optional) + "\n")
-        zf.writestr(ip(md5sum_optional_fname), "\n".join("%s  %s" % t for t in md5sums_optional) + "\n")
-        zf.writestr(
-            ip("OPTIONAL.txt"),
-            str_crlf(
-                OPTIONAL_NOTE.format()
-            ),
+    members = shared["members"]
+    signed_expires = ""
+    if sign is not None:
+        # URLs for direct download from object storage, for this user only
+        signed_expires = format_since(
+            utc_now() + datetime.timedelta(seconds=signed_url_expiry())
         )
-
+        with timer.stage("signing"):
+            members = [
+                signed_member(member, sign) if member.name in SIGNED_FNAMES else member
+                for member in members
+            ]
+
+    with timer.stage("splice"):
+        for member in members:
+            write_compressed(zf, ip(member.name), member)
+
+    # built for each request, as organizations change independently of
+    # their packages (and are not part of the member cache key). They are
+    # timed as one stage, however many there are (see timer.facts).
     for org in organizations:
-        zf.writestr(
-            ip(
-                "organization_metadata/organization_metadata_{}.csv".format(org["name"])
-            ),
-            org_with_extras_to_csv(org),
-        )
-
-    for typ, typ_packages in list(objects_by_attr(packages, "type", "unknown").items()):
-        # some objects may not have a ckanext-scheming schema
-        if typ is None:
-            continue
-        zf.writestr(
-            ip("package_metadata/package_metadata_{}_{}.csv".format(pfx, typ)),
-            schema_to_csv(typ, "dataset_fields", typ_packages),
-        )
-
-    for typ, typ_resources in list(objects_by_attr(
-        resources, "resource_type", "unknown"
-    ).items()):
-        # some objects may not have a ckanext-scheming schema
-        if typ is None:
-            continue
-        zf.writestr(
-            ip("resource_metadata/resource_metadata_{}_{}.csv".format(pfx, typ)),
-            schema_to_csv(typ, "resource_fields", typ_resources),
+        with timer.stage("csv_organizations"):
+            contents = org_with_extras_to_csv(org)
+        writestr(
+            ip("organization_metadata/organization_metadata_{}.csv".format(org["name"])),
+            contents,
         )
 
     write_script("download.sh", SH_TEMPLATE)
     write_script("download.ps1", POWERSHELL_TEMPLATE)
     write_script("download.py", PY_TEMPLATE)
 
-    zf.writestr(
+    writestr(
         ip("QUERY.txt"),
         str_crlf(
             QUERY_TEMPLATE.format(
@@ -561,38 +1423,46 @@ def generate_bulk_zip(
                 timestamp=get_timestamp(),
                 title=title,
                 user_page=user_page,
-                url_count=len(urls),
-                md5_count=len(md5sums),
-                url_optional_count=len(urls_optional),
-                md5_optional_count=len(md5sums_optional),
+                url_count=shared["url_count"],
+                md5_count=shared["md5_count"],
+                url_optional_count=shared["url_optional_count"],
+                md5_optional_count=shared["md5_optional_count"],
                 query=query,
                 query_url=query_url,
                 download_url=download_url,
+                since=format_since(since) if since else "",
+                next_since=format_since(next_since) if next_since else "",
+                signed_expires=signed_expires,
                 organization_count=organization_count,
                 package_count=package_count,
                 resource_count=resource_count,
-                shared_files_count=shared_files_count,
+                shared_files_count=shared["shared_files_count"],
+                layout=shared["layout"],
+                collision_count=shared["collision_count"],
                 total_size=bitmath.Byte(bytes=total_size_bytes).best_prefix().format("{value:.2f} {unit}"),
                 total_size_bytes=total_size_bytes,
             )
         ),
     )
 
-    zf.writestr(
-        ip("MEMBERSHIPS.txt"),
-        str_crlf(
-            generate_memberships_information(
-                prefix=pfx,
-                timestamp=get_timestamp(),
-                title=title,
-                user_page=user_page,
-                organization_count=organization_count,
-                memberships=memberships,
-                access_required=access_required,
-            )
-        ),
-    )
+    with timer.stage("memberships"):
+        contents = generate_memberships_information(
+            prefix=pfx,
+            timestamp=get_timestamp(),
+            title=title,
+            user_page=user_page,
+            organization_count=organization_count,
+            memberships=memberships,
+            access_required=access_required,
+        )
+    writestr(ip("MEMBERSHIPS.txt"), str_crlf(contents))
+
+    profiler = current_profiler()
+    if profiler is not None:
+        writestr(ip("tmp/{prefix}_profile.pstats"), profile_stats(profiler))
 
-    zf.close()
-    content = fd.getvalue()
-    return make_response((content, 200, headers))
+    with timer.stage("compression"):
+        zf.close()
+        content = fd.getvalue()
+    with timer.stage("response"):
+        return make_response((content, 200, headers))